@@ -0,0 +1,208 @@
+import os
+import time
+import asyncio
+import termios
+import threading
+from asyncio.streams import FlowControlMixin
+from Classes.GcodeStreamer import GcodeStreamer, StreamStats, StreamCancelled, encodeLine
+from Classes.MeatPack import ENABLE as MEATPACK_ENABLE, DISABLE as MEATPACK_DISABLE, QUERY as MEATPACK_QUERY, packLine
+
+BAUDRATES = {
+    9600: termios.B9600,
+    19200: termios.B19200,
+    38400: termios.B38400,
+    57600: termios.B57600,
+    115200: termios.B115200,
+    230400: termios.B230400,
+}
+# unbuffered bytes we allow the OS write buffer to hold before write() callers have to wait
+WRITE_HIGH_WATER = 4096
+# seconds a read waits for a response line before giving up, like the pool's serial timeout
+READ_TIMEOUT = 1.0
+
+
+# Opens a serial device non-blocking in raw 8N1 mode, the same settings pyserial uses. Each open
+# is its own open file, so O_NONBLOCK here never reaches another handle on the same port.
+def openSerialFd(device, baudrate=115200, configure=True):
+    fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    if configure:
+        try:
+            configureSerialFd(fd, baudrate)
+        except Exception:
+            os.close(fd)
+            raise
+    return fd
+
+
+def configureSerialFd(fd, baudrate=115200):
+    iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+    iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR
+               | termios.IGNCR | termios.ICRNL | termios.IXON | termios.IXOFF)
+    oflag &= ~termios.OPOST
+    lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+    cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB)
+    cflag |= termios.CS8 | termios.CLOCAL | termios.CREAD
+    speed = BAUDRATES.get(baudrate, termios.B115200)
+    termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+
+
+# A serial port driven by an asyncio event loop. The read side feeds a StreamReader and the write
+# side applies backpressure through drain() once the OS buffer passes WRITE_HIGH_WATER.
+class AsyncSerialConnection:
+    def __init__(self, reader, writer, readTransport):
+        self.reader = reader
+        self.writer = writer
+        self.readTransport = readTransport
+
+    # Opens `device` again even when pyserial already has it open (e.g. a port borrowed from the
+    # connection pool, which is set up already, so `configure=False`). A dup of pyserial's fd would
+    # share its file status flags, and the non-blocking mode asyncio needs would leak into it.
+    @classmethod
+    async def open(cls, device, baudrate=115200, configure=True):
+        loop = asyncio.get_running_loop()
+        readFd = openSerialFd(device, baudrate, configure)
+        writeFd = os.dup(readFd)
+        try:
+            reader = asyncio.StreamReader()
+            readTransport, _ = await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(readFd, "rb", buffering=0)
+            )
+            writeTransport, writeProtocol = await loop.connect_write_pipe(
+                FlowControlMixin, os.fdopen(writeFd, "wb", buffering=0)
+            )
+        except Exception:
+            for f in (readFd, writeFd):
+                try:
+                    os.close(f)
+                except OSError:
+                    pass
+            raise
+        writeTransport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+        writer = asyncio.StreamWriter(writeTransport, writeProtocol, reader, loop)
+        return cls(reader, writer, readTransport)
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def readline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Serial connection closed.")
+        return line
+
+    def close(self):
+        self.writer.close()
+        self.readTransport.close()
+
+
+# Same windowed protocol as GcodeStreamer, driven by coroutines on an event loop. Cancelling the
+# task that is streaming stops it at the next read or write.
+class AsyncGcodeStreamer(GcodeStreamer):
+    async def stream(self, lines, packed=False):
+        self.stats = StreamStats()
+        self.stats.startTime = time.monotonic()
+        try:
+            if packed:
+                await self.startPacking()
+            for line in lines:
+                if isinstance(line, tuple):
+                    await self.write(line[1], line[0], line[2] if len(line) > 2 else None)
+                else:
+                    await self.write(encodeLine(line))
+                await self.pollTelemetry()
+            await self.drain()
+        finally:
+            if packed:
+                await self.stopPacking()
+            self.stats.endTime = time.monotonic()
+        return self.stats
+
+    async def send(self, line):
+        await self.write(encodeLine(line))
+        await self.drain()
+        return self.lastResponse
+
+    async def write(self, data, number=None, text=None):
+        if self.packer is not None and text is None:
+            data, text = self.packer(data), data
+        self.outbox.append((number, data, text))
+        await self.flush()
+
+    async def flush(self):
+        outbox = self.outbox
+        while outbox:
+            number, data, text = outbox[0]
+            if not self.window.canSend(len(data)):
+                await self.readResponse()
+                continue
+            outbox.popleft()
+            await self.ser.write(data)
+            self.recordSent(data, number, text)
+
+    async def startPacking(self):
+        await self.flush()
+        await self.ser.write(MEATPACK_ENABLE)
+        self.packer = packLine
+
+    async def stopPacking(self):
+        self.packer = None
+        self.outbox.clear()
+        self.history.clear()
+        await self.ser.write(MEATPACK_DISABLE)
+
+    async def queryPacking(self):
+        self.packingReport = None
+        await self.flush()
+        await self.ser.write(MEATPACK_QUERY)
+        await self.send("M115")
+        return self.packingReport
+
+    async def pollTelemetry(self):
+        if self.telemetry is not None:
+            for query in self.telemetry.getQueries(printing=True):
+                await self.write(encodeLine(query))
+
+    async def drain(self):
+        await self.flush()
+        while not self.window.isEmpty() or self.outbox:
+            await self.readResponse()
+            await self.flush()
+
+    # Like the threaded version, a read gives up after READ_TIMEOUT so the ack timeout gets checked
+    async def readResponse(self):
+        if self.cancelEvent.is_set():
+            raise StreamCancelled("Streaming cancelled.")
+        started = time.monotonic()
+        try:
+            async with asyncio.timeout(READ_TIMEOUT):
+                response = await self.ser.readline()
+        except TimeoutError:
+            response = b""
+        if self.metrics is None:
+            return self.handleResponse(response.decode("utf-8", errors="replace").strip())
+        now = time.monotonic()
+        self.metrics.readBlocked.value += now - started
+        return self.handleResponse(response.decode("utf-8", errors="replace").strip(), now)
+
+
+# Runs one asyncio event loop on a background thread. Every printer on the async backend is a
+# task on this loop, so dozens of printers share a single thread.
+class EventLoopThread(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True, name="printer-event-loop")
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Schedules a coroutine from any thread. Returns a concurrent.futures.Future.
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def callSoon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
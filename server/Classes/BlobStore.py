@@ -0,0 +1,115 @@
+import os
+import io
+import pathlib
+import gzip
+import shutil
+import hashlib
+import tempfile
+
+# Uploaded G-code lives here, one file per distinct content, instead of in the job table.
+BLOB_DIR = os.environ.get(
+    "GCODE_BLOB_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storage", "blobs"),
+)
+COMPRESSED_EXT = ".gz"
+CHUNK_SIZE = 1 << 20
+
+
+# Opens `source` for reading in chunks: the contents (bytes or str), a readable binary file, or a
+# file on this server given as an os.PathLike (e.g. pathlib.Path). A str is always contents, never
+# a path, since it may have come straight from a request body.
+def openSource(source):
+    if hasattr(source, "read"):
+        return source
+    if isinstance(source, os.PathLike):
+        return open(source, "rb")
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    return io.BytesIO(source)
+
+
+# Content-addressed file store. Each blob is named after the SHA-256 of its contents, so storing
+# the same upload twice keeps a single copy. Blobs are sharded two directory levels deep
+# (ab/cd/abcd...) and optionally gzip-compressed; readers never need to know which.
+class BlobStore:
+    def __init__(self, root=BLOB_DIR, compress=False):
+        self.root = root
+        self.compress = compress
+
+    def getPath(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    # Path of the stored blob, compressed or not. None if it isn't stored.
+    def find(self, key):
+        path = self.getPath(key)
+        for candidate in (path, path + COMPRESSED_EXT):
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def exists(self, key):
+        return self.find(key) is not None
+
+    # Streams `source` into the store. Returns (key, size) where size is the uncompressed size.
+    def put(self, source):
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmpPath = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                out = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) if self.compress else raw
+                with openSource(source) as src:
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                        if isinstance(chunk, str):
+                            chunk = chunk.encode("utf-8")
+                        digest.update(chunk)
+                        size += len(chunk)
+                        out.write(chunk)
+                if out is not raw:
+                    out.close()
+            key = digest.hexdigest()
+            if not self.exists(key):  # identical uploads are deduplicated
+                path = self.getPath(key) + (COMPRESSED_EXT if self.compress else "")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmpPath, path)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        return key, size
+
+    # Moves the file at `path`, whose SHA-256 is already known, into the store (uploads are hashed
+    # as they arrive, so there's no need to read them again). Returns (key, size).
+    def adopt(self, path, key):
+        size = os.path.getsize(path)
+        if self.exists(key):
+            os.remove(path)
+        elif self.compress:  # compressing has to read it again anyway
+            self.put(pathlib.Path(path))
+            os.remove(path)
+        else:
+            target = self.getPath(key)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(path, target)
+        return key, size
+
+    # Opens a stored blob for reading, decompressing transparently.
+    def open(self, key):
+        path = self.find(key)
+        if path is None:
+            raise FileNotFoundError(f"Blob {key} not found.")
+        if path.endswith(COMPRESSED_EXT):
+            return gzip.open(path, "rb")
+        return open(path, "rb")
+
+    def read(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+    def delete(self, key):
+        path = self.find(key)
+        if path is not None:
+            os.remove(path)
+
+
+blobStore = BlobStore(compress=os.environ.get("GCODE_BLOB_COMPRESS", "0") == "1")
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from Classes.BlobStore import blobStore, CHUNK_SIZE
+from Classes.GcodeBuffer import GcodeBufferWriter
+
+# Uploads in progress: the raw bytes received so far (<id>.part) and what the upload is for (<id>.json)
+UPLOAD_DIR = os.environ.get(
+    "GCODE_UPLOAD_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storage", "uploads"),
+)
+# uploads that haven't received anything for this long are deleted, in seconds
+UPLOAD_EXPIRY = 24 * 60 * 60
+
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, expected):
+        super().__init__(f"Upload is at offset {expected}.")
+        self.expected = expected
+
+
+# One file being uploaded in chunks. Every chunk is appended to the part file, hashed and stripped
+# as it arrives, so once the last byte lands the blob's key is known and its GcodeBuffer is built.
+# Memory use is one chunk, whatever the file size.
+class ChunkedUpload:
+    def __init__(self, uploadId, root, info):
+        self.id = uploadId
+        self.root = root
+        self.info = info  # {"name", "size", "printerid", ...} as given when the upload was created
+        self.size = info["size"]
+        self.offset = 0
+        self.digest = hashlib.sha256()
+        self.writer = None
+        self.lock = threading.Lock()  # one chunk at a time
+
+    def getPartPath(self):
+        return os.path.join(self.root, self.id + ".part")
+
+    def getInfoPath(self):
+        return os.path.join(self.root, self.id + ".json")
+
+    # Picks up whatever was received before a restart, by re-reading the part file
+    def restore(self):
+        self.writer = GcodeBufferWriter()
+        with open(self.getPartPath(), "ab+") as part:
+            part.seek(0)
+            for chunk in iter(lambda: part.read(CHUNK_SIZE), b""):
+                self.consume(chunk)
+
+    def consume(self, chunk):
+        self.digest.update(chunk)
+        self.writer.feed(chunk)
+        self.offset += len(chunk)
+
+    # Appends the body of a request (a readable stream) at `offset`, which must be where the upload
+    # is. Data past the declared size is an error. Returns the new offset. If the stream breaks off,
+    # everything read up to that point is kept and the client resumes from the returned offset.
+    def append(self, offset, stream):
+        if not self.lock.acquire(blocking=False):
+            raise UploadOffsetMismatch(self.offset)  # another chunk is still being written
+        try:
+            if offset != self.offset:
+                raise UploadOffsetMismatch(self.offset)
+            with open(self.getPartPath(), "ab") as part:
+                try:
+                    while self.offset < self.size:
+                        chunk = stream.read(min(CHUNK_SIZE, self.size - self.offset))
+                        if not chunk:
+                            break
+                        part.write(chunk)
+                        self.consume(chunk)
+                finally:
+                    part.flush()
+                    os.fsync(part.fileno())
+            if stream.read(1):
+                raise ValueError(f"Upload is larger than its declared size of {self.size} bytes.")
+            return self.offset
+        finally:
+            self.lock.release()
+
+    def isComplete(self):
+        return self.offset == self.size
+
+    # Stores the finished file in the blob store and its preprocessed buffer in the cache.
+    # Returns (key, size).
+    def finish(self):
+        with self.lock:
+            if self.writer is None:
+                raise UploadOffsetMismatch(self.offset)  # already finished by another request
+            key = self.digest.hexdigest()
+            self.writer.finish(key).close()
+            self.writer = None
+            result = blobStore.adopt(self.getPartPath(), key)
+            self.delete()
+            return result
+
+    def delete(self):
+        if self.writer is not None:
+            self.writer.abort()
+        for path in (self.getPartPath(), self.getInfoPath()):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def getStatus(self):
+        return {"uploadid": self.id, "offset": self.offset, "size": self.size}
+
+
+# Uploads in progress by id. Their state survives a restart: an upload is restored from its files
+# the first time it's touched again.
+class UploadStore:
+    def __init__(self, root=UPLOAD_DIR, expiry=UPLOAD_EXPIRY):
+        self.root = root
+        self.expiry = expiry
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def create(self, **info):
+        if int(info.get("size", -1)) < 0:
+            raise ValueError("Upload size is required.")
+        os.makedirs(self.root, exist_ok=True)
+        self.expire()
+        upload = ChunkedUpload(uuid.uuid4().hex, self.root, dict(info, size=int(info["size"])))
+        with open(upload.getInfoPath(), "w") as f:
+            json.dump(upload.info, f)
+        upload.restore()  # creates the empty part file
+        with self.lock:
+            self.uploads[upload.id] = upload
+        return upload
+
+    # The upload with this id, or None
+    def get(self, uploadId):
+        with self.lock:
+            upload = self.uploads.get(uploadId)
+            if upload is not None:
+                return upload
+            if not uploadId.isalnum():
+                return None
+            try:
+                with open(os.path.join(self.root, uploadId + ".json")) as f:
+                    upload = ChunkedUpload(uploadId, self.root, json.load(f))
+            except (OSError, ValueError):
+                return None
+            upload.restore()
+            self.uploads[uploadId] = upload
+            return upload
+
+    def remove(self, upload):
+        with self.lock:
+            self.uploads.pop(upload.id, None)
+        upload.delete()
+
+    # Deletes uploads that have been abandoned
+    def expire(self):
+        cutoff = time.time() - self.expiry
+        for name in os.listdir(self.root):
+            if name.endswith(".part") and os.path.getmtime(os.path.join(self.root, name)) < cutoff:
+                uploadId = name[:-len(".part")]
+                with self.lock:
+                    upload = self.uploads.pop(uploadId, None)
+                if upload is None:
+                    upload = ChunkedUpload(uploadId, self.root, {"size": 0})
+                upload.delete()
+
+
+uploadStore = UploadStore()
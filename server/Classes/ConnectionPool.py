@@ -0,0 +1,189 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import serial
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BAUDRATE = 115200
+# Marlin prints "start" once it has booted. Opening a port toggles DTR and reboots most boards,
+# so commands written before this are lost.
+BOOT_MESSAGE = "start"
+
+
+class ConnectionUnavailable(Exception):
+    pass
+
+
+# One long-lived serial handle for a printer, shared by every job that prints on it.
+class PooledConnection:
+    def __init__(self, key, device):
+        self.key = key
+        self.device = device
+        self.ser = None
+        self.lock = threading.Lock()  # held by whoever has the connection leased
+        self.connects = 0
+        self.reconnects = 0  # connects after the first one
+        self.failures = 0  # consecutive failed connection attempts
+        self.retryAt = 0.0  # monotonic time before which we won't try to reconnect
+
+    def isOpen(self):
+        return self.ser is not None and self.ser.is_open
+
+    # Cheap health check: the port is open and the device still answers ioctls (an unplugged USB
+    # device raises OSError here).
+    def isHealthy(self):
+        if not self.isOpen():
+            return False
+        try:
+            self.ser.in_waiting
+            return True
+        except (OSError, serial.SerialException):
+            return False
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except (OSError, serial.SerialException):
+                pass
+            self.ser = None
+
+
+# Keeps one open serial handle per printer (keyed by hwid) instead of opening the port for every job.
+# Jobs borrow the handle through lease(), which reconnects with exponential backoff if the port has
+# gone away since it was last used. `resolver(key)`, if set, gives the device a printer is on now, so
+# a board that comes back on a different port after a USB reset is reconnected there.
+class SerialConnectionPool:
+    def __init__(self, baudrate=DEFAULT_BAUDRATE, timeout=1, bootTimeout=3.0, minBackoff=0.5, maxBackoff=30.0,
+                 maxAttempts=5, opener=serial.Serial, resolver=None):
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.bootTimeout = bootTimeout
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.maxAttempts = maxAttempts
+        self.opener = opener
+        self.resolver = resolver
+        self.__connections = {}  # key: PooledConnection
+        self.__lock = threading.Lock()
+
+    def getConnection(self, key, device):
+        with self.__lock:
+            conn = self.__connections.get(key)
+            if conn is None:
+                conn = PooledConnection(key, device)
+                self.__connections[key] = conn
+            return conn
+
+    # Context manager that lends the printer's serial handle for the duration of the block. Only
+    # one lease per printer can be held at a time. A serial error inside the block closes the
+    # handle so the next lease reconnects.
+    @contextmanager
+    def lease(self, key, device, timeout=None):
+        ser = self.acquire(key, device, timeout)
+        try:
+            yield ser
+        except (OSError, serial.SerialException):
+            self.invalidate(key)
+            raise
+        finally:
+            self.release(key)
+
+    # Non-context version of lease(), for callers that hold the handle across calls (the asyncio
+    # backend). Every acquire() must be paired with release().
+    def acquire(self, key, device, timeout=None):
+        conn = self.getConnection(key, device)
+        if not conn.lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise ConnectionUnavailable(f"Connection to {device} is in use.")
+        try:
+            if device != conn.device:  # the printer has moved to a different port
+                conn.close()
+                conn.device = device
+            if not conn.isHealthy():
+                self.reconnect(conn)
+            return conn.ser
+        except Exception:
+            conn.lock.release()
+            raise
+
+    def release(self, key):
+        conn = self.__connections.get(key)
+        if conn is not None and conn.lock.locked():
+            conn.lock.release()
+
+    def reconnect(self, conn):
+        conn.close()
+        for _ in range(self.maxAttempts):
+            delay = conn.retryAt - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if self.resolver is not None:
+                conn.device = self.resolver(conn.key) or conn.device
+            try:
+                conn.ser = self.open(conn.device)
+                conn.failures = 0
+                if conn.connects > 0:
+                    conn.reconnects += 1
+                conn.connects += 1
+                return conn.ser
+            except (OSError, serial.SerialException) as e:
+                conn.failures += 1
+                backoff = min(self.maxBackoff, self.minBackoff * (2 ** (conn.failures - 1)))
+                conn.retryAt = time.monotonic() + backoff
+                logger.warning("Connect failed", extra={"device": conn.device, "error": str(e), "retry_in": backoff})
+        raise ConnectionUnavailable(f"Could not connect to {conn.device} after {self.maxAttempts} attempts.")
+
+    def open(self, device):
+        ser = self.opener(device, self.baudrate, timeout=self.timeout)
+        self.waitForBoot(ser)
+        return ser
+
+    # Waits for the firmware to finish booting after the port is opened, so the first commands
+    # we send aren't swallowed by the bootloader.
+    def waitForBoot(self, ser):
+        deadline = time.monotonic() + self.bootTimeout
+        while time.monotonic() < deadline:
+            response = ser.readline().decode("utf-8", errors="replace").strip()
+            if response.startswith(BOOT_MESSAGE):
+                break
+        ser.reset_input_buffer()
+
+    # Closes the handle so the next lease reopens it
+    def invalidate(self, key):
+        conn = self.__connections.get(key)
+        if conn is not None:
+            conn.close()
+
+    def updateDevice(self, key, device):
+        conn = self.__connections.get(key)
+        if conn is not None and conn.device != device:
+            with conn.lock:
+                conn.close()
+                conn.device = device
+
+    def close(self, key):
+        with self.__lock:
+            conn = self.__connections.pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def closeAll(self):
+        with self.__lock:
+            connections = list(self.__connections.values())
+            self.__connections = {}
+        for conn in connections:
+            conn.close()
+
+    # True if the printer's port is open, whether or not it's leased right now
+    def isConnected(self, key):
+        conn = self.__connections.get(key)
+        return conn is not None and conn.isOpen()
+
+    def getReconnects(self, key):
+        conn = self.__connections.get(key)
+        return conn.reconnects if conn is not None else 0
+
+
+serialPool = SerialConnectionPool()
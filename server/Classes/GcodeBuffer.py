@@ -0,0 +1,276 @@
+import os
+import io
+import mmap
+import hashlib
+import tempfile
+from array import array
+
+# Preprocessed G-code is cached here, one blob + one offset index per distinct source file.
+CACHE_DIR = os.environ.get(
+    "GCODE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "gcode"),
+)
+
+BLOB_EXT = ".gcb"
+INDEX_EXT = ".idx"
+CHECKSUM_EXT = ".sum"
+OFFSET_TYPE = "Q"  # unsigned 64-bit offsets
+CHECKSUM_TYPE = "B"
+# lines at least this long are checksummed as one integer rather than byte by byte
+FOLD_XOR_BYTES = 64
+
+
+# XOR of every byte, as used by "N<n> <command>*<checksum>" lines. Most lines are short enough
+# that a plain loop beats anything else in Python; longer ones are folded in half as one integer
+# until a byte is left.
+def xorBytes(data):
+    if len(data) < FOLD_XOR_BYTES:
+        checksum = 0
+        for byte in data:
+            checksum ^= byte
+        return checksum
+    folded = int.from_bytes(data, "little")
+    shift = 8 << (len(data) - 1).bit_length()
+    while shift > 8:
+        shift >>= 1
+        folded ^= folded >> shift
+    return folded & 0xFF
+
+
+# Checksum of line `index` (without its newline) sent as "N<index + 1> <line>*<checksum>". Line
+# numbers follow the file, so the checksums can be worked out once when the file is preprocessed.
+def numberedChecksum(index, line):
+    return xorBytes(b"N%d " % (index + 1)) ^ xorBytes(line)
+
+
+# A line that isn't in a buffer (so has no precomputed checksum) as it goes over the wire
+def encodeNumbered(number, line):
+    body = b"N%d %s" % (number, line)
+    return b"%s*%d\n" % (body, xorBytes(body))
+
+
+# Strips whitespace and comments from a raw G-code line. Returns b"" for lines that shouldn't be sent.
+def stripLine(line):
+    if isinstance(line, str):
+        line = line.encode("utf-8")
+    if b";" in line:
+        line = line.split(b";", 1)[0]  # Remove comments starting with ";"
+    return line.strip()
+
+
+# Opens `source` as an iterator of raw lines: the contents (bytes or str), a readable binary file,
+# or a file on this server as an os.PathLike. Like BlobStore.openSource, a str is never a path.
+def _openSource(source):
+    if hasattr(source, "read"):
+        return source
+    if isinstance(source, os.PathLike):
+        return open(source, "rb")
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    return io.BytesIO(source)
+
+
+# SHA-256 of the raw source, read in chunks so large files never sit in memory at once.
+def hashSource(source):
+    digest = hashlib.sha256()
+    with _openSource(source) as raw:
+        for chunk in iter(lambda: raw.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _map(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# Builds a GcodeBuffer from raw G-code fed in pieces of any size (lines may be split across
+# feeds), without holding the file or its offsets in memory. Used for uploads that arrive in chunks.
+class GcodeBufferWriter:
+    FLUSH_OFFSETS = 1 << 16  # offsets kept in memory before they're appended to the index
+
+    def __init__(self, cacheDir=CACHE_DIR):
+        os.makedirs(cacheDir, exist_ok=True)
+        self.cacheDir = cacheDir
+        blobFd, self.blobTmp = tempfile.mkstemp(dir=cacheDir, suffix=BLOB_EXT)
+        indexFd, self.indexTmp = tempfile.mkstemp(dir=cacheDir, suffix=INDEX_EXT)
+        checksumFd, self.checksumTmp = tempfile.mkstemp(dir=cacheDir, suffix=CHECKSUM_EXT)
+        self.blob = os.fdopen(blobFd, "wb")
+        self.index = os.fdopen(indexFd, "wb")
+        self.checksumFile = os.fdopen(checksumFd, "wb")
+        self.offsets = array(OFFSET_TYPE, [0])
+        self.checksums = array(CHECKSUM_TYPE)
+        self.lines = 0
+        self.position = 0
+        self.partial = b""  # the start of a line whose end hasn't arrived yet
+
+    def feed(self, data):
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.writeLine(line)
+
+    def writeLine(self, line):
+        line = stripLine(line)
+        if len(line) == 0:  # Don't keep empty lines and comments
+            return
+        self.checksums.append(numberedChecksum(self.lines, line))
+        self.lines += 1
+        line += b"\n"
+        self.blob.write(line)
+        self.position += len(line)
+        self.offsets.append(self.position)
+        if len(self.offsets) >= self.FLUSH_OFFSETS:
+            self.flushOffsets()
+
+    def flushOffsets(self):
+        self.offsets.tofile(self.index)
+        self.offsets = array(OFFSET_TYPE)
+        self.checksums.tofile(self.checksumFile)
+        self.checksums = array(CHECKSUM_TYPE)
+
+    # Moves the files into the cache as the buffer for `key` (the SHA-256 of everything fed) and
+    # returns it. If that buffer is already cached, it's kept and these files are dropped.
+    def finish(self, key):
+        if self.partial:
+            self.writeLine(self.partial)
+            self.partial = b""
+        self.flushOffsets()
+        self.blob.close()
+        self.index.close()
+        self.checksumFile.close()
+        basePath = os.path.join(self.cacheDir, key)
+        if not GcodeBuffer.exists(basePath):
+            os.replace(self.checksumTmp, basePath + CHECKSUM_EXT)
+            os.replace(self.indexTmp, basePath + INDEX_EXT)
+            # the blob goes in last, so a blob on disk always has its index next to it
+            os.replace(self.blobTmp, basePath + BLOB_EXT)
+        self.abort()
+        return GcodeBuffer(basePath)
+
+    # Removes whatever temporary files are left
+    def abort(self):
+        for f, path in ((self.blob, self.blobTmp), (self.index, self.indexTmp), (self.checksumFile, self.checksumTmp)):
+            f.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# Compact, read-only representation of a preprocessed G-code file: every command is stored once,
+# encoded and newline terminated, back to back in a single blob. A parallel array of offsets
+# (one per line plus the end of the blob) gives O(1) access to any line, and a third file holds
+# each line's checksum for numbered sending. The files are memory-mapped, so opening a job costs
+# nothing no matter how large it is.
+class GcodeBuffer:
+    def __init__(self, basePath):
+        self.basePath = basePath
+        self.__blob = _map(basePath + BLOB_EXT)
+        self.__index = _map(basePath + INDEX_EXT)
+        self.__offsets = memoryview(self.__index).cast(OFFSET_TYPE) if self.__index else array(OFFSET_TYPE, [0])
+        self.__checksums = None  # mapped on first use
+
+    # Strips comments and blank lines from `source` and writes the blob and index under `cacheDir`,
+    # named after the SHA-256 of the source. Identical sources are only ever preprocessed once.
+    @classmethod
+    def build(cls, source, cacheDir=CACHE_DIR):
+        digest = hashlib.sha256()
+        writer = GcodeBufferWriter(cacheDir)
+        try:
+            with _openSource(source) as raw:
+                for line in raw:
+                    digest.update(line)
+                    writer.writeLine(line)
+            return writer.finish(digest.hexdigest())
+        finally:
+            writer.abort()
+
+    # Loads the cached buffer for `key` (the SHA-256 of the source) if it's already been built.
+    @classmethod
+    def load(cls, key, cacheDir=CACHE_DIR):
+        basePath = os.path.join(cacheDir, key)
+        if not cls.exists(basePath):
+            return None
+        return cls(basePath)
+
+    # Returns the preprocessed buffer for `source`, only parsing it if it hasn't been seen before.
+    # Hashing is far cheaper than stripping, so repeat uploads and re-prints skip parsing entirely.
+    @classmethod
+    def fromSource(cls, source, cacheDir=CACHE_DIR):
+        return cls.load(hashSource(source), cacheDir) or cls.build(source, cacheDir)
+
+    # Returns the preprocessed buffer for a blob in a BlobStore. The blob key is the SHA-256 of its
+    # contents, the same key the cache uses, so a cached buffer is found without reading the blob.
+    @classmethod
+    def fromBlob(cls, key, store, cacheDir=CACHE_DIR):
+        cached = cls.load(key, cacheDir)
+        if cached is not None:
+            return cached
+        with store.open(key) as blob:
+            return cls.build(blob, cacheDir)
+
+    @staticmethod
+    def exists(basePath):
+        return os.path.exists(basePath + BLOB_EXT) and os.path.exists(basePath + INDEX_EXT)
+
+    def getKey(self):
+        return os.path.basename(self.basePath)
+
+    # Number of bytes in the blob, i.e. everything that will be sent to the printer.
+    def getSize(self):
+        return self.__offsets[len(self.__offsets) - 1]
+
+    def getOffset(self, index):
+        return self.__offsets[index]
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    # Returns line `index` as bytes, including its "\n" terminator.
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("G-code line index out of range")
+        return self.__blob[self.__offsets[index]:self.__offsets[index + 1]]
+
+    def __iter__(self):
+        return self.iterFrom(0)
+
+    # Iterates over the lines starting at `start`. Used to resume part way through a file.
+    def iterFrom(self, start):
+        blob = self.__blob
+        offsets = self.__offsets
+        for i in range(start, len(self)):
+            yield blob[offsets[i]:offsets[i + 1]]
+
+    # Per-line checksums for numbered sending. Buffers cached before checksums were kept get them
+    # computed (and saved) here.
+    def getChecksums(self):
+        if self.__checksums is None:
+            path = self.basePath + CHECKSUM_EXT
+            if not os.path.exists(path):
+                checksums = array(CHECKSUM_TYPE, (numberedChecksum(i, line[:-1]) for i, line in enumerate(self)))
+                fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=CHECKSUM_EXT)
+                with os.fdopen(fd, "wb") as f:
+                    checksums.tofile(f)
+                os.replace(tmpPath, path)
+            self.__checksums = _map(path) or b""
+        return self.__checksums
+
+    # (line number, wire bytes) for every line from `start`, numbered and checksummed. Line i is
+    # sent as N<i + 1>.
+    def iterNumbered(self, start):
+        blob = self.__blob
+        offsets = self.__offsets
+        checksums = self.getChecksums()
+        for i in range(start, len(self)):
+            yield i + 1, b"N%d %s*%d\n" % (i + 1, blob[offsets[i]:offsets[i + 1] - 1], checksums[i])
+
+    def close(self):
+        if isinstance(self.__offsets, memoryview):
+            self.__offsets.release()
+        for m in (self.__blob, self.__index, self.__checksums):
+            if isinstance(m, mmap.mmap):
+                m.close()
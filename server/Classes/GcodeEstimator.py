@@ -0,0 +1,316 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import tempfile
+
+# Firmware defaults for the Original Prusa i3 MK3. M201/M203/M204/M205 in the file override them.
+DEFAULT_MAX_FEEDRATE = {"X": 200.0, "Y": 200.0, "Z": 12.0, "E": 120.0}  # mm/s (M203)
+DEFAULT_MAX_ACCEL = {"X": 1000.0, "Y": 1000.0, "Z": 200.0, "E": 5000.0}  # mm/s^2 (M201)
+DEFAULT_PRINT_ACCEL = 1250.0  # M204 P / S
+DEFAULT_RETRACT_ACCEL = 1250.0  # M204 R
+DEFAULT_TRAVEL_ACCEL = 1250.0  # M204 T
+DEFAULT_JERK = {"X": 10.0, "Y": 10.0, "Z": 0.4, "E": 4.5}  # mm/s (M205)
+DEFAULT_FEEDRATE = 1500.0  # mm/min until the file sets one
+# smallest Z change (mm) that starts a new layer. Spiral vase prints raise Z a little on every
+# move, and this keeps them to one layer per MIN_LAYER_HEIGHT instead of one per line.
+MIN_LAYER_HEIGHT = 0.05
+
+# Filament used and time spent are stored alongside the preprocessed G-code
+ESTIMATE_EXT = ".est.json"
+PROGRESS_LINES = 10_000  # lines between progress reports
+
+WORD = re.compile(r"([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)")
+
+
+# Splits a G-code line into its command ("G1") and {letter: value} parameters.
+def parseLine(line):
+    if isinstance(line, (bytes, bytearray, memoryview)):
+        line = bytes(line).decode("ascii", errors="ignore")
+    words = WORD.findall(line.split(";", 1)[0].upper())
+    if not words:
+        return None, {}
+    letter, number = words[0]
+    command = letter + (number.split(".")[0].lstrip("+") if number else "")
+    params = {}
+    for letter, number in words[1:]:
+        try:
+            params[letter] = float(number) if number else 0.0
+        except ValueError:
+            pass
+    return command, params
+
+
+# Time to cover `distance` with a symmetric trapezoidal velocity profile: accelerate from
+# `entry` to `cruise`, hold it, then decelerate back to `entry`. Short moves that can't reach
+# `cruise` become a triangle.
+def trapezoidTime(distance, cruise, entry, accel):
+    if distance <= 0 or cruise <= 0:
+        return 0.0
+    entry = min(entry, cruise)
+    if accel <= 0:
+        return distance / cruise
+    rampDistance = (cruise * cruise - entry * entry) / (2 * accel)
+    if 2 * rampDistance <= distance:
+        return 2 * (cruise - entry) / accel + (distance - 2 * rampDistance) / cruise
+    peak = math.sqrt(accel * distance + entry * entry)
+    return 2 * (peak - entry) / accel
+
+
+# Totals for one G-code file
+class PrintEstimate:
+    def __init__(self):
+        self.total_time = 0.0  # seconds
+        self.filament_length = 0.0  # mm of filament pushed through the extruder
+        self.layer_times = []  # [z, seconds] for each layer, bottom up
+        self.layers = []  # where each layer starts and the machine state there (see GcodeEstimator.layerState)
+        self.moves = 0
+
+    def toDict(self):
+        return {
+            "total_time": round(self.total_time, 1),
+            "filament_length": round(self.filament_length, 1),
+            "layer_times": [[round(z, 3), round(t, 2)] for z, t in self.layer_times],
+            "moves": self.moves,
+            "layers": self.layers,
+        }
+
+    @classmethod
+    def fromDict(cls, data):
+        estimate = cls()
+        estimate.total_time = data["total_time"]
+        estimate.filament_length = data["filament_length"]
+        estimate.layer_times = data["layer_times"]
+        estimate.moves = data["moves"]
+        estimate.layers = data.get("layers", [])
+        return estimate
+
+
+# Walks a G-code stream once and estimates print time and filament use. Memory is bounded: only
+# the machine state and one entry per layer are kept.
+class GcodeEstimator:
+    def __init__(self):
+        self.maxFeedrate = dict(DEFAULT_MAX_FEEDRATE)
+        self.maxAccel = dict(DEFAULT_MAX_ACCEL)
+        self.jerk = dict(DEFAULT_JERK)
+        self.printAccel = DEFAULT_PRINT_ACCEL
+        self.retractAccel = DEFAULT_RETRACT_ACCEL
+        self.travelAccel = DEFAULT_TRAVEL_ACCEL
+        self.position = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+        self.feedrate = DEFAULT_FEEDRATE / 60.0  # mm/s
+        self.absolute = True  # G90 / G91
+        self.absoluteE = True  # M82 / M83
+        self.estimate = PrintEstimate()
+        self.layerZ = None
+        self.layerTime = 0.0
+        # state a print needs to resume at a layer
+        self.hotend = 0.0
+        self.bed = 0.0
+        self.fan = 0.0
+        self.lineIndex = 0
+        self.zMove = None  # (z, state) from just before the last move that changed Z
+
+    def estimateLines(self, lines):
+        for self.lineIndex, line in enumerate(lines):
+            command, params = parseLine(line)
+            if command is not None:
+                self.handle(command, params)
+        self.finishLayer()
+        return self.estimate
+
+    # Everything needed to pick a print up at the current line: where the head is, the extruder
+    # position, feedrate, modes, temperatures and fan.
+    def layerState(self):
+        return {
+            "line": self.lineIndex,
+            "x": round(self.position["X"], 3),
+            "y": round(self.position["Y"], 3),
+            "e": round(self.position["E"], 5),
+            "feedrate": round(self.feedrate * 60.0, 1),
+            "absolute": self.absolute,
+            "absolute_e": self.absoluteE,
+            "hotend": self.hotend,
+            "bed": self.bed,
+            "fan": self.fan,
+        }
+
+    def handle(self, command, params):
+        if command in ("G0", "G1"):
+            self.linearMove(params)
+        elif command in ("G2", "G3"):
+            self.arcMove(params, clockwise=command == "G2")
+        elif command == "G4":
+            self.addTime(params.get("P", 0.0) / 1000.0 + params.get("S", 0.0))
+        elif command == "G90":
+            self.absolute = True
+            self.absoluteE = True
+        elif command == "G91":
+            self.absolute = False
+            self.absoluteE = False
+        elif command == "M82":
+            self.absoluteE = True
+        elif command == "M83":
+            self.absoluteE = False
+        elif command == "G92":
+            for axis in ("X", "Y", "Z", "E"):
+                if axis in params:
+                    self.position[axis] = params[axis]
+            if not params:
+                self.position = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+        elif command == "G28":
+            for axis in ("X", "Y", "Z"):
+                self.position[axis] = 0.0
+        elif command == "M201":
+            self.maxAccel.update((axis, params[axis]) for axis in "XYZE" if axis in params)
+        elif command == "M203":
+            self.maxFeedrate.update((axis, params[axis]) for axis in "XYZE" if axis in params)
+        elif command == "M204":
+            if "S" in params:
+                self.printAccel = self.travelAccel = params["S"]
+            self.printAccel = params.get("P", self.printAccel)
+            self.retractAccel = params.get("R", self.retractAccel)
+            self.travelAccel = params.get("T", self.travelAccel)
+        elif command == "M205":
+            self.jerk.update((axis, params[axis]) for axis in "XYZE" if axis in params)
+        elif command in ("M104", "M109"):
+            self.hotend = params.get("S", self.hotend)
+        elif command in ("M140", "M190"):
+            self.bed = params.get("S", self.bed)
+        elif command == "M106":
+            self.fan = params.get("S", 255.0)
+        elif command == "M107":
+            self.fan = 0.0
+
+    def target(self, params):
+        target = dict(self.position)
+        for axis in ("X", "Y", "Z"):
+            if axis in params:
+                target[axis] = params[axis] if self.absolute else self.position[axis] + params[axis]
+        if "E" in params:
+            target["E"] = params["E"] if self.absoluteE else self.position["E"] + params["E"]
+        if "F" in params and params["F"] > 0:
+            self.feedrate = params["F"] / 60.0
+        return target
+
+    def linearMove(self, params):
+        target = self.target(params)
+        if target["Z"] != self.position["Z"]:
+            self.zMove = (target["Z"], self.layerState())  # position is still from before the move
+        delta = {axis: target[axis] - self.position[axis] for axis in ("X", "Y", "Z", "E")}
+        self.move(delta, math.sqrt(delta["X"] ** 2 + delta["Y"] ** 2 + delta["Z"] ** 2))
+        self.position = target
+
+    def arcMove(self, params, clockwise):
+        target = self.target(params)
+        x0, y0 = self.position["X"], self.position["Y"]
+        x1, y1 = target["X"], target["Y"]
+        if "R" in params:
+            radius = abs(params["R"])
+            chord = math.hypot(x1 - x0, y1 - y0)
+            if chord == 0 or radius < chord / 2:
+                angle = math.pi if chord else 0.0
+            else:
+                angle = 2 * math.asin(chord / (2 * radius))
+            if params["R"] < 0:  # negative R means the long way around
+                angle = 2 * math.pi - angle
+        else:
+            cx, cy = x0 + params.get("I", 0.0), y0 + params.get("J", 0.0)
+            radius = math.hypot(x0 - cx, y0 - cy)
+            start = math.atan2(y0 - cy, x0 - cx)
+            end = math.atan2(y1 - cy, x1 - cx)
+            angle = (start - end) if clockwise else (end - start)
+            if angle <= 1e-9:
+                angle += 2 * math.pi  # full circle when start == end
+        delta = {axis: target[axis] - self.position[axis] for axis in ("X", "Y", "Z", "E")}
+        self.move(delta, math.hypot(angle * radius, delta["Z"]))
+        self.position = target
+
+    def move(self, delta, distance):
+        extruding = delta["E"] > 0 and distance > 0
+        if extruding and self.isNewLayer(self.position["Z"] + delta["Z"]):
+            self.startLayer(self.position["Z"] + delta["Z"])
+        self.estimate.filament_length += delta["E"]
+        self.estimate.moves += 1
+        if distance == 0:  # extruder-only move (retract / prime)
+            distance = abs(delta["E"])
+            axes = ("E",)
+            accel = min(self.retractAccel, self.maxAccel["E"])
+        else:
+            axes = [axis for axis in ("X", "Y", "Z") if delta[axis] != 0]
+            accel = self.printAccel if extruding else self.travelAccel
+        if distance == 0:
+            return
+        # limit speed and acceleration so no axis exceeds its own maximum
+        speed = self.feedrate
+        jerk = float("inf")
+        for axis in axes:
+            share = abs(delta[axis]) / distance
+            if share > 0:
+                speed = min(speed, self.maxFeedrate[axis] / share)
+                accel = min(accel, self.maxAccel[axis] / share)
+                jerk = min(jerk, self.jerk[axis] / share)
+        self.addTime(trapezoidTime(distance, speed, jerk, accel))
+
+    def addTime(self, seconds):
+        self.estimate.total_time += seconds
+        self.layerTime += seconds
+
+    def isNewLayer(self, z):
+        return self.layerZ is None or abs(z - self.layerZ) >= MIN_LAYER_HEIGHT - 1e-9
+
+    def startLayer(self, z):
+        if self.layerZ is not None:  # time before the first layer (homing, priming) counts towards it
+            self.finishLayer()
+        self.layerZ = z
+        # a layer starts at the move up to its height, if there was one, otherwise at its first extrusion
+        state = self.zMove[1] if self.zMove is not None and self.zMove[0] == z else self.layerState()
+        self.estimate.layers.append({"z": round(z, 3), **state})
+
+    def finishLayer(self):
+        if self.layerZ is not None or self.layerTime > 0:
+            self.estimate.layer_times.append([self.layerZ if self.layerZ is not None else 0.0, self.layerTime])
+        self.layerTime = 0.0
+
+
+# Passes `lines` through, calling progress(fraction done) every PROGRESS_LINES lines
+def reportProgress(lines, progress):
+    total = len(lines)
+    for i, line in enumerate(lines):
+        if i % PROGRESS_LINES == 0:
+            progress(i / total)
+        yield line
+
+
+# Estimates a GcodeBuffer, caching the result next to the buffer's files so the same G-code is
+# only ever walked once. `progress`, if given, is called with the fraction of lines estimated.
+def estimateBuffer(gcode, progress=None):
+    cachePath = gcode.basePath + ESTIMATE_EXT
+    if os.path.exists(cachePath):
+        with open(cachePath) as f:
+            data = json.load(f)
+        if "layers" in data: # estimates cached before the layer index was added are redone
+            return PrintEstimate.fromDict(data)
+    estimate = GcodeEstimator().estimateLines(gcode if progress is None else reportProgress(gcode, progress))
+    # a temporary file of its own, as two workers can estimate the same file at once
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(cachePath), suffix=ESTIMATE_EXT)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(estimate.toDict(), f)
+        os.replace(tmpPath, cachePath)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+    return estimate
+
+
+# python -m Classes.GcodeEstimator ../20mm_calibration.gcode
+if __name__ == "__main__":
+    path = sys.argv[1]
+    start = time.perf_counter()
+    with open(path, "rb") as g:
+        result = GcodeEstimator().estimateLines(g)
+    elapsed = time.perf_counter() - start
+    print(f"{path}: {result.total_time / 60:.1f} min, {result.filament_length:.1f} mm filament, "
+          f"{len(result.layer_times)} layers, {result.moves} moves (estimated in {elapsed * 1000:.0f} ms)")
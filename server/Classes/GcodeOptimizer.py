@@ -0,0 +1,315 @@
+import os
+import json
+import math
+import logging
+import tempfile
+from Classes.GcodeBuffer import GcodeBufferWriter, GcodeBuffer
+from Classes.GcodeEstimator import parseLine, reportProgress
+
+try:
+    import numpy as np  # optional: only needed for jobs uploaded with optimize on
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# how far (mm) an arc or merged move may stray from the path of the moves it replaces
+ARC_TOLERANCE = float(os.environ.get("ARC_TOLERANCE", "0.025"))
+MIN_ARC_SEGMENTS = 3  # moves an arc has to replace to be worth it
+MAX_ARC_RADIUS = 1000.0  # mm. Flatter curves are left to the collinear merge.
+# merged moves must extrude within this fraction of the same filament per mm
+FLOW_TOLERANCE = 0.05
+# the optimized buffer is cached as "<source key>-opt-<tolerance>", with what was removed next to it
+OPTIMIZED_SUFFIX = "-opt"
+REPORT_EXT = ".opt.json"
+
+
+def isAvailable():
+    return np is not None
+
+
+# {letter: value text} for a plain "G1 X.. Y.. E.. F.." move in the plane, or None for anything
+# else (other commands, Z moves, anything the optimizer doesn't know how to rewrite)
+def parseMove(line):
+    words = line.split()
+    if len(words) < 2 or words[0] != b"G1":
+        return None
+    params = {}
+    for word in words[1:]:
+        letter = word[:1]
+        if letter not in (b"X", b"Y", b"E", b"F"):
+            return None
+        params[letter] = word[1:]
+    if b"X" not in params and b"Y" not in params:
+        return None
+    return params
+
+
+def formatNumber(value, digits=3):
+    text = b"%.*f" % (digits, value)
+    return text.rstrip(b"0").rstrip(b".") if b"." in text else text
+
+
+# Replaces runs of short G1 moves with fewer lines: moves along a straight line become one G1,
+# moves along a circle (within `tolerance`) become a G2/G3 arc. Only plain moves in the XY plane,
+# in absolute XY mode, are touched; everything else is copied as it is and ends the current run.
+# A run is fitted as a whole with array operations over its points: a move is only merged if
+# every point it replaces is within the tolerance of the new path and the extrusion per mm stays
+# the same.
+class GcodeOptimizer:
+    def __init__(self, tolerance=ARC_TOLERANCE):
+        self.tolerance = tolerance
+        self.absolute = True  # G90 / G91
+        self.absoluteE = True  # M82 / M83
+        self.x = None  # unknown until an absolute move sets it
+        self.y = None
+        self.e = 0.0
+        self.feedrate = None
+        self.run = []  # the current run: (line, x, y, extruded, params) per move
+        self.runStart = None  # (x, y) the run starts from
+        self.runExtruding = False
+        self.linesIn = 0
+        self.linesOut = 0
+        self.arcs = 0
+        self.merged = 0  # moves folded into a longer G1
+
+    # Optimizes `lines`, passing each output line (without its newline) to `write`
+    def optimizeLines(self, lines, write):
+        self.write = write
+        for line in lines:
+            self.linesIn += 1
+            self.handle(line)
+        self.flush()
+        return self.getReport()
+
+    def getReport(self):
+        return {
+            "lines_before": self.linesIn,
+            "lines_after": self.linesOut,
+            "lines_removed": self.linesIn - self.linesOut,
+            "arcs": self.arcs,
+            "merged_moves": self.merged,
+        }
+
+    def emit(self, line):
+        self.write(line)
+        self.linesOut += 1
+
+    def handle(self, line):
+        params = parseMove(line) if self.absolute and self.x is not None and self.y is not None else None
+        if params is not None:
+            try:
+                x = float(params[b"X"]) if b"X" in params else self.x
+                y = float(params[b"Y"]) if b"Y" in params else self.y
+                e = float(params[b"E"]) if b"E" in params else None
+                feedrate = float(params[b"F"]) if b"F" in params else self.feedrate
+            except ValueError:
+                params = None
+        if params is not None:
+            extruded = 0.0 if e is None else (e - self.e if self.absoluteE else e)
+            # retractions and moves that don't go anywhere in the plane stay as they are
+            if (x, y) != (self.x, self.y) and (e is None or extruded > 0):
+                if self.run and (feedrate != self.feedrate or (extruded > 0) != self.runExtruding):
+                    self.flush()
+                if not self.run:
+                    self.runStart = (self.x, self.y)
+                    self.runExtruding = extruded > 0
+                self.run.append((line, x, y, extruded, params))
+                self.x, self.y, self.feedrate = x, y, feedrate
+                if e is not None:
+                    self.e = e if self.absoluteE else self.e + e
+                return
+        self.flush()
+        self.emit(line)
+        self.track(line)
+
+    # Follows the machine state through a line that isn't part of a run
+    def track(self, line):
+        command, params = parseLine(line)
+        if command in ("G0", "G1", "G2", "G3"):
+            if self.absolute:
+                self.x = params.get("X", self.x)
+                self.y = params.get("Y", self.y)
+            else:
+                self.x = self.x + params.get("X", 0.0) if self.x is not None else None
+                self.y = self.y + params.get("Y", 0.0) if self.y is not None else None
+            if "E" in params:
+                self.e = params["E"] if self.absoluteE else self.e + params["E"]
+            if params.get("F", 0) > 0:
+                self.feedrate = params["F"]
+        elif command == "G90":
+            self.absolute = self.absoluteE = True
+        elif command == "G91":
+            self.absolute = self.absoluteE = False
+        elif command == "M82":
+            self.absoluteE = True
+        elif command == "M83":
+            self.absoluteE = False
+        elif command == "G92":
+            if not params:
+                self.x, self.y, self.e = 0.0, 0.0, 0.0
+            self.x = params.get("X", self.x)
+            self.y = params.get("Y", self.y)
+            self.e = params.get("E", self.e)
+        elif command == "G28":
+            self.x = self.y = None  # wherever the endstops are
+
+    # Fits the current run and writes it out
+    def flush(self):
+        run, self.run = self.run, []
+        if len(run) < 2:
+            for move in run:
+                self.emit(move[0])
+            return
+        self.px = np.array([self.runStart[0]] + [move[1] for move in run])
+        self.py = np.array([self.runStart[1]] + [move[2] for move in run])
+        self.extruded = np.array([move[3] for move in run])
+        self.lengths = np.hypot(np.diff(self.px), np.diff(self.py))
+        for start, end, arc in self.fit(len(run)):
+            if end - start == 1:
+                self.emit(run[start][0])
+            else:
+                self.emit(self.encode(run, start, end, arc))
+                if arc:
+                    self.arcs += 1
+                else:
+                    self.merged += end - start - 1
+
+    # Splits the run's `n` moves into (start, end, arc) groups, greedily taking whichever of the
+    # longest straight line or the longest arc from each point covers more moves
+    def fit(self, n):
+        start = 0
+        while start < n:
+            lineEnd = self.extend(start, start + 2, n, self.fitsLine) or start + 1
+            arcEnd = self.extend(start, start + MIN_ARC_SEGMENTS, n, self.fitsArc)
+            if arcEnd is not None and arcEnd > lineEnd:
+                yield start, arcEnd, True
+                start = arcEnd
+            else:
+                yield start, lineEnd, False
+                start = lineEnd
+
+    # The furthest end point from `first` on for which fits(start, end) holds, or None if it doesn't
+    # even hold for `first`. Steps out in doubling strides, then bisects back to the last fit.
+    def extend(self, start, first, n, fits):
+        if first > n or not fits(start, first):
+            return None
+        good, step = first, 1
+        while good + step <= n and fits(start, good + step):
+            good += step
+            step *= 2
+        bad = min(good + step, n + 1)
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            if fits(start, middle):
+                good = middle
+            else:
+                bad = middle
+        return good
+
+    # Moves start..end (as points start..end) lie along one straight line, all heading forwards
+    def fitsLine(self, start, end):
+        px, py = self.px[start:end + 1], self.py[start:end + 1]
+        chordX, chordY = px[-1] - px[0], py[-1] - py[0]
+        chord = math.hypot(chordX, chordY)
+        if chord == 0:
+            return False
+        offsets = np.abs(chordX * (py[1:-1] - py[0]) - chordY * (px[1:-1] - px[0])) / chord
+        if offsets.max() > self.tolerance:
+            return False
+        if (np.diff(px) * chordX + np.diff(py) * chordY).min() <= 0:
+            return False
+        return self.fitsFlow(start, end)
+
+    # Centre of the circle through the first, middle and last points of start..end, or None if
+    # they are in a line
+    def circle(self, start, end):
+        middle = (start + end) // 2
+        ax, ay = self.px[start], self.py[start]
+        bx, by = self.px[middle] - ax, self.py[middle] - ay
+        cx, cy = self.px[end] - ax, self.py[end] - ay
+        d = 2 * (bx * cy - by * cx)
+        if abs(d) < 1e-12:
+            return None
+        b2, c2 = bx * bx + by * by, cx * cx + cy * cy
+        return ax + (cy * b2 - by * c2) / d, ay + (bx * c2 - cx * b2) / d
+
+    # Moves start..end follow one circle: every point is on it, every move turns the same way
+    # around it (less than a full turn in all) and no move's chord strays from the arc
+    def fitsArc(self, start, end):
+        centre = self.circle(start, end)
+        if centre is None:
+            return False
+        rx, ry = self.px[start:end + 1] - centre[0], self.py[start:end + 1] - centre[1]
+        radius = math.hypot(rx[0], ry[0])
+        if radius > MAX_ARC_RADIUS or np.abs(np.hypot(rx, ry) - radius).max() > self.tolerance:
+            return False
+        turns = np.arctan2(rx[:-1] * ry[1:] - ry[:-1] * rx[1:], rx[:-1] * rx[1:] + ry[:-1] * ry[1:])
+        if turns[0] < 0:
+            turns = -turns
+        if turns.min() <= 0 or turns.sum() >= 2 * math.pi - 1e-6:
+            return False
+        halfChords = self.lengths[start:end] / 2
+        sagitta = radius - np.sqrt(np.maximum(radius * radius - halfChords * halfChords, 0.0))
+        if sagitta.max() > self.tolerance:
+            return False
+        return self.fitsFlow(start, end)
+
+    def fitsFlow(self, start, end):
+        if not self.runExtruding:
+            return True
+        extruded, lengths = self.extruded[start:end], self.lengths[start:end]
+        flow = extruded.sum() / lengths.sum()
+        return np.abs(extruded / lengths - flow).max() <= FLOW_TOLERANCE * flow
+
+    # The line replacing moves start..end. The end point and absolute E are copied from the
+    # last move replaced, so they are exactly what the slicer wrote.
+    def encode(self, run, start, end, arc):
+        last = run[end - 1][4]
+        words = [b"G1"]
+        if arc:
+            centre = self.circle(start, end)
+            turn = (self.px[start + 1] - self.px[start]) * (centre[1] - self.py[start]) - \
+                   (self.py[start + 1] - self.py[start]) * (centre[0] - self.px[start])
+            words = [b"G3" if turn > 0 else b"G2"]  # centre on the left: counterclockwise
+        words.append(b"X" + last.get(b"X", formatNumber(self.px[end])))
+        words.append(b"Y" + last.get(b"Y", formatNumber(self.py[end])))
+        if arc:
+            words.append(b"I" + formatNumber(centre[0] - self.px[start]))
+            words.append(b"J" + formatNumber(centre[1] - self.py[start]))
+        if self.runExtruding:
+            words.append(b"E" + (last[b"E"] if self.absoluteE else formatNumber(self.extruded[start:end].sum(), 5)))
+        if start == 0 and b"F" in run[0][4]:
+            words.append(b"F" + run[0][4][b"F"])
+        return b" ".join(words)
+
+
+# The optimized version of a GcodeBuffer and a report of what was removed ({"lines_before",
+# "lines_after", "lines_removed", "arcs", "merged_moves"}). The result is cached next to the
+# source buffer, so each file is only optimized once for each tolerance. Without numpy the buffer
+# is returned as it is, with nothing removed.
+def optimizeBuffer(gcode, tolerance=ARC_TOLERANCE, progress=None):
+    basePath = f"{gcode.basePath}{OPTIMIZED_SUFFIX}-{tolerance:g}"
+    if GcodeBuffer.exists(basePath) and os.path.exists(basePath + REPORT_EXT):
+        with open(basePath + REPORT_EXT) as f:
+            return GcodeBuffer(basePath), json.load(f)
+    if np is None:
+        logger.warning("G-code optimization skipped, numpy is not installed", extra={"file": gcode.getKey()})
+        return gcode, {"lines_before": len(gcode), "lines_after": len(gcode), "lines_removed": 0, "arcs": 0,
+                       "merged_moves": 0, "skipped": "numpy is not installed"}
+    writer = GcodeBufferWriter(os.path.dirname(basePath))
+    reportTmp = None
+    try:
+        lines = gcode if progress is None else reportProgress(gcode, progress)
+        report = GcodeOptimizer(tolerance).optimizeLines(lines, writer.writeLine)
+        # the report goes in first: a cached buffer always has its report next to it. Two workers
+        # can optimize the same file at once, so each writes its own temporary file.
+        fd, reportTmp = tempfile.mkstemp(dir=os.path.dirname(basePath), suffix=REPORT_EXT)
+        with os.fdopen(fd, "w") as f:
+            json.dump(report, f)
+        os.replace(reportTmp, basePath + REPORT_EXT)
+        return writer.finish(os.path.basename(basePath)), report
+    finally:
+        writer.abort()
+        if reportTmp is not None and os.path.exists(reportTmp):
+            os.remove(reportTmp)
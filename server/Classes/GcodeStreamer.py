@@ -0,0 +1,421 @@
+import re
+import time
+import logging
+import threading
+from collections import deque
+from Classes.Metrics import metrics
+from Classes.MeatPack import ENABLE as MEATPACK_ENABLE, DISABLE as MEATPACK_DISABLE, QUERY as MEATPACK_QUERY, \
+    REPORT_PREFIX as MEATPACK_REPORT, packLine
+
+# Marlin defaults: BUFSIZE=4 commands in the serial command queue and a 128 byte RX ring buffer.
+# Keeping one byte free in the RX buffer avoids overrunning it when a line exactly fills it.
+DEFAULT_MAX_COMMANDS = 4
+DEFAULT_MAX_BYTES = 127
+# numbered lines kept after sending, for resend requests. Only lines still in the firmware's
+# buffers can be asked for again, so this only has to cover the send window.
+RESEND_HISTORY = 64
+# seconds without an ok or a keepalive before the oldest ok is taken as lost and its slot freed
+ACK_TIMEOUT = 10.0
+# seconds without an ok or a keepalive before lines that were resent are taken as thrown away and
+# sent again. Longer than Marlin's 2s busy keepalive interval.
+RESEND_TIMEOUT = 3.0
+
+logger = logging.getLogger(__name__)
+
+LINES_SENT = metrics.counter("filamentforge_lines_sent_total", "G-code lines written to the printer.", ("printer",))
+BYTES_SENT = metrics.counter("filamentforge_bytes_sent_total", "Bytes written to the printer.", ("printer",))
+ACK_LATENCY = metrics.histogram("filamentforge_ack_latency_seconds",
+                                "Time from writing a command to its ok.", ("printer",))
+READ_BLOCKED = metrics.counter("filamentforge_read_blocked_seconds_total",
+                               "Time spent waiting on the printer for a response line.", ("printer",))
+FIRMWARE_ERRORS = metrics.counter("filamentforge_firmware_errors_total", "Error lines from the firmware.", ("printer",))
+RESENDS = metrics.counter("filamentforge_resends_total", "Lines sent again at the firmware's request.", ("printer",))
+
+
+# Encode a G-code line to the bytes that go over the wire (one command, newline terminated).
+def encodeLine(line):
+    if isinstance(line, str):
+        line = line.encode("utf-8")
+    if not line.endswith(b"\n"):
+        line += b"\n"
+    return line
+
+
+# Marlin acknowledges every processed command with a line starting with "ok".
+def isAck(response):
+    return response.startswith("ok")
+
+
+RESEND = re.compile(r"(?:Resend:|rs)\s*N?(\d+)")
+# commands that wait for a heater. Firmware without host keepalive reports temperatures while
+# they run, which counts as a sign of life.
+HEAT_WAIT = re.compile(rb"(?:N\d+ )?M(?:109|190|191|116)\b")
+
+
+# The line number in a "Resend: <n>" (Marlin) or "rs <n>" (Repetier) request, or None
+def parseResend(response):
+    match = RESEND.match(response)
+    return int(match.group(1)) if match else None
+
+
+# "busy: processing" keepalives while a long command (homing, a full planner) runs
+def isBusy(response):
+    return response.startswith(("busy:", "echo:busy:"))
+
+
+# Tracks the commands written to the printer that have not been acknowledged yet.
+# A command may be sent as long as the firmware's command queue and RX buffer both have room.
+class SendWindow:
+    def __init__(self, maxCommands=DEFAULT_MAX_COMMANDS, maxBytes=DEFAULT_MAX_BYTES):
+        self.maxCommands = maxCommands
+        self.maxBytes = maxBytes
+        self.inFlight = deque()  # (size, sentAt, data, line number) for each unacknowledged command, oldest first
+        self.bytesInFlight = 0
+
+    def canSend(self, size):
+        # always allow one command in flight, even if it's longer than the RX buffer
+        if not self.inFlight:
+            return True
+        return len(self.inFlight) < self.maxCommands and self.bytesInFlight + size <= self.maxBytes
+
+    def sent(self, size, sentAt, data=None, number=None):
+        self.inFlight.append((size, sentAt, data, number))
+        self.bytesInFlight += size
+
+    # Releases the oldest slot. Returns the time the acknowledged command was sent, or None for
+    # a stray "ok" that doesn't match anything we sent.
+    def acknowledge(self):
+        if not self.inFlight:
+            return None
+        size, sentAt, _, _ = self.inFlight.popleft()
+        self.bytesInFlight -= size
+        return sentAt
+
+    # Releases the slots of numbered line `number` and of the numbered lines sent after it, which
+    # the firmware rejected or threw away without a reply. Unnumbered commands (queries) aren't
+    # checked against the line number, so they still get their ok unless they were thrown away.
+    def discardFrom(self, number):
+        kept = deque()
+        for entry in self.inFlight:
+            if entry[3] is not None and entry[3] >= number:
+                self.bytesInFlight -= entry[0]
+            else:
+                kept.append(entry)
+        self.inFlight = kept
+
+    def isInFlight(self, number):
+        return any(entry[3] == number for entry in self.inFlight)
+
+    # Releases every slot, for when the firmware says it has nothing left to do
+    def clear(self):
+        self.inFlight.clear()
+        self.bytesInFlight = 0
+
+    def isHeating(self):
+        return any(data is not None and HEAT_WAIT.match(data) for _, _, data, _ in self.inFlight)
+
+    def isEmpty(self):
+        return not self.inFlight
+
+    def getSize(self):
+        return len(self.inFlight)
+
+
+# Throughput numbers for one streaming run.
+class StreamStats:
+    def __init__(self):
+        self.lines = 0
+        self.bytes = 0
+        self.errors = 0
+        self.resends = 0  # lines sent again because the firmware asked for them
+        self.lostAcks = 0  # oks given up on after ACK_TIMEOUT
+        self.startTime = None
+        self.endTime = None
+
+    def getElapsed(self):
+        if self.startTime is None:
+            return 0.0
+        end = self.endTime if self.endTime is not None else time.monotonic()
+        return end - self.startTime
+
+    def getLinesPerSecond(self):
+        elapsed = self.getElapsed()
+        return self.lines / elapsed if elapsed > 0 else 0.0
+
+    def getBytesPerSecond(self):
+        elapsed = self.getElapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def toDict(self):
+        return {
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "errors": self.errors,
+            "resends": self.resends,
+            "lost_acks": self.lostAcks,
+            "elapsed": round(self.getElapsed(), 3),
+            "lines_per_second": round(self.getLinesPerSecond(), 1),
+            "bytes_per_second": round(self.getBytesPerSecond(), 1),
+        }
+
+
+# A printer's series of the streaming metrics, looked up once so the send loop only adds to numbers
+class StreamMetrics:
+    def __init__(self, printer):
+        self.lines = LINES_SENT.labels(printer)
+        self.bytes = BYTES_SENT.labels(printer)
+        self.ackLatency = ACK_LATENCY.labels(printer)
+        self.readBlocked = READ_BLOCKED.labels(printer)
+        self.errors = FIRMWARE_ERRORS.labels(printer)
+        self.resends = RESENDS.labels(printer)
+
+
+class StreamCancelled(Exception):
+    pass
+
+
+# Streams G-code to a serial port keeping up to `maxCommands` commands (and `maxBytes` bytes)
+# in the firmware's buffers at once. Slots are released as "ok" lines come back, so the printer's
+# planner never runs dry waiting on a round trip and there is no fixed sleep per line.
+# Lines can be sent numbered and checksummed (see GcodeBuffer.iterNumbered). The last of those are
+# kept, so when the firmware rejects one and asks for it again only the lines from there on are
+# resent. Marlin empties its RX buffer before asking, so the lines sent after the bad one never get
+# an ok: their slots are freed along with it. Lines that reach the firmware after that are rejected
+# with the same request, which is ignored while the line is waiting to go out again or waiting for
+# its reply. Each rejection empties the RX buffer again, which can take the resent line with it, so
+# if nothing comes back for RESEND_TIMEOUT the lines are resent once more. "busy:" keepalives hold
+# off the timeouts, and "wait" (the firmware is idle) frees any slots whose oks were lost.
+# With a `telemetry` (PrinterTelemetry) attached, every response is also parsed for temperatures
+# and position, and M105/M114 queries are slipped into the stream when samples go stale.
+# With `metrics` (StreamMetrics) the printer's lines, ack round trips and read waits are counted,
+# and with `exchanges` (ExchangeRing) the last lines each way are kept. `printer` names the printer in logs.
+# A stream can be MeatPack encoded (see Classes.MeatPack) for firmware that supports it: the lines
+# come already packed and anything else sent meanwhile, like telemetry queries, is packed on the way.
+class GcodeStreamer:
+    def __init__(self, ser, maxCommands=DEFAULT_MAX_COMMANDS, maxBytes=DEFAULT_MAX_BYTES, telemetry=None, metrics=None,
+                 exchanges=None, printer=None):
+        self.ser = ser
+        self.printer = printer
+        self.telemetry = telemetry
+        self.metrics = metrics
+        self.exchanges = exchanges
+        self.window = SendWindow(maxCommands, maxBytes)
+        self.stats = StreamStats()
+        self.cancelEvent = threading.Event()
+        self.lastResponse = None
+        self.outbox = deque()  # (line number or None, data, plain text or None) waiting for room in the window
+        self.history = deque(maxlen=RESEND_HISTORY)  # (line number, data, plain text) of numbered lines sent
+        self.resendFrom = None  # line number of the last resend request acted on
+        self.skipAck = False  # the next ok is for a rejected line whose slot is already free
+        self.progress = 0  # oks and keepalives received
+        self.checkedProgress = (0, time.monotonic())  # progress at the last quiet read, and when
+        self.packer = None  # packs unnumbered lines while the firmware expects MeatPack
+        self.packingReport = None  # the firmware's last "[MP]" line
+
+    # Streams every line in `lines` and waits for the last one to be acknowledged. Lines are str
+    # or bytes, or (line number, wire bytes) for numbered lines, or (line number, wire bytes,
+    # plain line) for packed ones. With packed=True, MeatPack is switched on for the stream.
+    def stream(self, lines, packed=False):
+        self.stats = StreamStats()
+        self.stats.startTime = time.monotonic()
+        try:
+            if packed:
+                self.startPacking()
+            for line in lines:
+                if isinstance(line, tuple):
+                    self.write(line[1], line[0], line[2] if len(line) > 2 else None)
+                else:
+                    self.write(encodeLine(line))
+                self.pollTelemetry()
+            self.drain()
+        finally:
+            if packed:
+                self.stopPacking()
+            self.stats.endTime = time.monotonic()
+        return self.stats
+
+    # Sends a single command and waits for its acknowledgement (ping-pong).
+    def send(self, line):
+        self.write(encodeLine(line))
+        self.drain()
+        return self.lastResponse
+
+    # `text` is the plain line when `data` is packed
+    def write(self, data, number=None, text=None):
+        if self.packer is not None and text is None:
+            data, text = self.packer(data), data
+        self.outbox.append((number, data, text))
+        self.flush()
+
+    # Sends queued lines as the window makes room. Lines to resend are queued ahead of the rest.
+    def flush(self):
+        outbox = self.outbox
+        while outbox:
+            number, data, text = outbox[0]
+            if not self.window.canSend(len(data)):
+                self.readResponse()
+                continue
+            outbox.popleft()
+            self.ser.write(data)
+            self.recordSent(data, number, text)
+
+    # Switches the firmware to MeatPack. Everything written from here on is packed.
+    def startPacking(self):
+        self.flush()
+        self.ser.write(MEATPACK_ENABLE)
+        self.packer = packLine
+
+    # Back to plain text. Packed lines can't go out after this, so any not yet sent (a stream that
+    # failed part way) are dropped, along with the resend history.
+    def stopPacking(self):
+        self.packer = None
+        self.outbox.clear()
+        self.history.clear()
+        self.ser.write(MEATPACK_DISABLE)
+
+    # Asks the firmware whether it speaks MeatPack. Returns its "[MP]" state line, or None if it
+    # doesn't. Firmware without MeatPack sees the query as junk in front of M115, which it answers
+    # with an error and an ok like any unknown command.
+    def queryPacking(self):
+        self.packingReport = None
+        self.flush()
+        self.ser.write(MEATPACK_QUERY)
+        self.send("M115")
+        return self.packingReport
+
+    # Queries ride in the send window like any other command, so they never stall the stream.
+    def pollTelemetry(self):
+        if self.telemetry is not None:
+            for query in self.telemetry.getQueries(printing=True):
+                self.write(encodeLine(query))
+
+    # Waits until every command in flight has been acknowledged.
+    def drain(self):
+        self.flush()
+        while not self.window.isEmpty() or self.outbox:
+            self.readResponse()
+            self.flush()
+
+    # Reads one response line. A read timeout just returns an empty string: long moves and
+    # heating (M109/M190) can legitimately keep the printer quiet for a while.
+    def readResponse(self):
+        if self.cancelEvent.is_set():
+            raise StreamCancelled("Streaming cancelled.")
+        if self.metrics is None:
+            return self.handleResponse(self.ser.readline().decode("utf-8", errors="replace").strip())
+        started = time.monotonic()
+        response = self.ser.readline()
+        now = time.monotonic()
+        self.metrics.readBlocked.value += now - started
+        return self.handleResponse(response.decode("utf-8", errors="replace").strip(), now)
+
+    # Bookkeeping for a command that has just been written. Shared with the asyncio streamer.
+    def recordSent(self, data, number=None, text=None):
+        now = time.monotonic()
+        self.window.sent(len(data), now, text or data, number)
+        if number is not None:
+            self.history.append((number, data, text))
+        if self.exchanges is not None:
+            self.exchanges.sent(text or data, now)
+        self.stats.lines += 1
+        self.stats.bytes += len(data)
+        if self.metrics is not None:
+            self.metrics.lines.value += 1
+            self.metrics.bytes.value += len(data)
+
+    # Interprets one response line from the firmware, read at `receivedAt` (monotonic, only needed
+    # for metrics). Shared with the asyncio streamer.
+    def handleResponse(self, response, receivedAt=None):
+        if not response:
+            self.checkAckTimeout()
+            return response
+        self.lastResponse = response
+        if self.exchanges is not None:
+            self.exchanges.received(response, receivedAt or time.monotonic())
+        if self.telemetry is not None:
+            self.telemetry.handle(response)
+        if isAck(response):
+            self.progress += 1
+            if self.skipAck:
+                self.skipAck = False
+                return response
+            sentAt = self.window.acknowledge()
+            if sentAt is not None and receivedAt is not None:
+                self.metrics.ackLatency.observe(receivedAt - sentAt)
+        elif response.startswith(("Resend", "rs")):
+            number = parseResend(response)
+            if number is not None:
+                # the request is followed by an ok for the line that was rejected
+                self.skipAck = self.resend(number)
+        elif isBusy(response):
+            self.progress += 1
+        elif response == "wait":
+            # the firmware's queue is empty, so anything still in flight had its ok lost
+            self.retryResend()
+            self.window.clear()
+        elif response.startswith("Error"):
+            self.stats.errors += 1
+            if self.metrics is not None:
+                self.metrics.errors.inc()
+            logger.warning("Firmware error", extra={"printer": self.printer, "response": response})
+        elif "T:" in response and self.window.isHeating():
+            self.progress += 1
+        elif response.startswith(MEATPACK_REPORT):
+            self.packingReport = response
+        return response
+
+    # Queues the lines from `number` on to be sent again and frees their slots. Returns whether the
+    # rejected line's slot is free, so the ok that follows the request isn't counted again.
+    def resend(self, number):
+        if any(entry[0] == number for entry in self.outbox):
+            return True  # already going out again
+        if number == self.resendFrom and self.window.isInFlight(number):
+            return True  # from a line sent before the resend, which was freed with the rest (see retryResend)
+        lines = []
+        while self.history and self.history[-1][0] >= number:
+            lines.append(self.history.pop())
+        if not lines:
+            return False  # asking for a line that hasn't been sent yet, e.g. after M110
+        lines.reverse()
+        if lines[0][0] != number:
+            raise Exception(f"Printer asked for line {number}, which is too old to resend.")
+        self.window.discardFrom(number)
+        self.outbox.extendleft(reversed(lines))
+        self.resendFrom = number
+        self.stats.resends += len(lines)
+        if self.metrics is not None:
+            self.metrics.resends.inc(len(lines))
+        logger.info("Resending", extra={"printer": self.printer, "line": number, "lines": len(lines)})
+        return True
+
+    # Sends the lines of the last resend again if the first of them is still waiting for its ok,
+    # i.e. the firmware threw it away. Returns whether it did.
+    def retryResend(self):
+        number = self.resendFrom
+        if number is None or not self.window.isInFlight(number):
+            return False
+        self.resendFrom = None
+        return self.resend(number)
+
+    # Called on every quiet read. If nothing has come back for ACK_TIMEOUT while commands are in
+    # flight, the oldest ok is taken as lost so the stream can't hang on it. With numbered lines a
+    # command that really was lost is caught by the firmware's next resend request, and resent
+    # lines that were lost are sent again after RESEND_TIMEOUT.
+    def checkAckTimeout(self):
+        now = time.monotonic()
+        progress, since = self.checkedProgress
+        if progress != self.progress or self.window.isEmpty():
+            self.checkedProgress = (self.progress, now)
+        elif now - since >= RESEND_TIMEOUT and self.retryResend():
+            self.checkedProgress = (self.progress, now)
+        elif now - since >= ACK_TIMEOUT:
+            self.window.acknowledge()
+            self.stats.lostAcks += 1
+            self.checkedProgress = (self.progress, now)
+            logger.warning("No ok from printer, freeing its slot", extra={"printer": self.printer, "timeout": ACK_TIMEOUT})
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def getStats(self):
+        return self.stats
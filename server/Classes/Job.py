@@ -1,6 +1,9 @@
 import serial
 from serial.tools import list_ports
 import time
+import pathlib
+from Classes.GcodeBuffer import GcodeBuffer
+from Classes.GcodeEstimator import estimateBuffer
 
 # Class for each printer job.
 class Job:
@@ -8,30 +11,18 @@ class Job:
     def __init__(self, file, name, quantity, priority, status):
         self.file = file  # The G-code file
         self.name = name  # Name of the job
-        self.gcode_lines = self.loadGcode(file)  # List containing the G-code lines
+        self.gcode_lines = self.loadGcode(file)  # Preprocessed G-code lines (GcodeBuffer)
+        self.estimate = estimateBuffer(self.gcode_lines)  # Estimated print time, filament and per-layer times
         self.quantity = quantity  # Quantity of the job
         self.priority = priority  # Priority of the job
         self.status = status  # Status of the job. (completed, error, cancelled, printing, in-queue, or failed.)
         self.version = 1 
 
-    # Method to load G-code from a given file.
+    # Method to load G-code from a given file. The file is stripped of comments and blank lines once
+    # and cached as a compact, memory-mapped buffer that behaves like a list of encoded lines.
+    # Loading the same file again (another job, or quantity > 1) reuses the cached buffer.
     def loadGcode(self, file):
-        lines = []
-        with open(file, "r") as g:
-            for line in g:
-                line = line.strip()  # Remove whitespace
-                if len(line) == 0:  # Do not send blank lines
-                    continue
-                if ";" in line:  # Remove inline comments
-                    line = line.split(";")[
-                        0
-                    ].strip()  # Remove comments starting with ";"
-                if len(line) == 0 or line.startswith(
-                    ";"
-                ):  # Don't send empty lines and comments
-                    continue
-                lines.append(line)  # Add the G-code line to the list
-        return lines  # Return the list of G-code lines
+        return GcodeBuffer.fromSource(pathlib.Path(file) if isinstance(file, str) else file)
 
     # Method to find file type.
     def fileType(self):
@@ -53,6 +44,12 @@ class Job:
     #         pass
     #         # send to compatible printer
             
+    def getEstimatedTime(self):
+        return self.estimate.total_time
+
+    def getFilamentLength(self):
+        return self.estimate.filament_length
+
     def getFile(self): 
         return self.file
     
@@ -0,0 +1,263 @@
+import os
+import sys
+import mmap
+import tempfile
+from array import array
+from Classes.GcodeBuffer import xorBytes, OFFSET_TYPE
+
+# MeatPack (Marlin's MEATPACK_ON_SERIAL_PORT_*): the 15 most common G-code characters are sent as
+# 4 bits each, two to a byte. Anything else follows its byte in full. Packing is switched on and
+# off with commands that start with two 0xFF bytes, which can't occur in packed data.
+MEATPACK = os.environ.get("MEATPACK", "1") != "0"  # MEATPACK=0 never asks printers for it
+SIGNAL = 0xFF
+ENABLE_PACKING = 0xFB
+DISABLE_PACKING = 0xFA
+RESET_ALL = 0xF9
+QUERY_CONFIG = 0xF8
+ENABLE_NO_SPACES = 0xF7
+DISABLE_NO_SPACES = 0xF6
+# firmware with MeatPack answers every command with its state, e.g. "[MP] PV01 ON NSP"
+REPORT_PREFIX = "[MP]"
+
+# Spaces are dropped from moves (Marlin parses "G1X10Y10" fine), which frees a code for "E"
+CODES = b"0123456789.E\nGX"
+LITERAL = 0xF
+MOVES = (b"G0 ", b"G1 ", b"G2 ", b"G3 ")
+
+# packed lines for a GcodeBuffer are cached next to its files
+PACKED_EXT = ".mpk"
+PACKED_INDEX_EXT = ".mpi"
+
+
+def command(code):
+    return bytes((SIGNAL, SIGNAL, code))
+
+
+ENABLE = command(ENABLE_PACKING) + command(ENABLE_NO_SPACES)
+DISABLE = command(DISABLE_PACKING) + command(DISABLE_NO_SPACES)
+# a non-MeatPack firmware sees these as garbage at the start of the next line
+QUERY = command(DISABLE_PACKING) + command(QUERY_CONFIG)
+
+__pairs = None
+
+
+# Packed bytes for every pair of characters, indexed by the pair read as a native 16-bit integer
+def getPairTable():
+    global __pairs
+    if __pairs is None:
+        codes = [LITERAL] * 256
+        for code, char in enumerate(CODES):
+            codes[char] = code
+        pairs = [b""] * 65536
+        for first in range(256):
+            for second in range(256):
+                low, high = codes[first], codes[second]
+                packed = bytes(((high << 4) | low,))
+                if low == LITERAL:
+                    packed += bytes((first,))
+                if high == LITERAL:
+                    packed += bytes((second,))
+                pairs[int.from_bytes(bytes((first, second)), sys.byteorder)] = packed
+        __pairs = pairs
+    return __pairs
+
+
+# Packs a newline-terminated line. An odd length is padded with a second newline, which the
+# firmware drops (nothing after a newline in the same byte is used).
+def pack(data):
+    if len(data) % 2:
+        data += b"\n"
+    pairs = getPairTable()
+    return b"".join([pairs[pair] for pair in memoryview(data).cast("H")])
+
+
+# Line `line` (no newline) as "N<number> <line>*<checksum>" on the wire, packed. Moves lose their
+# spaces first, and the checksum covers the line as the firmware will unpack it. `checksum` is the
+# line's checksum sent unpacked, if it's already known (GcodeBuffer.getChecksums).
+def packNumbered(number, line, checksum=None):
+    if line.startswith(MOVES):
+        body = b"N%d%s" % (number, line.replace(b" ", b""))
+        # every space dropped (including the one after the number) flips the space bit
+        if checksum is not None and line.count(b" ") % 2 == 0:
+            checksum ^= 0x20
+    else:
+        body = b"N%d %s" % (number, line)
+    if checksum is None:
+        checksum = xorBytes(body)
+    return pack(b"%s*%d\n" % (body, checksum))
+
+
+# An unnumbered command (e.g. a telemetry query) sent while packing is on
+def packLine(data):
+    return pack(data if data.endswith(b"\n") else data + b"\n")
+
+
+# Packed, numbered wire lines for every line of a GcodeBuffer, stored like the buffer itself: one
+# blob and an index of offsets, memory-mapped. They're built once, when the job is preprocessed,
+# so streaming a packed job copies bytes just like streaming a plain one.
+class PackedGcode:
+    def __init__(self, gcode):
+        self.gcode = gcode
+        self.__blob = mapFile(gcode.basePath + PACKED_EXT)
+        self.__index = mapFile(gcode.basePath + PACKED_INDEX_EXT)
+        self.__offsets = memoryview(self.__index).cast(OFFSET_TYPE) if self.__index else array(OFFSET_TYPE, [0])
+
+    @staticmethod
+    def exists(gcode):
+        return os.path.exists(gcode.basePath + PACKED_EXT) and os.path.exists(gcode.basePath + PACKED_INDEX_EXT)
+
+    # The packed lines for `gcode`, packing them first if they aren't cached yet. `progress`, if
+    # given, is called with the fraction of lines packed.
+    @classmethod
+    def fromBuffer(cls, gcode, progress=None):
+        if not cls.exists(gcode):
+            cls.build(gcode, progress)
+        return cls(gcode)
+
+    @classmethod
+    def build(cls, gcode, progress=None):
+        directory = os.path.dirname(gcode.basePath)
+        blobFd, blobTmp = tempfile.mkstemp(dir=directory, suffix=PACKED_EXT)
+        indexFd, indexTmp = tempfile.mkstemp(dir=directory, suffix=PACKED_INDEX_EXT)
+        try:
+            offsets = array(OFFSET_TYPE, [0])
+            position = 0
+            total = len(gcode)
+            checksums = gcode.getChecksums()
+            with os.fdopen(blobFd, "wb") as blob:
+                for i, line in enumerate(gcode):
+                    if progress is not None and i % 10_000 == 0:
+                        progress(i / total)
+                    packed = packNumbered(i + 1, line[:-1], checksums[i])
+                    blob.write(packed)
+                    position += len(packed)
+                    offsets.append(position)
+            with os.fdopen(indexFd, "wb") as index:
+                offsets.tofile(index)
+            os.replace(indexTmp, gcode.basePath + PACKED_INDEX_EXT)
+            # the blob goes in last, so a packed blob on disk always has its index next to it
+            os.replace(blobTmp, gcode.basePath + PACKED_EXT)
+        finally:
+            for path in (blobTmp, indexTmp):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # Bytes on the wire for the whole file
+    def getSize(self):
+        return self.__offsets[len(self.__offsets) - 1]
+
+    # (line number, packed wire bytes, plain line) for every line from `start`, numbered like
+    # GcodeBuffer.iterNumbered. The plain line is what logs and the send window look at.
+    def iterNumbered(self, start):
+        blob = self.__blob
+        offsets = self.__offsets
+        for i, line in enumerate(self.gcode.iterFrom(start), start):
+            yield i + 1, blob[offsets[i]:offsets[i + 1]], line
+
+    def close(self):
+        if isinstance(self.__offsets, memoryview):
+            self.__offsets.release()
+        for m in (self.__blob, self.__index):
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+
+def mapFile(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# The firmware's side, as Marlin's meatpack.cpp does it. Used by the virtual printer.
+class MeatPackDecoder:
+    def __init__(self):
+        self.active = False
+        self.noSpaces = False
+        self.signals = 0  # 0xFF bytes just received
+        self.literals = 0  # full characters still to come
+        self.held = None  # packed character that goes out after the next full one
+        self.wireBytes = 0  # received since the last newline came out
+        self.lineSizes = []  # bytes on the wire for each line decoded
+
+    # Decodes received bytes. Returns the plain bytes and the MeatPack commands that were in them.
+    def feed(self, data):
+        out = bytearray()
+        commands = []
+        for byte in data:
+            self.wireBytes += 1
+            if byte == SIGNAL and self.signals < 2:
+                self.signals += 1
+                continue
+            if self.signals == 2:
+                self.signals = 0
+                self.handleCommand(byte)
+                commands.append(byte)
+                continue
+            if self.signals == 1:  # a lone 0xFF is packed data
+                self.signals = 0
+                self.decode(SIGNAL, out)
+            self.decode(byte, out)
+        return bytes(out), commands
+
+    def decode(self, byte, out):
+        if not self.active:
+            self.output(byte, out)
+        elif self.literals:
+            self.literals -= 1
+            self.output(byte, out)
+            if self.held is not None:
+                self.output(self.held, out)
+                self.held = None
+        else:
+            low, high = byte & 0xF, byte >> 4
+            if low == LITERAL:
+                self.literals += 1
+                if high == LITERAL:
+                    self.literals += 1
+                else:
+                    self.held = self.char(high)
+            else:
+                char = self.char(low)
+                self.output(char, out)
+                if char != 0x0A:  # nothing after a newline is used
+                    if high == LITERAL:
+                        self.literals += 1
+                    else:
+                        self.output(self.char(high), out)
+
+    def output(self, char, out):
+        out.append(char)
+        if char == 0x0A:
+            self.lineSizes.append(self.wireBytes)
+            self.wireBytes = 0
+
+    def char(self, code):
+        char = CODES[code]
+        return 0x20 if char == 0x45 and not self.noSpaces else char  # "E" is a space unless spaces are off
+
+    def handleCommand(self, code):
+        if code == ENABLE_PACKING:
+            self.active = True
+        elif code == DISABLE_PACKING:
+            self.active = False
+        elif code == ENABLE_NO_SPACES:
+            self.noSpaces = True
+        elif code == DISABLE_NO_SPACES:
+            self.noSpaces = False
+        elif code == RESET_ALL:
+            self.active = self.noSpaces = False
+
+    # Drops the part of a line decoded so far, when the firmware flushes its RX buffer
+    def discardLine(self):
+        self.signals = 0
+        self.literals = 0
+        self.held = None
+        self.wireBytes = 0
+        self.lineSizes.clear()
+
+    # The state line the firmware prints after every command
+    def report(self):
+        return f"{REPORT_PREFIX} PV01 {'ON' if self.active else 'OFF'} {'NSP' if self.noSpaces else 'ESP'}"
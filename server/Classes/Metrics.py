@@ -0,0 +1,197 @@
+import math
+import threading
+from bisect import bisect_left
+
+# seconds, for ack round trips and reads. Acks for heating (M109/M190) and homing land in +Inf.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# seconds, for queue waits and whole prints
+JOB_BUCKETS = (60, 300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 16 * 3600, 24 * 3600, 48 * 3600)
+
+
+def formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def formatLabels(names, values, extra=None):
+    pairs = [f'{name}="{escapeLabel(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # per bucket, not cumulative; the last is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+# A metric and its series, one per combination of label values. Series are looked up once by
+# whoever updates them (labels() takes a lock, updating doesn't), so the hot path is an attribute
+# increment. Each series should only be updated from one thread, e.g. a printer's worker; a scrape
+# reads the numbers as they are without stopping anyone.
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labels)
+        self.series = {}  # label values: value
+        self.lock = threading.Lock()
+        if not self.labelNames:
+            self.series[()] = self.newValue()
+
+    def newValue(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        value = self.series.get(values)
+        if value is None:
+            with self.lock:
+                value = self.series.setdefault(values, self.newValue())
+        return value
+
+    # Drops a series, e.g. for a printer that was removed
+    def remove(self, *values):
+        with self.lock:
+            self.series.pop(tuple(str(value) for value in values), None)
+
+    # Lines in the Prometheus text format
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, value in list(self.series.items()):
+            yield from self.renderSeries(values, value)
+
+    def renderSeries(self, values, value):
+        yield f"{self.name}{formatLabels(self.labelNames, values)} {formatValue(value.value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def newValue(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.series[()].inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def newValue(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.series[()].set(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def newValue(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.series[()].observe(value)
+
+    def renderSeries(self, values, value):
+        counts = list(value.counts)
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            total += count
+            yield f"{self.name}_bucket{formatLabels(self.labelNames, values, ('le', formatValue(bound)))} {total}"
+        yield f"{self.name}_sum{formatLabels(self.labelNames, values)} {formatValue(value.sum)}"
+        yield f"{self.name}_count{formatLabels(self.labelNames, values)} {total}"
+
+
+# A metric whose values are read from somewhere else when it is scraped, e.g. whether threads are
+# alive. `function` returns {label values: value}.
+class CallbackMetric(Metric):
+    def __init__(self, name, help, kind, labels, function):
+        self.kind = kind
+        self.function = function
+        super().__init__(name, help, labels)
+
+    def newValue(self):
+        return None
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        try:
+            collected = self.function()
+        except Exception as e:
+            print(f"Metric {self.name} failed: {e}")
+            return
+        for values, value in collected.items():
+            yield f"{self.name}{formatLabels(self.labelNames, values)} {formatValue(value)}"
+
+
+# Every metric the server exposes on /metrics. Registering a name twice returns the metric that
+# already has it, so modules can declare their metrics at import time. Callbacks are replaced
+# instead, since they read from whichever object registered them last.
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}  # name: Metric, in registration order
+        self.lock = threading.Lock()
+
+    def register(self, metric, replace=False):
+        with self.lock:
+            if replace:
+                self.metrics[metric.name] = metric
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, function, kind="gauge", labels=()):
+        return self.register(CallbackMetric(name, help, kind, labels, function), replace=True)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = [line for metric in metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+import threading
+import serial.tools.list_ports
+from Classes.VirtualPrinter import listVirtualPorts, findVirtualPort
+
+try:
+    import pyudev  # optional: hotplug events from udev instead of waiting for the next check
+except ImportError:
+    pyudev = None
+
+LINUX = sys.platform.startswith("linux")
+if LINUX:
+    from serial.tools.list_ports_linux import SysFS
+
+# the device nodes pyserial's comports() looks at on Linux
+DEVICE_PREFIXES = ("ttyS", "ttyUSB", "ttyXRUSB", "ttyACM", "ttyAMA", "rfcomm", "ttyAP")
+# seconds between full rescans where there's no cheap way to tell if anything changed (not Linux)
+RESCAN_INTERVAL = 5.0
+
+
+# Serial ports seen by the server, enumerated once and indexed by hwid and device. On Linux a
+# refresh lists /dev and only probes nodes that appeared or were recreated since the last one
+# (a replugged board gets a fresh node), so checking for changes is one directory read. Listeners
+# are told when a known hwid shows up on a different device, e.g. a printer that was /dev/ttyACM0
+# coming back as /dev/ttyACM1 after a USB reset.
+class PortRegistry:
+    def __init__(self, devDir="/dev", rescanInterval=RESCAN_INTERVAL):
+        self.devDir = devDir
+        self.rescanInterval = rescanInterval
+        self.ports = {}  # device: port info
+        self.byHwid = {}  # hwid: port info
+        self.signature = {}  # device: (inode, ctime) of its node at the last refresh
+        self.scannedAt = None
+        self.scans = 0  # refreshes that found something to probe
+        self.probes = 0  # device nodes looked up in sysfs
+        self.listeners = []
+        self.monitor = None
+        self.__lock = threading.RLock()
+
+    # Calls `listener(hwid, device)` whenever a port's hwid moves to a new device
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    # Connected ports (physical and virtual)
+    def getPorts(self):
+        self.refresh()
+        with self.__lock:
+            return list(self.ports.values()) + listVirtualPorts()
+
+    # The port with this hwid, or None if it isn't connected
+    def findByHwid(self, hwid):
+        port = findVirtualPort(hwid)
+        if port is not None:
+            return port
+        self.refresh()
+        with self.__lock:
+            return self.byHwid.get(hwid)
+
+    def findByDevice(self, device):
+        self.refresh()
+        with self.__lock:
+            port = self.ports.get(device)
+        return port or next((port for port in listVirtualPorts() if port.device == device), None)
+
+    # The device the port with this hwid is on now, or None
+    def findDevice(self, hwid):
+        port = self.findByHwid(hwid)
+        return port.device if port is not None else None
+
+    # Brings the index up to date with what's plugged in. Cheap when nothing changed.
+    def refresh(self, force=False):
+        with self.__lock:
+            moved = self.__updateLinux(force) if LINUX else self.__rescan(force)
+        for hwid, device in moved:
+            for listener in self.listeners:
+                try:
+                    listener(hwid, device)
+                except Exception as e:
+                    print(f"Port listener error for {hwid}: {e}")
+
+    def __updateLinux(self, force):
+        signature = self.__readSignature()
+        if signature == self.signature and not force:
+            return []
+        previous = {hwid: port.device for hwid, port in self.byHwid.items()}
+        for device in self.signature.keys() - signature.keys():
+            self.__remove(device)
+        for device, stamp in signature.items():
+            if force or self.signature.get(device) != stamp:
+                self.__remove(device)
+                port = SysFS(device)
+                self.probes += 1
+                if port.subsystem != "platform":  # internal ports with nothing behind them
+                    self.__add(port)
+        self.signature = signature
+        self.scans += 1
+        return self.__moved(previous)
+
+    # Listing /dev is cheap, probing each port in sysfs isn't
+    def __readSignature(self):
+        signature = {}
+        try:
+            names = os.listdir(self.devDir)
+        except OSError:
+            return signature
+        for name in names:
+            if name.startswith(DEVICE_PREFIXES):
+                path = os.path.join(self.devDir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # unplugged while listing
+                signature[path] = (stat.st_ino, stat.st_ctime_ns)
+        return signature
+
+    def __rescan(self, force):
+        now = time.monotonic()
+        if not force and self.scannedAt is not None and now - self.scannedAt < self.rescanInterval:
+            return []
+        previous = {hwid: port.device for hwid, port in self.byHwid.items()}
+        self.ports, self.byHwid = {}, {}
+        for port in serial.tools.list_ports.comports():
+            self.__add(port)
+        self.probes += len(self.ports)
+        self.scannedAt = now
+        self.scans += 1
+        return self.__moved(previous)
+
+    def __add(self, port):
+        self.ports[port.device] = port
+        if port.hwid and port.hwid != "n/a":
+            self.byHwid[port.hwid] = port
+
+    def __remove(self, device):
+        port = self.ports.pop(device, None)
+        if port is not None and self.byHwid.get(port.hwid) is port:
+            del self.byHwid[port.hwid]
+
+    def __moved(self, previous):
+        return [(hwid, port.device) for hwid, port in self.byHwid.items()
+                if hwid in previous and previous[hwid] != port.device]
+
+    # Refreshes as soon as udev reports a tty being added or removed, if pyudev is installed.
+    # Returns whether hotplug events are being watched.
+    def startMonitor(self):
+        if pyudev is None or not LINUX or self.monitor is not None:
+            return self.monitor is not None
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by("tty")
+            self.monitor = pyudev.MonitorObserver(monitor, callback=lambda device: self.refresh(), name="port-monitor")
+            self.monitor.start()
+            return True
+        except Exception as e:  # no netlink access, e.g. in a container
+            print(f"Port hotplug monitor unavailable: {e}")
+            self.monitor = None
+            return False
+
+    def stopMonitor(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+
+
+portRegistry = PortRegistry()
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+from bisect import bisect_right
+
+# One checkpoint file per printer, for the job it is printing
+CHECKPOINT_DIR = os.environ.get(
+    "PRINT_CHECKPOINT_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storage", "checkpoints"),
+)
+# seconds between checkpoint writes while printing
+CHECKPOINT_INTERVAL = 5.0
+# mm the nozzle is lifted off the part while re-homing X and Y on resume
+RESUME_LIFT = 2.0
+RESUME_TRAVEL_FEEDRATE = 3000  # mm/min
+RESUME_Z_FEEDRATE = 600  # mm/min
+
+
+# Durable progress of the print running on each printer, so a print cut short by a disconnect,
+# crash or power loss can be picked up at the last layer instead of starting over.
+class CheckpointStore:
+    def __init__(self, root=CHECKPOINT_DIR):
+        self.root = root
+
+    def getPath(self, key):
+        return os.path.join(self.root, f"{key}.json")
+
+    # Atomically replaces the checkpoint for `key`: a crash mid-write leaves the previous one intact
+    def save(self, key, checkpoint):
+        os.makedirs(self.root, exist_ok=True)
+        path = self.getPath(key)
+        with open(path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def load(self, key):
+        try:
+            with open(self.getPath(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def clear(self, key):
+        try:
+            os.remove(self.getPath(key))
+        except FileNotFoundError:
+            pass
+
+
+# The last layer starting at or before `line` (a layer index entry from GcodeEstimator), or None
+# if the print hadn't reached the first layer yet.
+def findLayer(layers, line):
+    position = bisect_right([layer["line"] for layer in layers], line)
+    return layers[position - 1] if position else None
+
+
+# Writes checkpoints for one print, at most every `interval` seconds. `update` is called for every
+# line sent, so it only looks at the clock until a write is due. With a `loop` (the asyncio backend)
+# the writes and their fsyncs run on the loop's executor, one at a time, and wait() waits for the last.
+class Checkpointer:
+    def __init__(self, store, key, job, gcode, layers, telemetry=None, interval=CHECKPOINT_INTERVAL, inFlight=0,
+                 loop=None):
+        self.store = store
+        self.key = key
+        self.job = job
+        self.gcode = gcode
+        self.layers = layers
+        self.telemetry = telemetry
+        self.interval = interval
+        self.inFlight = inFlight  # lines that may be sent but not yet executed
+        self.loop = loop
+        self.pending = None  # the write running on the executor
+        self.nextWrite = 0.0
+        self.writes = 0
+
+    def update(self, line):
+        now = time.monotonic()
+        if now >= self.nextWrite:
+            if self.loop is None:
+                self.save(line)
+            elif self.pending is None or self.pending.done():
+                self.pending = self.loop.run_in_executor(None, self.save, line)
+            else:
+                return  # the last write is still going: try again on the next line
+            self.nextWrite = now + self.interval
+
+    # Waits for a write still running on the executor, so it can't land after the checkpoint is cleared
+    async def wait(self):
+        if self.pending is not None:
+            await self.pending
+
+    def save(self, line):
+        line = max(0, line - self.inFlight)
+        layer = findLayer(self.layers, line)
+        temperatures = self.telemetry.getLatest()["temperatures"] if self.telemetry is not None else None
+        self.store.save(self.key, {
+            "job": getattr(self.job, "id", None),
+            "file_hash": self.gcode.getKey(),
+            "line": line,
+            "offset": self.gcode.getOffset(min(line, len(self.gcode))),
+            "z": layer["z"] if layer else None,
+            "temperatures": temperatures,
+            "time": time.time(),
+        })
+        self.writes += 1
+
+
+# G-code that puts a printer that has been reset (or power cycled) back into the state the file
+# expects at the start of `layer`: heated, X and Y homed, the nozzle above where the layer starts,
+# the extruder position and modes restored. Z can't be homed with a part on the bed, so the
+# nozzle is assumed to still be at the layer height.
+def resumePreamble(layer, checkpoint=None):
+    hotend, bed = layer["hotend"], layer["bed"]
+    temperatures = (checkpoint or {}).get("temperatures") or {}
+    hotend = hotend or temperatures.get("hotend_target") or 0
+    bed = bed or temperatures.get("bed_target") or 0
+    z = layer["z"]
+    return [
+        f"M140 S{bed:g}",
+        f"M104 S{hotend:g}",
+        f"M190 S{bed:g}",
+        f"M109 S{hotend:g}",
+        f"G92 Z{z:g}",
+        "G91",
+        f"G1 Z{RESUME_LIFT:g} F{RESUME_Z_FEEDRATE}",
+        "G90",
+        "G28 X Y",
+        "M82" if layer["absolute_e"] else "M83",
+        f"G92 E{layer['e']:g}",
+        f"M106 S{layer['fan']:g}" if layer["fan"] else "M107",
+        f"G1 X{layer['x']:g} Y{layer['y']:g} F{RESUME_TRAVEL_FEEDRATE}",
+        f"G1 Z{z:g} F{RESUME_Z_FEEDRATE}",
+        f"G1 F{layer['feedrate']:g}",
+        "G90" if layer["absolute"] else "G91",
+    ]
+
+
+checkpointStore = CheckpointStore()
@@ -1,7 +1,14 @@
 import serial
 from serial.tools import list_ports
 import time
+import logging
 from Classes.Queue import Queue
+from Classes.GcodeStreamer import GcodeStreamer
+from Classes.VirtualPrinter import startVirtualFarm, listVirtualPorts
+from Classes.PortRegistry import portRegistry
+from Classes.PrinterLog import CommandEcho
+
+logger = logging.getLogger(__name__)
 
 # Class for each printer.
 class Printer:
@@ -14,13 +21,14 @@ class Printer:
         self.queue = Queue()
         self.__mongoid = mongoid
         self.status = "configuring" # ready, error, offline, printing, complete 
+        self.commandEcho = CommandEcho(logger) # echo is rate limited, a print sends thousands of lines
 
     # Method to connect to the printer via serial port.
     def connect(self):
         if not self.virtual:
             self.ser = serial.Serial(self.serial_port, 115200, timeout=1)
         else:
-            print("Connected to virtual printer.")
+            logger.info("Connected to virtual printer.")
 
     # Method to disconnect from the printer via serial port.
     def disconnect(self):
@@ -35,20 +43,19 @@ class Printer:
     # Method to send gcode commands to the printer.
     def sendGcode(self, message):
         if self.virtual:
-            print(f"Virtual Printer - Command: {message}, Received: ok")
+            self.commandEcho.log(self.__mongoid, message, "ok")
             return
-        self.ser.write(f"{message}\n".encode("utf-8"))
-        time.sleep(0.1)
-        while True:
-            response = self.ser.readline().decode("utf-8").strip()
-            if "ok" in response:
-                break
-        print(f"Command: {message}, Received: {response}")
+        response = GcodeStreamer(self.ser).send(message)
+        self.commandEcho.log(self.__mongoid, message, response)
 
-    # Method to print a job.
+    # Method to print a job. Lines are streamed with several commands in flight at once.
     def printJob(self, job):
-        for line in job.gcode_lines:
-            self.sendGcode(line)
+        if self.virtual:
+            for line in job.gcode_lines:
+                self.sendGcode(line)
+            return
+        stats = GcodeStreamer(self.ser).stream(job.gcode_lines)
+        logger.info("Stream finished", extra={"printer": self.__mongoid, **stats.toDict()})
 
     # Method to get a list of all the connected serial ports. Static Method that can be called without an instance.
     @staticmethod
@@ -59,15 +66,14 @@ class Printer:
         printerList = []
 
         if virtual:
-            # Assuming you want to create a predefined number of virtual printers
+            # Simulated printers on pseudo-terminals, so the real serial code path is exercised
             num_virtual_printers = 3  # You can change this number as needed
-            for i in range(num_virtual_printers):
-                # Creating virtual Printer objects
-                printerList.append(Printer("Virtual Port " + str(i), 0, virtual=True, filament=False))
-            return printerList
+            if not listVirtualPorts():
+                startVirtualFarm(num_virtual_printers)
+            return listVirtualPorts()
 
         # Get a list of all the connected serial ports.
-        ports = serial.tools.list_ports.comports()
+        ports = portRegistry.getPorts()
         for port in ports:
             # Keep a list of supported printers.
             supportedPrinters = ["Original Prusa i3 MK3", "Makerbot"]
@@ -1,18 +1,23 @@
 from Classes.Printer import Printer
+from services.schedulerService import FarmScheduler
 class PrinterList: 
     
     def __init__(self): 
         self.__list = {} # Stores mongodbid: Printer Object 
+        self.__scheduler = FarmScheduler() # orders printers by when they'll finish their queued work
           
     def addPrinter(self, port, id): # add printer to printer list 
         printer = Printer(port, id, None, False) # port, filament, virtual
         # self.__list.append(printer)
         self.__list[id] = printer 
+        self.__scheduler.addPrinter(printer)
         
-    def autoQueue(self): # Get index of printer with smallest queue 
-        # sort printer objects by size of queue 
-        sortPrintersByQueueSize = sorted(self.__list.items(), key=lambda item: item[1].getSizeOfQueue())
-        return sortPrintersByQueueSize # returns a list of tuples
+    def autoQueue(self, job): # Get the printer that will finish its queued work first 
+        # picks by estimated finish time, not queue length, and reserves the job's time on it 
+        return self.__scheduler.assign(job) # returns a Printer object (None if none can take the job)
+
+    def jobFinished(self, printer, job): 
+        self.__scheduler.release(printer, job)
 
     def getList(self): 
         return self.__list; 
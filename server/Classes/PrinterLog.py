@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+
+# LOG_FORMAT=json writes one JSON object per line, for log shippers. The default is plain text.
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# records waiting for the writer thread. When the output can't keep up, new records are dropped
+# rather than making printer threads wait.
+LOG_QUEUE_SIZE = 10_000
+# command echoes logged per printer per second (and the burst allowed above that). The rest are
+# counted and the count goes out with the next echo.
+COMMAND_ECHO_RATE = float(os.environ.get("COMMAND_ECHO_RATE", "2"))
+COMMAND_ECHO_BURST = 10
+# lines sent and received kept per printer, for working out why a print failed
+EXCHANGE_HISTORY = 200
+
+# attributes every LogRecord has. Anything else was passed in `extra` and is a structured field.
+RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def getFields(record):
+    return {key: value for key, value in vars(record).items() if key not in RECORD_FIELDS}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getFields(record),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# "message key=value ..." with the structured fields after the message
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getFields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+# Hands records to the writer thread without ever blocking the caller
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # the writer formats records itself, so only the message arguments need resolving here
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+listener = None
+queueHandler = None
+
+
+# Routes every logger through a bounded queue to a background thread that does the actual writing,
+# so a slow stdout or log pipe never holds up a printer's send loop. Safe to call more than once.
+def setupLogging(level=LOG_LEVEL, logFormat=LOG_FORMAT, stream=None):
+    global listener, queueHandler
+    if listener is not None:
+        return listener
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if logFormat == "json" else TextFormatter())
+    queueHandler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root = logging.getLogger()
+    root.handlers = [queueHandler]
+    root.setLevel(level)
+    listener = QueueListener(queueHandler.queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(stopLogging)
+    return listener
+
+
+# Writes out whatever is still queued and stops the writer thread
+def stopLogging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def getDroppedRecords():
+    return queueHandler.dropped if queueHandler is not None else 0
+
+
+# Token bucket for one printer's command echo. Commands over the rate are counted, not logged.
+class CommandEcho:
+    def __init__(self, logger, rate=COMMAND_ECHO_RATE, burst=COMMAND_ECHO_BURST):
+        self.logger = logger
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updatedAt = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def log(self, printer, command, response):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updatedAt) * self.rate)
+            self.updatedAt = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+        fields = {"printer": printer, "command": command, "response": response}
+        if suppressed:
+            fields["suppressed"] = suppressed
+        self.logger.info("Command sent", extra=fields)
+
+
+# The last `size` lines sent to and received from one printer. Appending is a deque append, cheap
+# enough to do for every line streamed. Times are monotonic until dumped.
+class ExchangeRing:
+    def __init__(self, size=EXCHANGE_HISTORY):
+        self.entries = deque(maxlen=size)  # (monotonic time, "sent" | "received", str or bytes)
+
+    def sent(self, data, at):
+        self.entries.append((at, "sent", data))
+
+    def received(self, line, at):
+        self.entries.append((at, "received", line))
+
+    # Oldest first, as [{"time" (unix), "direction", "line"}]
+    def dump(self, limit=None):
+        entries = list(self.entries)
+        if limit is not None:
+            entries = entries[-limit:]
+        offset = time.time() - time.monotonic()
+        return [{
+            "time": round(at + offset, 3),
+            "direction": direction,
+            "line": (line.decode("utf-8", errors="replace") if isinstance(line, bytes) else line).rstrip("\n"),
+        } for at, direction, line in entries]
@@ -1,68 +1,243 @@
-from collections import deque
-class Queue: 
-    # Only adding ID to the queue 
+import heapq
+import itertools
+import threading
+
+
+# Jobs are identified in the journal by their database id
+def journalKey(jobid):
+    return getattr(jobid, "id", jobid)
+
+
+# Priority used for a job when none is given: the job's own `priority` field if it has one.
+def jobPriority(jobid):
+    try:
+        return int(getattr(jobid, "priority", 0) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class Queue:
+    # Only adding ID to the queue
+    # Jobs are ordered by priority (higher first), then by position within their priority level.
+    # Entries live in a heap keyed by (-priority, sequence) with a dict from job ID to its entry,
+    # so membership is O(1) and enqueue, dequeue, move-to-front and delete are O(log n).
+    # Removed or re-keyed entries are marked dead and skipped lazily. The live entries of each
+    # priority level are also linked in order, so bump() finds its neighbour in O(1).
+    # Request threads and printer workers share a queue, so every change holds the queue's lock.
+    # Changes are journaled in order under the lock, but the wait for the fsync happens after it's
+    # released, so readers never wait on the disk. A change is recorded before it's made, so one
+    # the journal refuses leaves the queue as it was. One whose write fails afterwards (JournalError
+    # from the wait) stands: the journal keeps the record and writes it with its next commit.
     def __init__(self):
-        self.__queue = deque() # use Python double-ended queue  
-    
-    # if no priority add to end of queue. If priority add to front of queue. 
-    def addToBack(self, jobid):
-        if self.__queue.count(jobid)>0: 
-            raise Exception("Job ID already in queue.") 
-        self.__queue.append(jobid) # appending on the right is the "front" because popping takes out from right d
-    
-    def addToFront(self, jobid): 
-        if self.__queue.count(jobid)>0: 
-            raise Exception("Job ID already in queue.") 
-        self.__queue.appendleft(jobid)
-    
-    def bump(self, up, jobid): # up = boolean. if up = true bump up, else bump down 
-        index = list(self.__queue).index(jobid)
-        if up==True: 
-            self.__queue.remove(jobid)
-            self.__queue.insert(index-1, jobid)
-        else: 
-            self.__queue.remove(jobid)
-            self.__queue.insert(index+1, jobid)
-            pass 
-    
-    def deleteJob(self, jobid): 
-        if self.__queue.count(jobid)<=0: 
-            raise Exception("Job not in queue.") 
-        self.__queue.remove(jobid)
-    
-    def bumpExtreme(self, front, jobid): # bump to back/front of queue 
-        if(front == True):
-            self.__queue.remove(jobid)
-            self.addToFront(jobid)
-        else: 
-            self.__queue.remove(jobid)
-            self.addToBack(jobid) 
-            
-    def getQueue(self): 
-        return self.__queue
-    
-    def getNext(self): 
-        return self.__queue[0]
-    
-    def getSize(self): 
-        return len(self.__queue)
-    
+        self.__heap = []  # [-priority, sequence, tiebreak, jobid, alive, previous, next]
+        self.__entries = {}  # jobid: heap entry
+        self.__levels = {}  # -priority: [first entry, last entry] of that level's live entries
+        self.__front = 0  # sequence numbers below this are free for addToFront
+        self.__back = 0  # sequence numbers from this up are free for addToBack
+        self.__dead = 0  # dead entries still sitting in the heap
+        self.__counter = itertools.count()  # keeps a dead and a live entry with the same key from comparing job IDs
+        self.__lock = threading.Lock()
+        self.__journal = None  # QueueJournal that every change is written to, if any
+        self.__key = None  # this queue's name in the journal (the printer id)
+
+    # Journals every change from now on. Jobs already in the queue are assumed to be journaled.
+    def setJournal(self, journal, key):
+        self.__journal = journal
+        self.__key = key
+
+    # Adds jobs that are already in the journal (a restore) without journaling them again
+    def load(self, entries):
+        with self.__lock:
+            for jobid, priority in entries:
+                if jobid not in self.__entries:
+                    self.__push(jobid, priority, self.__back)
+                    self.__back += 1
+
+    # Queues a journal record. Returns its sequence number for __commit, or None without a journal.
+    def __record(self, op, jobid, **fields):
+        if self.__journal is not None:
+            return self.__journal.append({"op": op, "printer": self.__key, "job": journalKey(jobid), **fields},
+                                         wait=False)
+        return None
+
+    # Waits for a record to be on disk. Called without the lock held.
+    def __commit(self, sequence):
+        if sequence is not None:
+            self.__journal.commit(sequence)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, jobid):
+        return jobid in self.__entries
+
+    def __push(self, jobid, priority, sequence):
+        entry = [-priority, sequence, next(self.__counter), jobid, True, None, None]
+        self.__entries[jobid] = entry
+        heapq.heappush(self.__heap, entry)
+        self.__link(entry)
+
+    # Puts a new entry in its level's order. Adding at either end is O(1); anywhere else (a job
+    # moved to another level keeping its sequence) walks the level from the back.
+    def __link(self, entry):
+        level = self.__levels.get(entry[0])
+        if level is None:
+            self.__levels[entry[0]] = [entry, entry]
+            return
+        first, last = level
+        if entry[1] < first[1]:
+            entry[6], first[5], level[0] = first, entry, entry
+            return
+        previous = last
+        while previous[1] > entry[1]:
+            previous = previous[5]
+        following = previous[6]
+        entry[5], entry[6], previous[6] = previous, following, entry
+        if following is None:
+            level[1] = entry
+        else:
+            following[5] = entry
+
+    def __unlink(self, entry):
+        previous, following = entry[5], entry[6]
+        level = self.__levels[entry[0]]
+        if previous is None:
+            level[0] = following
+        else:
+            previous[6] = following
+        if following is None:
+            level[1] = previous
+        else:
+            following[5] = previous
+        if level[0] is None:
+            del self.__levels[entry[0]]
+        entry[5] = entry[6] = None
+
+    def __kill(self, jobid):
+        entry = self.__entries.pop(jobid)
+        entry[4] = False
+        self.__unlink(entry)
+        self.__dead += 1
+        # rebuild once dead entries outnumber live ones, so the heap stays O(live jobs)
+        if self.__dead > len(self.__entries):
+            self.__heap = [e for e in self.__heap if e[4]]
+            heapq.heapify(self.__heap)
+            self.__dead = 0
+        return entry
+
+    def __peek(self):
+        heap = self.__heap
+        while heap and not heap[0][4]:
+            heapq.heappop(heap)
+            self.__dead -= 1
+        if not heap:
+            raise IndexError("Queue is empty.")
+        return heap[0]
+
+    # if no priority add to end of queue. If priority add to front of queue.
+    # Within a priority level, addToBack appends and addToFront goes ahead of everything else.
+    def addToBack(self, jobid, priority=None):
+        with self.__lock:
+            if jobid in self.__entries:
+                raise Exception("Job ID already in queue.")
+            priority = jobPriority(jobid) if priority is None else priority
+            sequence = self.__record("add", jobid, priority=priority)
+            self.__push(jobid, priority, self.__back)
+            self.__back += 1
+        self.__commit(sequence)
+
+    def addToFront(self, jobid, priority=None):
+        with self.__lock:
+            if jobid in self.__entries:
+                raise Exception("Job ID already in queue.")
+            priority = jobPriority(jobid) if priority is None else priority
+            sequence = self.__record("front", jobid, priority=priority)
+            self.__front -= 1
+            self.__push(jobid, priority, self.__front)
+        self.__commit(sequence)
+
+    def bump(self, up, jobid): # up = boolean. if up = true bump up, else bump down
+        # swaps the job with its neighbour in the same priority level. A job never changes level by
+        # being bumped: at the edge of its level this does nothing (use setPriority for that).
+        with self.__lock:
+            entry = self.__entries[jobid]
+            neighbour = entry[5] if up else entry[6]
+            if neighbour is None: # already at the front/back of its level
+                return
+            sequence = self.__record("bump", jobid, up=up)
+            # the two jobs trade entries. The keys stay where they are, so the heap is untouched.
+            otherid = neighbour[3]
+            entry[3], neighbour[3] = otherid, jobid
+            self.__entries[jobid], self.__entries[otherid] = neighbour, entry
+        self.__commit(sequence)
+
+    def deleteJob(self, jobid):
+        with self.__lock:
+            if jobid not in self.__entries:
+                raise Exception("Job not in queue.")
+            sequence = self.__record("delete", jobid)
+            self.__kill(jobid)
+        self.__commit(sequence)
+
+    # Takes a job out if it's still queued. Returns whether it was.
+    def discard(self, jobid):
+        with self.__lock:
+            if jobid not in self.__entries:
+                return False
+            sequence = self.__record("delete", jobid)
+            self.__kill(jobid)
+        self.__commit(sequence)
+        return True
+
+    def bumpExtreme(self, front, jobid): # bump to back/front of queue
+        with self.__lock:
+            priority = -self.__entries[jobid][0]
+            sequence = self.__record("extreme", jobid, front=front)
+            self.__kill(jobid)
+            if(front == True):
+                self.__front -= 1
+                self.__push(jobid, priority, self.__front)
+            else:
+                self.__push(jobid, priority, self.__back)
+                self.__back += 1
+        self.__commit(sequence)
+
+    # Moves a job to a new priority level, keeping its place relative to jobs already there
+    def setPriority(self, jobid, priority):
+        with self.__lock:
+            entry = self.__entries[jobid]
+            sequence = self.__record("priority", jobid, priority=priority)
+            self.__kill(jobid)
+            self.__push(jobid, priority, entry[1])
+        self.__commit(sequence)
+
+    def getPriority(self, jobid):
+        with self.__lock:
+            return -self.__entries[jobid][0]
+
+    # Jobs in order, front first: each level's linked entries, highest priority first
+    def getQueue(self):
+        with self.__lock:
+            jobs = []
+            for key in sorted(self.__levels):
+                entry = self.__levels[key][0]
+                while entry is not None:
+                    jobs.append(entry[3])
+                    entry = entry[6]
+            return jobs
+
+    def getNext(self):
+        with self.__lock:
+            return self.__peek()[3]
+
+    def getSize(self):
+        return len(self.__entries)
+
+    # Removes and returns the job at the front of the queue (the one getNext returns)
     def removeJob(self):
-        self.__queue.pop()
-    
-    
-
-# test = Queue()
-
-# test.addToFront(1)
-# test.addToFront(2)
-# test.addToFront(3)
-# test.addToFront(4)
-# test.addToFront(5)
-# # test.addToBack(10)
-# # test.addToFront(11)
-# # test.bumpExtreme(False, 2)
-# test.bump(False, 2)
-
-# print(test.getNext())
-# print(test.getQueue())
\ No newline at end of file
+        with self.__lock:
+            entry = self.__peek()
+            sequence = self.__record("delete", entry[3])
+            self.__kill(entry[3])
+        self.__commit(sequence)
+        return entry[3]
@@ -0,0 +1,220 @@
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from Classes.Queue import Queue
+
+# Every queue change is appended here before it is acknowledged, so queues survive a restart or crash
+JOURNAL_PATH = os.environ.get(
+    "QUEUE_JOURNAL",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storage", "queue.journal"),
+)
+# the journal is rewritten as a snapshot of the current queues once it holds this many records
+COMPACT_AFTER = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+# A record could not be written. It stays in the journal's queues and goes out with the next snapshot.
+class JournalError(Exception):
+    pass
+
+
+# Applies one journal record to `queues` ({printer: Queue of job ids}). Records that no longer
+# apply (a job already added or already gone) are skipped, so replay never fails half way.
+def applyRecord(queues, record):
+    queue = queues.setdefault(record["printer"], Queue())
+    op, job = record["op"], record["job"]
+    if op in ("add", "front"):
+        if job not in queue:
+            if op == "add":
+                queue.addToBack(job, record.get("priority", 0))
+            else:
+                queue.addToFront(job, record.get("priority", 0))
+    elif job not in queue:
+        return
+    elif op == "delete":
+        queue.deleteJob(job)
+    elif op == "bump":
+        queue.bump(record["up"], job)
+    elif op == "extreme":
+        queue.bumpExtreme(record["front"], job)
+    elif op == "priority":
+        queue.setPriority(job, record["priority"])
+
+
+# Write-ahead journal for printer queues: one JSON record per line, fsynced before append() returns.
+# Appends from many threads are group-committed: whatever queues up while one fsync is running is
+# written and synced together by the next, so a burst of enqueues costs a few fsyncs, not one each.
+# The journal replays its own records into `queues` as they are appended, which is what gets written
+# out when the file is compacted. When a write fails, everyone waiting on that batch gets a
+# JournalError, and the next commit rewrites the whole file, since its end may be torn.
+class QueueJournal:
+    def __init__(self, path=JOURNAL_PATH, compactAfter=COMPACT_AFTER):
+        self.path = path
+        self.compactAfter = compactAfter
+        self.queues = {}  # printer: Queue of job ids, the state the journal describes
+        self.commits = 0  # number of fsyncs
+        self.__condition = threading.Condition()
+        self.__pending = []  # encoded records waiting for the next commit
+        self.__appended = 0
+        self.__committed = 0  # records whose write has been attempted
+        self.__durable = 0  # records known to be on disk
+        self.__error = None  # why the last write failed
+        self.__rewriteNeeded = False
+        self.__records = 0  # records in the file
+        self.__file = None
+        self.__thread = None
+        self.__closed = False
+        self.__local = threading.local()  # per thread: depth of deferred() blocks
+
+    # Replays the journal, compacts it and starts the commit thread. Returns the queues it describes.
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        for record in self.read():
+            applyRecord(self.queues, record)
+        self.__rewrite(self.__snapshot())
+        self.__file = open(self.path, "ab")
+        self.__thread = threading.Thread(target=self.__run, daemon=True, name="queue-journal")
+        self.__thread.start()
+        return self.getQueues()
+
+    # Records in the file, oldest first. A torn last line from a crash mid-write is ignored.
+    def read(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    break
+
+    # {printer: [(job id, priority)]} in queue order
+    def getQueues(self):
+        with self.__condition:
+            return {printer: [(job, queue.getPriority(job)) for job in queue.getQueue()]
+                    for printer, queue in self.queues.items() if queue.getSize()}
+
+    # Adds a record and returns its sequence number. With wait=True (the default) this returns once
+    # the record is on disk, unless the calling thread is inside deferred(). Raises JournalError if
+    # the record couldn't be written.
+    def append(self, record, wait=True):
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        with self.__condition:
+            if self.__closed or self.__thread is None:
+                raise Exception("Queue journal is not open.")
+            applyRecord(self.queues, record)
+            self.__pending.append(line)
+            self.__appended += 1
+            sequence = self.__appended
+            self.__condition.notify_all()
+            if wait:
+                self.__commit(sequence)
+        return sequence
+
+    # Waits for a record appended with wait=False, like append() would have. Callers that hold a
+    # lock while appending release it before they wait here.
+    def commit(self, sequence):
+        with self.__condition:
+            self.__commit(sequence)
+
+    def __commit(self, sequence):
+        if not getattr(self.__local, "depth", 0):
+            self.__waitFor(sequence)
+
+    def __waitFor(self, sequence):
+        while self.__committed < sequence and not self.__closed:
+            self.__condition.wait()
+        if self.__durable < sequence and self.__error is not None:
+            raise JournalError(f"Queue journal write failed: {self.__error}")
+
+    # Waits until everything appended so far is on disk
+    def sync(self):
+        with self.__condition:
+            self.__waitFor(self.__appended)
+
+    # Appends from this thread inside the block don't wait for their own commit. Leaving the block
+    # waits once for all of them, so a bulk change costs one or two fsyncs instead of one per record.
+    @contextmanager
+    def deferred(self):
+        self.__local.depth = getattr(self.__local, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            self.__local.depth -= 1
+            if self.__local.depth == 0:
+                self.sync()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__pending and not self.__closed:
+                    self.__condition.wait()
+                if not self.__pending:
+                    break
+                batch, self.__pending = self.__pending, []
+                sequence = self.__appended
+                snapshot = None
+                if self.__rewriteNeeded or self.__records + len(batch) > self.compactAfter:
+                    snapshot = self.__snapshot()  # already includes this batch
+            error = None
+            try:
+                if snapshot is not None:
+                    self.__file.close()
+                    self.__rewrite(snapshot)
+                    self.__file = open(self.path, "ab")
+                else:
+                    self.__file.write(b"".join(batch))
+                    self.__file.flush()
+                    os.fsync(self.__file.fileno())
+                    self.__records += len(batch)
+                self.commits += 1
+            except OSError as e:
+                error = e
+                logger.error("Queue journal write failed", extra={"journal": self.path, "records": len(batch),
+                                                                  "error": str(e)})
+            with self.__condition:
+                self.__committed = sequence
+                if error is None:
+                    self.__durable = sequence
+                    self.__rewriteNeeded = False
+                else:
+                    self.__error = error
+                    self.__rewriteNeeded = True
+                self.__condition.notify_all()
+
+    # "add" records that rebuild the current queues
+    def __snapshot(self):
+        lines = []
+        for printer, queue in self.queues.items():
+            for job in queue.getQueue():
+                record = {"op": "add", "printer": printer, "job": job, "priority": queue.getPriority(job)}
+                lines.append(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        return lines
+
+    # Atomically replaces the file with `lines`
+    def __rewrite(self, lines):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.path)
+        directory = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.__records = len(lines)
+
+    # Flushes what's pending and stops the commit thread
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+        if self.__file is not None:
+            self.__file.close()
@@ -0,0 +1,81 @@
+from array import array
+import math
+
+
+# Fixed-size time series. Samples are stored in flat arrays of doubles (one per field plus one for
+# timestamps) that are allocated once and overwritten oldest-first, so memory never grows however
+# long the printer runs.
+class RingBuffer:
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.times = array("d", bytes(8 * capacity))
+        self.values = {field: array("d", bytes(8 * capacity)) for field in self.fields}
+        self.start = 0  # index of the oldest sample
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # Adds a sample. Fields missing from `values` are stored as NaN.
+    def append(self, timestamp, values):
+        index = (self.start + self.size) % self.capacity
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity  # overwrite the oldest
+        else:
+            self.size += 1
+        self.times[index] = timestamp
+        for field in self.fields:
+            self.values[field][index] = values.get(field, math.nan)
+
+    # indices of the samples at or after `since`, oldest first
+    def __indices(self, since=None):
+        indices = [(self.start + i) % self.capacity for i in range(self.size)]
+        if since is not None:
+            indices = [i for i in indices if self.times[i] >= since]
+        return indices
+
+    def getLatest(self):
+        if not self.size:
+            return None
+        index = (self.start + self.size - 1) % self.capacity
+        return self.__sample(index)
+
+    def __sample(self, index):
+        sample = {"time": self.times[index]}
+        for field in self.fields:
+            value = self.values[field][index]
+            sample[field] = None if math.isnan(value) else value
+        return sample
+
+    def getSamples(self, since=None):
+        return [self.__sample(i) for i in self.__indices(since)]
+
+    # Downsamples to one entry per `bucketSeconds`, with the min, mean and max of each field in
+    # the bucket. NaN (missing) values are left out.
+    def rollup(self, bucketSeconds, since=None):
+        buckets = []
+        current = None
+        for i in self.__indices(since):
+            bucket = math.floor(self.times[i] / bucketSeconds) * bucketSeconds
+            if current is None or current["time"] != bucket:
+                current = {"time": bucket, "samples": 0, "stats": {field: [math.inf, 0.0, -math.inf, 0] for field in self.fields}}
+                buckets.append(current)
+            current["samples"] += 1
+            for field in self.fields:
+                value = self.values[field][i]
+                if math.isnan(value):
+                    continue
+                stats = current["stats"][field]
+                stats[0] = min(stats[0], value)
+                stats[1] += value
+                stats[2] = max(stats[2], value)
+                stats[3] += 1
+
+        rollups = []
+        for bucket in buckets:
+            entry = {"time": bucket["time"], "samples": bucket["samples"]}
+            for field, (low, total, high, count) in bucket["stats"].items():
+                entry[field] = {"min": low, "avg": round(total / count, 3), "max": high} if count else None
+            rollups.append(entry)
+        return rollups
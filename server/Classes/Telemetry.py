@@ -0,0 +1,135 @@
+import os
+import re
+import time
+from itertools import islice
+from Classes.RingBuffer import RingBuffer
+from Classes.GcodeEstimator import GcodeEstimator, parseLine
+
+# seconds between temperature samples, and the M155 auto-report interval we ask the firmware for
+DEFAULT_INTERVAL = 2
+# seconds between position samples (M114 has no auto-report on most firmware)
+DEFAULT_POSITION_INTERVAL = 5
+# M114 is only sent mid-print with TELEMETRY_M114_WHILE_PRINTING=1. On Marlin 1.1.x and builds with
+# M114_LEGACY it waits for the planner to empty, which stops the print for a moment and leaves a
+# blob on the part. Otherwise positions during a print come from the streamed moves.
+POSITION_WHILE_PRINTING = os.environ.get("TELEMETRY_M114_WHILE_PRINTING", "0") == "1"
+# samples kept per printer: 2 hours of temperatures at the default interval
+DEFAULT_CAPACITY = 3600
+
+TEMPERATURE_FIELDS = ("hotend", "hotend_target", "bed", "bed_target")
+POSITION_FIELDS = ("x", "y", "z", "e")
+
+# "ok T:210.0 /210.0 B:60.0 /60.0 @:127 B@:0" (M105 or M155 auto-report). The lookbehind keeps
+# T0:/T1: and B@: from matching.
+HOTEND = re.compile(r"(?<![\w@])T:\s*(-?[\d.]+)\s*/\s*(-?[\d.]+)")
+BED = re.compile(r"(?<![\w@])B:\s*(-?[\d.]+)\s*/\s*(-?[\d.]+)")
+# "X:10.00 Y:20.00 Z:0.30 E:1.20 Count X:800 Y:1600 Z:120" (M114). Only the part before "Count".
+POSITION = re.compile(r"X:\s*(-?[\d.]+)\s+Y:\s*(-?[\d.]+)\s+Z:\s*(-?[\d.]+)\s+E:\s*(-?[\d.]+)")
+
+
+def parseTemperature(response):
+    hotend = HOTEND.search(response)
+    if hotend is None:
+        return None
+    sample = {"hotend": float(hotend.group(1)), "hotend_target": float(hotend.group(2))}
+    bed = BED.search(response)
+    if bed is not None:
+        sample["bed"] = float(bed.group(1))
+        sample["bed_target"] = float(bed.group(2))
+    return sample
+
+
+def parsePosition(response):
+    match = POSITION.match(response.split("Count", 1)[0].strip())
+    if match is None:
+        return None
+    return dict(zip(POSITION_FIELDS, map(float, match.groups())))
+
+
+# Temperatures and position for one printer. Fed every response line the streamer reads, so samples
+# arrive whether they were asked for (M105/M114) or pushed by the firmware (M155 auto-report).
+# Queries are only due when no sample has arrived recently, so a printer that auto-reports is never
+# polled for temperatures.
+class PrinterTelemetry:
+    def __init__(self, interval=DEFAULT_INTERVAL, positionInterval=DEFAULT_POSITION_INTERVAL,
+                 capacity=DEFAULT_CAPACITY, listener=None, positionWhilePrinting=POSITION_WHILE_PRINTING):
+        self.interval = interval
+        self.positionInterval = positionInterval
+        self.positionWhilePrinting = positionWhilePrinting
+        self.temperatures = RingBuffer(capacity, TEMPERATURE_FIELDS)
+        self.positions = RingBuffer(capacity, POSITION_FIELDS)
+        self.lastSample = {"M105": float("-inf"), "M114": float("-inf")}  # monotonic time of the last reading
+        self.lastQuery = {"M105": float("-inf"), "M114": float("-inf")}
+        self.listener = listener  # called with the fields of each new sample
+
+    # Parses one response line. Returns True if it carried telemetry.
+    def handle(self, response):
+        if "T:" in response:
+            sample = parseTemperature(response)
+            if sample is not None:
+                self.record("M105", self.temperatures, sample)
+                return True
+        if response.startswith("X:"):
+            sample = parsePosition(response)
+            if sample is not None:
+                self.record("M114", self.positions, sample)
+                return True
+        return False
+
+    def record(self, query, buffer, sample):
+        self.lastSample[query] = time.monotonic()
+        buffer.append(time.time(), sample)
+        if self.listener:
+            self.listener({field: round(value, 1) for field, value in sample.items()})
+
+    # A position worked out from the G-code sent (see StreamedPosition) rather than read with M114
+    def recordStreamedPosition(self, sample):
+        self.record("M114", self.positions, sample)
+
+    # Commands to send now to keep the samples fresh. Cheap enough to call between every line.
+    # `printing` leaves M114 out unless positionWhilePrinting is set.
+    def getQueries(self, now=None, printing=False):
+        now = time.monotonic() if now is None else now
+        queries = []
+        for query, interval in (("M105", self.interval), ("M114", self.positionInterval)):
+            if query == "M114" and printing and not self.positionWhilePrinting:
+                continue
+            # allow an auto-report to be a little late before falling back to polling
+            if now - self.lastSample[query] > interval * 1.5 and now - self.lastQuery[query] >= interval:
+                self.lastQuery[query] = now
+                queries.append(query)
+        return queries
+
+    def getLatest(self):
+        return {"temperatures": self.temperatures.getLatest(), "position": self.positions.getLatest()}
+
+    def getRollup(self, bucketSeconds, since=None):
+        return {
+            "temperatures": self.temperatures.rollup(bucketSeconds, since),
+            "positions": self.positions.rollup(bucketSeconds, since),
+        }
+
+
+# The position the head was sent to, from the G-code streamed so far, for printing printers that
+# aren't asked with M114. Lines are fed through a GcodeEstimator as the print goes, so each one is
+# parsed once. A resumed print starts from the saved state of the layer it resumed at.
+class StreamedPosition:
+    def __init__(self, gcode, start=0, layer=None):
+        self.gcode = gcode
+        self.line = start
+        self.estimator = GcodeEstimator()
+        if layer is not None:
+            self.estimator.position = {"X": layer["x"], "Y": layer["y"], "Z": layer["z"], "E": layer["e"]}
+            self.estimator.absolute = layer["absolute"]
+            self.estimator.absoluteE = layer["absolute_e"]
+
+    # The position after the lines before `line` have run
+    def advance(self, line):
+        if line > self.line:
+            for text in islice(self.gcode.iterFrom(self.line), line - self.line):
+                command, params = parseLine(text)
+                if command is not None:
+                    self.estimator.handle(command, params)
+            self.line = line
+        position = self.estimator.position
+        return {"x": position["X"], "y": position["Y"], "z": position["Z"], "e": position["E"]}
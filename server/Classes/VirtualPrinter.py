@@ -0,0 +1,479 @@
+import os
+import re
+import pty
+import sys
+import tty
+import time
+import heapq
+import random
+import itertools
+import threading
+import selectors
+import fcntl
+import struct
+import termios
+from collections import deque
+from Classes.ConnectionPool import BOOT_MESSAGE
+from Classes.MeatPack import MeatPackDecoder
+
+VIRTUAL_DESCRIPTION = "Virtual Printer"
+# Marlin prints a keepalive this often while a command blocks (G28, M109, a full planner)
+BUSY_INTERVAL = 2.0
+# flushes this soon after booting belong to the same open and don't reboot again
+REBOOT_DEBOUNCE = 0.5
+
+NUMBERED = re.compile(r"N(\d+)\s*(.*)$")
+# words with or without spaces between them, e.g. "G1X10Y10" from a MeatPack host
+WORD = re.compile(r"([A-Za-z])([-+]?[0-9.]*)")
+
+
+# XOR of every byte before the "*", as used by "N<n> <command>*<checksum>" lines
+def lineChecksum(data):
+    if isinstance(data, str):
+        data = data.encode("ascii")
+    checksum = 0
+    for byte in data:
+        checksum ^= byte
+    return checksum
+
+
+def parseParams(words):
+    params = {}
+    for word in words:
+        try:
+            params[word[0].upper()] = float(word[1:]) if len(word) > 1 else 0.0
+        except ValueError:
+            pass
+    return params
+
+
+# Shaped like serial.tools.list_ports.ListPortInfo so virtual printers list and register like real ones
+class VirtualPort:
+    def __init__(self, device, description, hwid):
+        self.device = device
+        self.description = description
+        self.hwid = hwid
+
+
+# One simulated Marlin board on a pseudo-terminal. The host opens `device` like any serial port.
+# Commands are processed one at a time: each is acknowledged with "ok" after `ackLatency`, moves
+# wait for room in a planner of `plannerDepth` moves that each take `moveTime` to run, and blocking
+# commands send "busy" keepalives. Numbered lines are checksummed, and a bad one is answered like
+# Marlin's FlushSerialRequestResend: the rest of the RX buffer is thrown away unanswered and the line
+# is asked for again. `resendRate` injects line noise and `haltRate` random kills (cleared with M999).
+# With `waitInterval` the idle board sends "wait" that often, like Marlin's NO_TIMEOUTS. With
+# `meatpack` the board decodes MeatPack like a Marlin build with MEATPACK_ON_SERIAL_PORT_1.
+# Everything runs on the farm's single event thread, so all methods must be called from there.
+class VirtualPrinter:
+    def __init__(self, farm, index, ackLatency=0.0, plannerDepth=16, moveTime=0.0, homeTime=0.0, heatTime=0.0,
+                 rxBufferSize=128, resendRate=0.0, haltRate=0.0, waitInterval=0.0, meatpack=False, seed=None):
+        self.farm = farm
+        self.index = index
+        self.ackLatency = ackLatency
+        self.plannerDepth = plannerDepth
+        self.moveTime = moveTime
+        self.homeTime = homeTime
+        self.heatTime = heatTime
+        self.rxBufferSize = rxBufferSize
+        self.resendRate = resendRate
+        self.haltRate = haltRate
+        self.waitInterval = waitInterval
+        self.supportsMeatpack = meatpack
+        self.meatpack = None  # MeatPackDecoder, replaced on every boot
+        self.random = random.Random(seed)
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)  # the slave end stays open so the pty outlives clients closing it
+        os.set_blocking(self.master, False)
+        # packet mode reports the host flushing its input, which pyserial does when it opens the port
+        fcntl.ioctl(self.master, termios.TIOCPKT, struct.pack("i", 1))
+        self.device = os.ttyname(self.slave)
+        self.hwid = f"VIRTUAL SER=VP{index:04d}"
+
+        self.rx = bytearray()
+        self.commands = deque()  # (line, bytes it took on the wire) received and not yet processed
+        self.pendingBytes = 0
+        self.busy = False
+        self.halted = False
+        self.planner = deque()  # end time of each move in the planner
+        self.lineNumber = 0  # last good line number
+        self.position = dict.fromkeys("XYZE", 0.0)
+        self.temperatures = {"T": [25.0, 0.0], "B": [25.0, 0.0]}  # heater: [current, target]
+        self.autoReport = 0.0
+        self.autoReportToken = 0
+        self.lastReceived = 0.0  # monotonic time the host last sent anything
+
+        # counters for load tests
+        self.received = 0
+        self.resends = 0
+        self.flushed = 0  # lines thrown away unanswered after a bad line
+        self.overflows = 0
+        self.bootedAt = 0.0
+        self.session = 0  # bumped on every boot so timers from before it are ignored
+
+        self.boot()
+        self.bootedAt = float("-inf")  # the first open must still reboot it
+
+    # Opening a real port toggles DTR and resets the board, which then prints "start"
+    def boot(self):
+        self.bootedAt = time.monotonic()
+        self.session += 1
+        self.busy = False
+        self.planner.clear()
+        self.rx.clear()
+        self.commands.clear()
+        self.pendingBytes = 0
+        self.halted = False
+        self.lineNumber = 0
+        self.meatpack = MeatPackDecoder() if self.supportsMeatpack else None
+        self.setAutoReport(0)
+        if self.waitInterval > 0:
+            self.farm.schedule(self.bootedAt + self.waitInterval, self.idleWait, self.session)
+        self.write(BOOT_MESSAGE)
+
+    def getPort(self):
+        return VirtualPort(self.device, VIRTUAL_DESCRIPTION, self.hwid)
+
+    def getStats(self):
+        return {"device": self.device, "received": self.received, "resends": self.resends,
+                "flushed": self.flushed, "overflows": self.overflows, "halted": self.halted}
+
+    def write(self, *lines):
+        data = "".join(line + "\n" for line in lines).encode("ascii")
+        try:
+            os.write(self.master, data)
+        except (BlockingIOError, OSError):
+            pass  # nobody is reading: output is lost, as on a real line
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def onReadable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        if not data:
+            return
+        self.lastReceived = time.monotonic()
+        if data[0] != 0:  # packet mode status byte instead of data
+            if data[0] & (termios.TIOCPKT_FLUSHREAD | termios.TIOCPKT_FLUSHWRITE) \
+                    and time.monotonic() - self.bootedAt > REBOOT_DEBOUNCE:
+                self.boot()
+            return
+        data = data[1:]
+        if self.meatpack is not None:
+            data, commands = self.meatpack.feed(data)
+            for _ in commands:
+                self.write(self.meatpack.report())
+        self.rx += data
+        while True:
+            end = self.rx.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(self.rx[:end + 1])
+            del self.rx[:end + 1]
+            # the RX buffer holds what came over the wire, which is less than the line if it was packed
+            size = self.meatpack.lineSizes.pop(0) if self.meatpack is not None else len(line)
+            self.commands.append((line, size))
+            self.pendingBytes += size
+        partial = self.meatpack.wireBytes if self.meatpack is not None else len(self.rx)
+        # a real RX ring buffer would have dropped characters here
+        if self.pendingBytes + partial > self.rxBufferSize:
+            self.overflows += 1
+        self.processNext()
+
+    def processNext(self):
+        while not self.busy and self.commands:
+            line, size = self.commands.popleft()
+            self.pendingBytes -= size
+            self.received += 1
+            if self.halted:
+                self.executeHalted(line)
+                continue
+            delay, responses, keepalive = self.execute(line.decode("ascii", errors="replace").strip())
+            delay += self.ackLatency
+            if delay <= 0:
+                self.write(*responses)
+                continue
+            self.busy = True
+            finishAt = time.monotonic() + delay
+            self.farm.schedule(finishAt, self.finish, self.session, responses)
+            if delay > BUSY_INTERVAL:
+                self.farm.schedule(time.monotonic() + BUSY_INTERVAL, self.keepalive, self.session, finishAt,
+                                   keepalive or "echo:busy: processing")
+
+    def finish(self, session, responses):
+        if session != self.session:
+            return
+        self.busy = False
+        self.write(*responses)
+        self.processNext()
+
+    def keepalive(self, session, finishAt, message):
+        if session == self.session and self.busy and time.monotonic() < finishAt:
+            self.write(message() if callable(message) else message)
+            self.farm.schedule(time.monotonic() + BUSY_INTERVAL, self.keepalive, session, finishAt, message)
+
+    def executeHalted(self, line):
+        if b"M999" in line:
+            self.halted = False
+            self.write(f"Resend: {self.lineNumber + 1}", "ok")
+
+    # Returns (seconds before the reply, reply lines, keepalive message)
+    def execute(self, text):
+        if text.startswith("N"):
+            error = self.checkLine(text)
+            if error is not None:
+                self.resends += 1
+                self.flushInput()
+                return 0.0, [f"Error:{error}, Last Line: {self.lineNumber}", f"Resend: {self.lineNumber + 1}", "ok"], None
+            number, text = NUMBERED.match(text).groups()
+            self.lineNumber = int(number)
+            text = text.rsplit("*", 1)[0].strip()
+        text = text.split(";", 1)[0].strip()
+        if not text:
+            return 0.0, ["ok"], None
+        if self.haltRate and self.random.random() < self.haltRate:
+            self.halted = True
+            return 0.0, ["Error:Printer halted. kill() called!"], None
+
+        words = ["".join(word) for word in WORD.findall(text)]
+        if not words:
+            return 0.0, ["ok"], None
+        command = words[0].upper()
+        params = parseParams(words[1:])
+        busy = "echo:busy: processing"
+        if command in ("G0", "G1", "G2", "G3"):
+            return self.queueMove(params), ["ok"], busy
+        if command == "G28":
+            for axis in "XYZ":
+                self.position[axis] = 0.0
+            return self.plannerIdleIn() + self.homeTime, ["ok"], busy
+        if command == "G4":
+            return self.plannerIdleIn() + params.get("P", 0.0) / 1000.0 + params.get("S", 0.0), ["ok"], busy
+        if command == "M400":
+            return self.plannerIdleIn(), ["ok"], busy
+        if command == "G92":
+            for axis in "XYZE":
+                if axis in params:
+                    self.position[axis] = params[axis]
+            return 0.0, ["ok"], None
+        if command in ("M104", "M109", "M140", "M190"):
+            heater = self.temperatures["T" if command in ("M104", "M109") else "B"]
+            heater[1] = params.get("S", params.get("R", heater[1]))
+            if command in ("M109", "M190"):
+                heater[0] = heater[1]  # reached once the wait is over
+                return self.heatTime, ["ok"], self.temperatureReport
+            return 0.0, ["ok"], None
+        if command == "M105":
+            return 0.0, ["ok " + self.temperatureReport()], None
+        if command == "M114":
+            position = " ".join(f"{axis}:{self.position[axis]:.2f}" for axis in "XYZE")
+            return 0.0, [f"{position} Count X:0 Y:0 Z:0", "ok"], None
+        if command == "M115":
+            return 0.0, [f"FIRMWARE_NAME:Marlin 2.1.2 (VirtualPrinter) PROTOCOL_VERSION:1.0 MACHINE_TYPE:{VIRTUAL_DESCRIPTION} EXTRUDER_COUNT:1",
+                         "Cap:AUTOREPORT_TEMP:1", "ok"], None
+        if command == "M155":
+            self.setAutoReport(params.get("S", 0.0))
+            return 0.0, ["ok"], None
+        if command == "M110":
+            if "N" in params:  # "N<n> M110" is already handled by the line number check
+                self.lineNumber = int(params["N"])
+            return 0.0, ["ok"], None
+        if command == "M112":
+            self.halted = True
+            return 0.0, ["Error:Printer halted. kill() called!"], None
+        return 0.0, ["ok"], None
+
+    # Marlin empties its RX buffer before asking for a line again, so the lines the host sent after
+    # the bad one get no reply at all. Lines that arrive later are answered with their own resend.
+    def flushInput(self):
+        self.flushed += len(self.commands)
+        self.commands.clear()
+        self.pendingBytes = 0
+        self.rx.clear()
+        if self.meatpack is not None:
+            self.meatpack.discardLine()
+
+    # "wait" while the command queue is empty and the host has sent nothing for `waitInterval`
+    def idleWait(self, session):
+        if session != self.session:
+            return
+        now = time.monotonic()
+        if not self.busy and not self.halted and not self.commands and now - self.lastReceived >= self.waitInterval:
+            self.write("wait")
+            self.lastReceived = now
+        self.farm.schedule(now + self.waitInterval, self.idleWait, session)
+
+    # Validates a numbered line. Returns the error message, or None if the line is good.
+    def checkLine(self, text):
+        match = NUMBERED.match(text)
+        if match is None:
+            return "Line Number is not Last Line Number+1"
+        number, rest = int(match.group(1)), match.group(2)
+        if number != self.lineNumber + 1 and "M110" not in rest:
+            return "Line Number is not Last Line Number+1"
+        if "*" not in text:
+            return "No Checksum with line number"
+        body, _, checksum = text.rpartition("*")
+        try:
+            if lineChecksum(body) != int(checksum):
+                return "checksum mismatch"
+        except ValueError:
+            return "checksum mismatch"
+        if self.resendRate and self.random.random() < self.resendRate:
+            return "checksum mismatch"  # simulated line noise
+        return None
+
+    def prunePlanner(self):
+        now = time.monotonic()
+        while self.planner and self.planner[0] <= now:
+            self.planner.popleft()
+        return now
+
+    # Adds a move to the planner. Returns how long the command blocks first: until the oldest move
+    # finishes if the planner is full.
+    def queueMove(self, params):
+        for axis in "XYZE":
+            if axis in params:
+                self.position[axis] = params[axis]
+        now = self.prunePlanner()
+        wait = 0.0
+        if len(self.planner) >= self.plannerDepth:
+            wait = self.planner[len(self.planner) - self.plannerDepth] - now
+        start = max(now + wait, self.planner[-1] if self.planner else now)
+        self.planner.append(start + self.moveTime)
+        return wait
+
+    def plannerIdleIn(self):
+        now = self.prunePlanner()
+        return self.planner[-1] - now if self.planner else 0.0
+
+    def temperatureReport(self):
+        (t, tTarget), (b, bTarget) = self.temperatures["T"], self.temperatures["B"]
+        return f"T:{t:.2f} /{tTarget:.2f} B:{b:.2f} /{bTarget:.2f} @:0 B@:0"
+
+    def setAutoReport(self, interval):
+        self.autoReport = interval
+        self.autoReportToken += 1  # stops the previous report loop
+        if interval > 0:
+            self.farm.schedule(time.monotonic() + interval, self.sendAutoReport, self.autoReportToken)
+
+    def sendAutoReport(self, token):
+        if token != self.autoReportToken or self.autoReport <= 0:
+            return
+        self.write(" " + self.temperatureReport())
+        self.farm.schedule(time.monotonic() + self.autoReport, self.sendAutoReport, token)
+
+
+# Runs any number of virtual printers on one thread: a selector over every pty plus a timer heap for
+# delayed acks, planner moves and auto-reports. 100 printers cost one thread.
+class VirtualPrinterFarm(threading.Thread):
+    def __init__(self, **defaults):
+        super().__init__(daemon=True, name="virtual-printer-farm")
+        self.defaults = defaults
+        self.printers = []
+        self.selector = selectors.DefaultSelector()
+        self.timers = []  # (time, counter, callback, args)
+        self.counter = itertools.count()
+        self.calls = deque()  # callbacks from other threads, run on the farm thread
+        self.wakeRead, self.wakeWrite = os.pipe()
+        os.set_blocking(self.wakeRead, False)
+        self.selector.register(self.wakeRead, selectors.EVENT_READ, None)
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    # Creates a printer. Safe to call from any thread; options override the farm defaults.
+    def spawn(self, **options):
+        with self.lock:
+            printer = VirtualPrinter(self, len(self.printers), **{**self.defaults, **options})
+            self.printers.append(printer)
+        self.callSoon(self.selector.register, printer.master, selectors.EVENT_READ, printer)
+        return printer
+
+    def callSoon(self, callback, *args):
+        self.calls.append((callback, args))
+        os.write(self.wakeWrite, b"\0")
+
+    # Only called from the farm thread
+    def schedule(self, when, callback, *args):
+        heapq.heappush(self.timers, (when, next(self.counter), callback, args))
+
+    def listPorts(self):
+        return [printer.getPort() for printer in self.printers]
+
+    def findPort(self, hwid):
+        for printer in self.printers:
+            if printer.hwid == hwid:
+                return printer.getPort()
+        return None
+
+    def run(self):
+        while not self.stopped:
+            timeout = None
+            if self.timers:
+                timeout = max(0.0, self.timers[0][0] - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        os.read(self.wakeRead, 4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    key.data.onReadable()
+            while self.calls:
+                callback, args = self.calls.popleft()
+                callback(*args)
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback, args = heapq.heappop(self.timers)
+                callback(*args)
+        for printer in self.printers:
+            printer.close()
+
+    def stop(self):
+        self.stopped = True
+        os.write(self.wakeWrite, b"\0")
+
+
+virtualFarm = None
+
+
+# Starts the shared farm with `count` printers (VIRTUAL_PRINTERS in app.py)
+def startVirtualFarm(count, **options):
+    global virtualFarm
+    if virtualFarm is None:
+        virtualFarm = VirtualPrinterFarm(**options)
+        virtualFarm.start()
+    for _ in range(count):
+        virtualFarm.spawn()
+    return virtualFarm
+
+
+# Virtual ports, listed alongside serial.tools.list_ports.comports()
+def listVirtualPorts():
+    return virtualFarm.listPorts() if virtualFarm is not None else []
+
+
+def findVirtualPort(hwid):
+    return virtualFarm.findPort(hwid) if virtualFarm is not None else None
+
+
+# python -m Classes.VirtualPrinter 100 [ackLatency]
+# Prints the device paths and keeps the printers running until interrupted.
+if __name__ == "__main__":
+    farm = startVirtualFarm(int(sys.argv[1]) if len(sys.argv) > 1 else 1,
+                            ackLatency=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
+    for port in farm.listPorts():
+        print(port.device, port.hwid)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        farm.stop()
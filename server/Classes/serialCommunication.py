@@ -1,6 +1,7 @@
 import serial
 import serial.tools.list_ports
 import time
+from Classes.GcodeStreamer import GcodeStreamer
 
     # Function to get a list of connected 3D prints.
 def get3DPrinterList():
@@ -28,26 +29,18 @@ def get3DPrinterList():
 def parseGcode(path):
     with open(path, "r") as g:
         # Replace file with the path to the file. "r" means read mode. 
-        for line in g:
-            #remove whitespace
-            line = line.strip() 
-            # Don't send empty lines and comments. ";" is a comment in gcode.
-            if len(line) == 0 or line.startswith(";"): 
-                continue
-            # Send the line to the printer.
-            sendGcode(line)
+        #remove whitespace
+        lines = (line.strip() for line in g)
+        # Don't send empty lines and comments. ";" is a comment in gcode.
+        # Stream the lines to the printer, keeping several commands in the printer's buffer.
+        stats = GcodeStreamer(ser).stream(line for line in lines if len(line) > 0 and not line.startswith(";"))
+    print(f"Streamed {stats.lines} lines ({stats.getLinesPerSecond():.1f} lines/s)")
 
 # Function to send gcode commands
 def sendGcode(message):
-    # Encode and send the message to the printer. 
-    ser.write(f"{message}\n".encode('utf-8'))
-    # Sleep the printer to give it enough time to get the instuction. 
-    time.sleep(0.1)
+    # Encode and send the message to the printer and wait for it to be acknowledged.
     # Save and print out the response from the printer. We can use this for error handling and status updates.
-    while True:
-        response = ser.readline().decode("utf-8").strip()
-        if "ok" in response:
-            break
+    response = GcodeStreamer(ser).send(message)
     print(f"Command: {message}, Recieved: {response}")
 
 # Function to reset the printer.
@@ -1,7 +1,14 @@
+import os
+import sys
+
+# the asyncio printer backend needs asyncio.timeout (3.11), see README
+if os.environ.get("PRINTER_BACKEND", "threaded") == "async" and sys.version_info < (3, 11):
+    raise Exception("PRINTER_BACKEND=async needs Python 3.11 or newer.")
+
 from flask import Flask, jsonify, request, Response, url_for
 from threading import Thread
+import atexit
 from flask_cors import CORS 
-import os 
 from models.db import db
 from models.printers import Printer
 from models.jobs import Job
@@ -9,15 +16,38 @@ from models.PrinterStatusService import PrinterStatusService
 from flask_migrate import Migrate
 from dotenv import load_dotenv
 from controllers.ports import getRegisteredPrinters
+from Classes.VirtualPrinter import startVirtualFarm
+from Classes.QueueJournal import QueueJournal
+from services.ingestService import IngestService
+from Classes.PrinterLog import setupLogging
+
+# uploads are analyzed in worker processes, started before the server starts any threads of its own
+ingest_service = IngestService()
+ingest_service.start()
+atexit.register(ingest_service.shutdown)
+
+# log records are written by a background thread, so printer threads never wait on stdout
+setupLogging()
+
+# VIRTUAL_PRINTERS=N simulates N Marlin printers on pseudo-terminals for load testing without hardware
+# (VIRTUAL_MEATPACK=1 builds them with MeatPack, VIRTUAL_WAIT_INTERVAL=s has idle ones send "wait")
+if int(os.environ.get("VIRTUAL_PRINTERS", "0")) > 0:
+    startVirtualFarm(int(os.environ["VIRTUAL_PRINTERS"]), ackLatency=float(os.environ.get("VIRTUAL_ACK_LATENCY", "0")),
+                     waitInterval=float(os.environ.get("VIRTUAL_WAIT_INTERVAL", "0")),
+                     meatpack=os.environ.get("VIRTUAL_MEATPACK") == "1")
 
 # moved this before importing the blueprints so that it can be accessed by the PrinterStatusService
-printer_status_service = PrinterStatusService()
+# PRINTER_BACKEND=async drives every printer from one asyncio event loop instead of a thread each
+# queued jobs are journaled so they survive a restart
+printer_status_service = PrinterStatusService(backend=os.environ.get("PRINTER_BACKEND", "threaded"), journal=QueueJournal())
+atexit.register(printer_status_service.shutdown) # stop printer workers cleanly on exit
 
 # IMPORTING BLUEPRINTS 
 from controllers.display import display_bp
 from controllers.ports import ports_bp
 from controllers.jobs import jobs_bp
 from controllers.statusService import status_bp, getStatus 
+from controllers.metrics import metrics_bp
 
 # Basic app setup 
 app = Flask(__name__)
@@ -39,12 +69,15 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db.init_app(app)
 
 migrate = Migrate(app, db)
+printer_status_service.init_app(app)
+ingest_service.init_app(app, printer_status_service)
 
 # # Register the display_bp Blueprint
 app.register_blueprint(display_bp)
 app.register_blueprint(ports_bp)
 app.register_blueprint(jobs_bp)
 app.register_blueprint(status_bp)
+app.register_blueprint(metrics_bp)
 
 # on server start, create a Printer object for each printer in the database and assign it to its 
 # own thread
@@ -54,7 +87,8 @@ with app.app_context():
         print(res)
         data = res[0].get_json() # converts to JSON 
         printers_data = data.get("printers", []) # gets the values w/ printer data
-        printer_status_service.create_printer_threads(printers_data)
+        printer_status_service.create_printer_threads(printers_data) # also picks up jobs that were queued before the restart
+        ingest_service.resume_pending() # and uploads that were still being analyzed
         
     except Exception as e:
         print(f"Unexpected error: {e}")
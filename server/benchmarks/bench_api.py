@@ -0,0 +1,90 @@
+# API latency as the tables grow. Runs the real app against a throwaway sqlite database.
+import io
+import os
+import sys
+import time
+import subprocess
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+from benchmarks.harness import benchmark
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REQUESTS = 20
+
+__app = None
+__jobRows = 0
+
+
+def getApp():
+    global __app
+    if __app is None:
+        # migrate before importing the app, which reads the printer table on import
+        subprocess.run([sys.executable, "-m", "flask", "--app", "app.py", "db", "upgrade"], cwd=SERVER_DIR,
+                       check=True, capture_output=True)
+        import app
+        __app = app
+    return __app
+
+
+# Grows the job table to `rows` rows (it only ever grows between sizes)
+def fillJobs(rows):
+    global __jobRows
+    app = getApp()
+    from models.db import db
+    from models.jobs import Job
+    from models.printers import Printer
+    with app.app.app_context():
+        if __jobRows == 0:
+            db.session.add(Printer(device="/dev/bench", description="bench", hwid="BENCH", name="bench", status="ready"))
+            db.session.commit()
+        start = datetime(2024, 1, 1)
+        db.session.execute(db.insert(Job), [
+            {"file_hash": f"{i:064x}", "file_size": 1000, "name": f"job {i}", "status": "complete",
+             "date": start + timedelta(minutes=i), "printer_id": 1}
+            for i in range(__jobRows, rows)
+        ])
+        db.session.commit()
+    __jobRows = max(__jobRows, rows)
+
+
+def latency(client, url):
+    times = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):  # some routes print their whole response
+            response = client.get(url)
+        times.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+@benchmark("api.getjobs", sizes=(1_000, 10_000, 100_000), repeat=1)
+def getJobs(rows):
+    fillJobs(rows)
+    from models.jobs import encodeCursor
+    client = getApp().app.test_client()
+    middle = encodeCursor(datetime(2024, 1, 1) + timedelta(minutes=rows // 2), rows // 2)
+    return {
+        "first_page_ms": latency(client, "/getjobs?limit=50"),
+        "deep_page_ms": latency(client, f"/getjobs?limit=50&cursor={middle}"),
+        "filtered_ms": latency(client, "/getjobs?limit=50&printerid=1&status=complete"),
+    }
+
+
+@benchmark("api.getprinterinfo", sizes=(10, 100, 1_000), repeat=1)
+def getPrinterInfo(printers):
+    app = getApp()
+    from models.printers import Printer
+    service = app.printer_status_service
+    saved = service.printer_threads
+    # stand-ins for worker threads: the route only reads thread.printer
+    service.printer_threads = [
+        SimpleNamespace(printer=Printer(device=f"/dev/bench{i}", description="bench", hwid=f"BENCH{i}", name=f"bench {i}", id=i))
+        for i in range(printers)
+    ]
+    try:
+        return {"median_ms": latency(app.app.test_client(), "/getprinterinfo")}
+    finally:
+        service.printer_threads = saved
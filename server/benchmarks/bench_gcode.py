@@ -0,0 +1,114 @@
+# G-code preprocessing: stripping and indexing, cached loads, print time estimation, optimization
+# and MeatPack packing
+import math
+import pathlib
+import time
+import random
+import tempfile
+from benchmarks.harness import benchmark, timed
+from Classes.GcodeBuffer import GcodeBuffer
+from Classes.GcodeEstimator import GcodeEstimator
+from Classes.GcodeOptimizer import optimizeBuffer, isAvailable
+from Classes.Job import Job
+from Classes.MeatPack import PackedGcode
+
+SAMPLE_DIR = tempfile.mkdtemp(prefix="bench-gcode-")
+__files = {}
+
+
+# A sliced-looking file with `lines` moves, plus comments and blank lines to strip
+def sampleFile(lines):
+    if lines not in __files:
+        rng = random.Random(lines)
+        path = pathlib.Path(SAMPLE_DIR, f"sample_{lines}.gcode")
+        with open(path, "w") as f:
+            f.write("; generated for benchmarks\nG90\nM82\nG28\nG92 E0\n")
+            e = 0.0
+            for i in range(lines):
+                if i % 50 == 0:
+                    f.write(f";LAYER:{i // 50}\nG1 Z{0.2 + 0.2 * (i // 50):.2f} F600\n\n")
+                e += rng.uniform(0.01, 0.1)
+                f.write(f"G1 X{rng.uniform(0, 200):.3f} Y{rng.uniform(0, 200):.3f} E{e:.5f} F1800 ; perimeter\n")
+        __files[lines] = path
+    return __files[lines]
+
+
+@benchmark("gcode.build", sizes=(10_000, 100_000))
+def build(lines):
+    path = sampleFile(lines)
+    cacheDir = tempfile.mkdtemp(dir=SAMPLE_DIR)  # cold: nothing cached yet
+    seconds = timed(GcodeBuffer.build, path, cacheDir)
+    return {"seconds": seconds, "lines_per_second": lines / seconds}
+
+
+# Job.loadGcode once the file has been preprocessed (another job or quantity > 1)
+@benchmark("gcode.load_cached", sizes=(100_000,))
+def loadCached(lines):
+    path = sampleFile(lines)
+    job = Job.__new__(Job)  # just the loader, without estimating
+    job.loadGcode(path).close()
+    seconds = timed(lambda: job.loadGcode(path).close())
+    return {"seconds": seconds}
+
+
+@benchmark("gcode.iterate", sizes=(100_000,))
+def iterate(lines):
+    gcode = GcodeBuffer.fromSource(sampleFile(lines))
+    seconds = timed(lambda: sum(1 for _ in gcode))
+    gcode.close()
+    return {"seconds": seconds, "lines_per_second": lines / seconds}
+
+
+@benchmark("gcode.estimate", sizes=(100_000,))
+def estimate(lines):
+    gcode = GcodeBuffer.fromSource(sampleFile(lines))
+    seconds = timed(GcodeEstimator().estimateLines, gcode)
+    gcode.close()
+    return {"seconds": seconds, "lines_per_second": lines / seconds}
+
+
+# Curved perimeters as slicers write them: circles of short segments, one per layer, with some
+# straight edges cut into pieces
+def curvedFile(lines):
+    key = ("curved", lines)
+    if key not in __files:
+        path = pathlib.Path(SAMPLE_DIR, f"curved_{lines}.gcode")
+        with open(path, "w") as f:
+            f.write("G90\nM83\nG28\nG92 E0\nG1 X60 Y100 F6000\n")
+            for i in range(lines):
+                if i % 200 == 0:
+                    f.write(f"G1 Z{0.2 + 0.2 * (i // 200):.2f} F600\nG1 X60 Y100 F6000\n")
+                step = i % 200
+                if step < 150:  # 150 segments around a circle of radius 40
+                    angle = math.pi + 2 * math.pi * (step + 1) / 150
+                    f.write(f"G1 X{100 + 40 * math.cos(angle):.3f} Y{100 + 40 * math.sin(angle):.3f} E0.05\n")
+                else:
+                    f.write(f"G1 X{60 - 0.5 * (step - 149):.3f} Y100 E0.02\n")
+        __files[key] = path
+    return __files[key]
+
+
+# needs numpy, like the optimizer
+if isAvailable():
+    @benchmark("gcode.optimize", sizes=(100_000,))
+    def optimize(lines):
+        gcode = GcodeBuffer.fromSource(curvedFile(lines), tempfile.mkdtemp(dir=SAMPLE_DIR))
+        start = time.perf_counter()
+        optimized, _ = optimizeBuffer(gcode)
+        seconds = time.perf_counter() - start
+        gcode.close()
+        optimized.close()
+        return {"seconds": seconds, "lines_per_second": lines / seconds}
+
+
+# Packing a job's lines for MeatPack printers, once at ingest. Reports how much the wire shrinks.
+@benchmark("gcode.pack", sizes=(100_000,))
+def pack(lines):
+    gcode = GcodeBuffer.fromSource(sampleFile(lines), tempfile.mkdtemp(dir=SAMPLE_DIR))
+    seconds = timed(PackedGcode.build, gcode)
+    packed = PackedGcode(gcode)
+    plain = sum(len(b"N%d %s" % (i + 1, line)) + 4 for i, line in enumerate(gcode))  # plus "*" and a checksum
+    result = {"seconds": seconds, "lines_per_second": lines / seconds, "wire_ratio": plain / packed.getSize()}
+    packed.close()
+    gcode.close()
+    return result
@@ -0,0 +1,53 @@
+# Queue operations on large queues
+import random
+from benchmarks.harness import benchmark, timed
+from Classes.Queue import Queue
+
+
+def filledQueue(size):
+    queue = Queue()
+    for job in range(size):
+        queue.addToBack(job)
+    return queue
+
+
+@benchmark("queue.add_remove", sizes=(10_000, 100_000))
+def addRemove(size):
+    queue = Queue()
+    def run():
+        for job in range(size):
+            queue.addToBack(job)
+        for _ in range(size):
+            queue.removeJob()
+    seconds = timed(run)
+    return {"seconds": seconds, "ops_per_second": 2 * size / seconds}
+
+
+@benchmark("queue.delete", sizes=(10_000, 100_000))
+def delete(size):
+    queue = filledQueue(size)
+    jobs = random.Random(size).sample(range(size), size // 2)
+    seconds = timed(lambda: [queue.deleteJob(job) for job in jobs])
+    return {"seconds": seconds, "ops_per_second": len(jobs) / seconds}
+
+
+@benchmark("queue.bump_extreme", sizes=(10_000, 100_000))
+def bumpExtreme(size):
+    queue = filledQueue(size)
+    jobs = random.Random(size).sample(range(size), 1_000)
+    seconds = timed(lambda: [queue.bumpExtreme(True, job) for job in jobs])
+    return {"seconds": seconds, "ops_per_second": len(jobs) / seconds}
+
+
+@benchmark("queue.bump", sizes=(10_000, 100_000))
+def bump(size):
+    queue = filledQueue(size)
+    jobs = random.Random(size).sample(range(size), 1_000)
+    seconds = timed(lambda: [queue.bump(True, job) for job in jobs])
+    return {"seconds": seconds, "ops_per_second": len(jobs) / seconds}
+
+
+@benchmark("queue.snapshot", sizes=(10_000, 100_000))
+def snapshot(size):
+    queue = filledQueue(size)
+    return {"seconds": timed(queue.getQueue)}
@@ -0,0 +1,31 @@
+# auto-placement of jobs on a farm
+import random
+from benchmarks.harness import benchmark, timed
+from Classes.PrinterList import PrinterList
+
+JOBS = 10_000
+
+
+class BenchJob:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def getEstimatedTime(self):
+        return self.seconds
+
+
+# PrinterList.autoQueue for JOBS jobs, finishing every other one as we go
+@benchmark("scheduler.autoQueue", sizes=(10, 100, 1_000))
+def autoQueue(printers):
+    printerList = PrinterList()
+    for id in range(printers):
+        printerList.addPrinter(f"/dev/bench{id}", id)
+    rng = random.Random(printers)
+    jobs = [BenchJob(rng.uniform(600, 36_000)) for _ in range(JOBS)]
+    def run():
+        for i, job in enumerate(jobs):
+            printer = printerList.autoQueue(job)
+            if i % 2:
+                printerList.jobFinished(printer, job)
+    seconds = timed(run)
+    return {"seconds": seconds, "assigns_per_second": JOBS / seconds}
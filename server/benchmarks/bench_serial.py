@@ -0,0 +1,60 @@
+# the serial send path, against a virtual printer on a pseudo-terminal
+import time
+import serial
+from benchmarks.harness import benchmark, timed
+from benchmarks.bench_gcode import sampleFile
+from Classes.GcodeStreamer import GcodeStreamer
+from Classes.VirtualPrinter import VirtualPrinterFarm
+from models.printers import Printer
+
+__farm = None
+
+
+def virtualPrinter():
+    global __farm
+    if __farm is None:
+        __farm = VirtualPrinterFarm()
+        __farm.start()
+    return __farm.spawn()
+
+
+def openPort():
+    ser = serial.Serial(virtualPrinter().device, 115200, timeout=1)
+    ser.readline()  # "start"
+    return ser
+
+
+@benchmark("serial.stream", sizes=(20_000,))
+def stream(lines):
+    ser = openPort()
+    gcode = [b"G1 X10.000 Y10.000 E0.12345 F1800"] * lines
+    seconds = timed(GcodeStreamer(ser).stream, gcode)
+    ser.close()
+    return {"seconds": seconds, "lines_per_second": lines / seconds}
+
+
+# round trip of one command waiting for its "ok"
+@benchmark("serial.ack_latency", sizes=(1_000,))
+def ackLatency(commands):
+    ser = openPort()
+    streamer = GcodeStreamer(ser)
+    latencies = []
+    for _ in range(commands):
+        start = time.perf_counter()
+        streamer.send(b"M105")
+        latencies.append(time.perf_counter() - start)
+    ser.close()
+    latencies.sort()
+    return {"p50_ms": latencies[len(latencies) // 2] * 1000, "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000}
+
+
+# Printer.parseGcode end to end: preprocess (cached after the first run) and stream through the pool
+@benchmark("serial.parseGcode", sizes=(20_000,))
+def parseGcode(lines):
+    port = virtualPrinter()
+    printer = Printer(device=port.device, description="bench", hwid=port.hwid, name="bench")
+    path = sampleFile(lines)
+    with printer.leaseSerial():
+        seconds = timed(printer.parseGcode, path)
+    printer.closeConnection()
+    return {"seconds": seconds, "lines_per_second": lines / seconds}
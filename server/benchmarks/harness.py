@@ -0,0 +1,97 @@
+# registry, runner and baseline comparison for the benchmarks in this folder
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+
+# every run is saved here (not committed); the baseline runs are compared against is committed
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# a metric this much worse than the baseline is a regression
+DEFAULT_THRESHOLD = 0.2
+
+BENCHMARKS = {}  # name: (function, sizes, repeat)
+
+
+# Registers a benchmark. The function takes a size (or nothing if `sizes` is None) and returns a
+# dict of metrics. Metrics ending in "_per_second" are better when higher, everything else (times,
+# latencies) when lower. Each size is run `repeat` times and the median of every metric is kept.
+def benchmark(name, sizes=None, repeat=3):
+    def register(function):
+        BENCHMARKS[name] = (function, sizes, repeat)
+        return function
+    return register
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def higherIsBetter(metric):
+    return metric.endswith("_per_second")
+
+
+def runBenchmarks(only=None):
+    results = {}
+    for name, (function, sizes, repeat) in BENCHMARKS.items():
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        for size in sizes or (None,):
+            label = name if size is None else f"{name}[{size}]"
+            runs = [function() if size is None else function(size) for _ in range(repeat)]
+            results[label] = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+            print(f"{label:<40} " + "  ".join(f"{metric}={formatValue(value)}" for metric, value in results[label].items()))
+    return results
+
+
+def formatValue(value):
+    return f"{value:.4g}" if isinstance(value, float) else str(value)
+
+
+def getCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def saveResults(results, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    report = {
+        "commit": getCommit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def loadResults(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+# Compares every metric found in both runs. Returns the regressions: (benchmark, metric, baseline, current, change).
+def compareResults(results, baseline, threshold=DEFAULT_THRESHOLD):
+    regressions = []
+    for label, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(label, {}).get(metric)
+            if not old or value is None:
+                continue
+            change = (value - old) / old
+            worse = -change if higherIsBetter(metric) else change
+            marker = "REGRESSION" if worse > threshold else ("improved" if worse < -threshold else "")
+            print(f"{label:<40} {metric:<24} {formatValue(old):>10} -> {formatValue(value):>10} {change:+7.1%} {marker}")
+            if worse > threshold:
+                regressions.append((label, metric, old, value, change))
+    return regressions
@@ -0,0 +1,60 @@
+# Runs the benchmarks, saves the results as JSON and compares them against a baseline.
+#
+#   cd server && python -m benchmarks.run                  # run everything, compare with baseline.json
+#   python -m benchmarks.run --only queue scheduler        # benchmarks whose names start with these
+#   python -m benchmarks.run --save-baseline               # make this run the new baseline
+#
+# Exits with status 1 if any metric regressed by more than --threshold.
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+# keep benchmark data out of the real cache, blob store and database
+WORK_DIR = tempfile.mkdtemp(prefix="filamentforge-bench-")
+os.environ["GCODE_CACHE_DIR"] = os.path.join(WORK_DIR, "cache")
+os.environ["GCODE_BLOB_DIR"] = os.path.join(WORK_DIR, "blobs")
+os.environ["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(WORK_DIR, "bench.db")
+
+from benchmarks.harness import RESULTS_DIR, BASELINE_PATH, DEFAULT_THRESHOLD, runBenchmarks, saveResults, loadResults, compareResults
+import benchmarks.bench_gcode
+import benchmarks.bench_serial
+import benchmarks.bench_queue
+import benchmarks.bench_scheduler
+import benchmarks.bench_api
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the G-code pipeline, queue, scheduler and API.")
+    parser.add_argument("--only", nargs="*", help="only run benchmarks whose names start with these prefixes")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="results file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="save this run as the baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    try:
+        results = runBenchmarks(args.only)
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    path = saveResults(results, os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json"))
+    print(f"\nResults saved to {path}")
+
+    if args.save_baseline:
+        saveResults(results, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against. Run with --save-baseline to create one.")
+        return 0
+    print(f"\nCompared with {args.baseline}:")
+    regressions = compareResults(results, loadResults(args.baseline), args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
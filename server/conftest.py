@@ -0,0 +1,14 @@
+import os
+import atexit
+import shutil
+import tempfile
+
+# keep test data out of the real cache, blob store, uploads, checkpoints and queue journal. Set
+# before anything imports the modules that read these.
+WORK_DIR = tempfile.mkdtemp(prefix="filamentforge-test-")
+os.environ["GCODE_CACHE_DIR"] = os.path.join(WORK_DIR, "cache")
+os.environ["GCODE_BLOB_DIR"] = os.path.join(WORK_DIR, "blobs")
+os.environ["GCODE_UPLOAD_DIR"] = os.path.join(WORK_DIR, "uploads")
+os.environ["PRINT_CHECKPOINT_DIR"] = os.path.join(WORK_DIR, "checkpoints")
+os.environ["QUEUE_JOURNAL"] = os.path.join(WORK_DIR, "queue.journal")
+atexit.register(shutil.rmtree, WORK_DIR, ignore_errors=True)
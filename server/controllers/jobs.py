@@ -1,35 +1,207 @@
 from flask import Blueprint, jsonify, request, make_response
+from datetime import datetime
 from models.jobs import Job
-from app import printer_status_service
+from Classes.ChunkedUpload import uploadStore, UploadOffsetMismatch
+from Classes.BlobStore import blobStore
+from app import printer_status_service, ingest_service
 
 # get data for jobs 
 jobs_bp = Blueprint("jobs", __name__)
 
+# query params (all optional): limit, cursor (next_cursor from the previous page), printerid,
+# status, since/until (ISO dates) and fields (comma separated column names)
 @jobs_bp.route('/getjobs', methods=["GET"])
 def getJobs(): 
     try:
-        res = Job.get_job_history()
+        args = request.args
+        try:
+            limit = args.get("limit", 50, type=int)
+            since = datetime.fromisoformat(args["since"]) if "since" in args else None
+            until = datetime.fromisoformat(args["until"]) if "until" in args else None
+            fields = args["fields"].split(",") if "fields" in args else None
+            res = Job.get_job_history(limit=limit, cursor=args.get("cursor"), printer_id=args.get("printerid", type=int),
+                                      status=args.get("status"), since=since, until=until, fields=fields)
+        except ValueError:
+            return jsonify({"error": "Invalid query parameters"}), 400
         return res 
     except Exception as e:
         print(f"Unexpected error: {e}")
         return jsonify({"error": "Unexpected error occurred"}), 500
 
-# add job to queue
+# add job to queue. The file is stored and the job id returned right away; the G-code is analyzed
+# in the background and the job is queued when that's done (see /ingeststatus). With
+# "optimize": true, short moves are merged into arcs and longer lines before printing, and
+# /ingeststatus reports how many lines that removed. "filament" (optional, e.g. "PLA") keeps an
+# auto-placed job off printers loaded with something else.
 @jobs_bp.route('/addjobtoqueue', methods=["POST"])
 def add_job_to_queue():
     try:
         data = request.get_json()
         file = data["file"]
         name = data["name"]
-        printerid= data["printerid"]
+        printerid = data.get("printerid") # no printer id: place the job automatically
+        if not isinstance(file, str):
+            return jsonify({"error": "file must be the G-code text."}), 400
+        if printerid is not None and printer_status_service.getPrinterThread(printerid) is None:
+            return jsonify({"error": "Printer not found."}), 404
         
-        job = Job(file, name, printerid)
-        threads = printer_status_service.getThreadArray()
-        printerobject = list(filter(lambda thread: thread.printer.id == printerid, threads))[0].printer
+        job = Job(file.encode("utf-8"), name, printerid, optimize=bool(data.get("optimize", False)), filament=data.get("filament"))
+        job.status = "uploaded"
+        job.save()
+        ingest_service.submit(job, printerid)
         
-        printerobject.getQueue().addToBack(job)
-        
-        return jsonify({"success": True, "message": "Job added to printer queue."}), 200
+        return jsonify({"success": True, "message": "Job uploaded.", "jobid": job.id}), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# Adds many jobs in one request: {"jobs": [{"name", "file" or "file_hash" (a file uploaded
+# before), "quantity" (copies, default 1), "priority" (optional integer, higher first, default 0),
+# "printerid" (optional), "optimize" and "filament" (optional, see /addjobtoqueue)}]}. The
+# rows are saved in one transaction. Each file is analyzed once and its copies are queued
+# together: on the given printer, or spread over the farm by the scheduler.
+@jobs_bp.route('/bulkaddjobs', methods=["POST"])
+def bulkAddJobs():
+    try:
+        entries = request.get_json()["jobs"]
+        checked = []
+        for number, entry in enumerate(entries, 1):
+            name = entry["name"]
+            printerid = entry.get("printerid")
+            quantity = entry.get("quantity", 1)
+            if not isinstance(quantity, int) or quantity < 1:
+                return jsonify({"error": f"Job {number}: quantity must be a positive integer."}), 400
+            if not isinstance(entry.get("priority", 0), int):
+                return jsonify({"error": f"Job {number}: priority must be an integer."}), 400
+            if printerid is not None and printer_status_service.getPrinterThread(printerid) is None:
+                return jsonify({"error": f"Job {number}: printer {printerid} not found."}), 404
+            if "file" in entry:
+                if not isinstance(entry["file"], str):
+                    return jsonify({"error": f"Job {number}: file must be the G-code text."}), 400
+                file_hash = file_size = None # stored once the whole batch is known to be valid
+            elif "file_hash" in entry:
+                file_hash, file_size = entry["file_hash"], Job.get_file_size(entry["file_hash"])
+                if file_size is None or not blobStore.exists(file_hash):
+                    return jsonify({"error": f"Job {number}: unknown file_hash."}), 400
+            else:
+                return jsonify({"error": f"Job {number}: file or file_hash is required."}), 400
+            checked.append((entry, name, printerid, quantity, file_hash, file_size))
+        # every entry is valid, so the files can go in the blob store without leaving orphans behind
+        groups = []
+        for entry, name, printerid, quantity, file_hash, file_size in checked:
+            if file_hash is None:
+                file_hash, file_size = blobStore.put(entry["file"].encode("utf-8"))
+            copies = []
+            for _ in range(quantity):
+                job = Job(None, name, printerid, file_hash=file_hash, file_size=file_size,
+                          optimize=bool(entry.get("optimize", False)), filament=entry.get("filament"),
+                          priority=entry.get("priority", 0))
+                job.status = "uploaded"
+                copies.append(job)
+            groups.append((copies, printerid))
+        Job.save_all([job for copies, _ in groups for job in copies])
+        for copies, printerid in groups:
+            ingest_service.submit_group(copies, printerid)
+        return jsonify({"success": True, "jobids": [[job.id for job in copies] for copies, _ in groups]}), 200
+    except KeyError as e:
+        return jsonify({"error": f"Missing field {e}"}), 400
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# Cancels, moves and reorders many queued jobs in one request and one transaction:
+# {"operations": [{"op": "cancel" | "move" | "front" | "back" | "up" | "down" | "priority",
+# "jobid", "printerid" (move), "priority" (priority)}]}, applied in order. If any operation is
+# invalid, none are applied.
+@jobs_bp.route('/bulkqueue', methods=["POST"])
+def bulkQueue():
+    try:
+        operations = request.get_json()["operations"]
+        try:
+            applied = printer_status_service.apply_queue_operations(operations)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"success": True, "applied": applied}), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# Chunked, resumable upload for large files, which never have to fit in memory. Start with
+# {"name", "size" (bytes), "printerid" (optional), "optimize" and "filament" (optional)}, then PUT the file's bytes in order to
+# /uploads/<id>?offset=<bytes already sent>, each chunk as the raw request body. After a failed
+# chunk, GET /uploads/<id> says where to carry on from. The job is created and analyzed as soon as
+# the last byte arrives; the response to that chunk has its id.
+@jobs_bp.route('/uploads', methods=["POST"])
+def createUpload():
+    try:
+        data = request.get_json()
+        printerid = data.get("printerid")
+        if printerid is not None and printer_status_service.getPrinterThread(printerid) is None:
+            return jsonify({"error": "Printer not found."}), 404
+        try:
+            upload = uploadStore.create(name=data["name"], size=data["size"], printerid=printerid,
+                                        optimize=bool(data.get("optimize", False)), filament=data.get("filament"))
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "name and size are required."}), 400
+        return jsonify(upload.getStatus()), 201
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+@jobs_bp.route('/uploads/<uploadid>', methods=["GET"])
+def getUpload(uploadid):
+    upload = uploadStore.get(uploadid)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(upload.getStatus()), 200
+
+@jobs_bp.route('/uploads/<uploadid>', methods=["PUT"])
+def appendUpload(uploadid):
+    try:
+        upload = uploadStore.get(uploadid)
+        if upload is None:
+            return jsonify({"error": "Upload not found"}), 404
+        try:
+            upload.append(request.args.get("offset", 0, type=int), request.stream)
+            if not upload.isComplete():
+                return jsonify(upload.getStatus()), 200
+            file_hash, file_size = upload.finish()
+        except UploadOffsetMismatch as e:
+            return jsonify({"error": str(e), **upload.getStatus()}), 409
+        except ValueError as e:
+            return jsonify({"error": str(e), **upload.getStatus()}), 400
+        uploadStore.remove(upload)
+        job = Job(None, upload.info["name"], upload.info["printerid"], file_hash=file_hash, file_size=file_size,
+                  optimize=upload.info.get("optimize", False), filament=upload.info.get("filament"))
+        job.status = "uploaded"
+        job.save()
+        ingest_service.submit(job, upload.info["printerid"])
+        return jsonify({**upload.getStatus(), "jobid": job.id}), 200
     except Exception as e:
         print(f"Unexpected error: {e}")
-        return jsonify({"error": "Unexpected error occurred"}), 500
\ No newline at end of file
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+@jobs_bp.route('/uploads/<uploadid>', methods=["DELETE"])
+def cancelUpload(uploadid):
+    upload = uploadStore.get(uploadid)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+    uploadStore.remove(upload)
+    return jsonify({"success": True, "message": "Upload cancelled."}), 200
+
+# where an uploaded job is in the pipeline: uploaded, analyzing (with stage and progress), inqueue
+# or failed (with the error)
+@jobs_bp.route('/ingeststatus', methods=["GET"])
+def getIngestStatus():
+    try:
+        jobid = request.args.get("jobid", type=int)
+        state = ingest_service.get_state(jobid)
+        if state is None: # not a recent upload, the database has its status
+            jobs = Job.load_jobs([jobid])
+            if not jobs:
+                return jsonify({"error": "Job not found"}), 404
+            state = {"id": jobid, "status": jobs[0].status}
+        return jsonify(state), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
@@ -0,0 +1,10 @@
+from flask import Blueprint, Response
+from Classes.Metrics import metrics
+
+metrics_bp = Blueprint("metrics", __name__)
+
+# Prometheus scrape endpoint: send rates, ack latency, read waits, queue waits, job durations,
+# reconnects and whether the printer workers are alive
+@metrics_bp.route("/metrics", methods=["GET"])
+def getMetrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
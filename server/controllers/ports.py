@@ -6,12 +6,13 @@ from flask_cors import cross_origin
 from sqlalchemy.exc import SQLAlchemyError
 from flask import Blueprint, jsonify, request, make_response
 from models.printers import Printer
+from Classes.PortRegistry import portRegistry
 
 ports_bp = Blueprint("ports", __name__)
 
 @ports_bp.route("/getports",  methods=["GET"])
 def getPorts():
-    ports = serial.tools.list_ports.comports()
+    ports = portRegistry.getPorts() # cached, includes virtual printers so they register like real ones
     printerList = []
     for port in ports:
         port_info = {
@@ -42,6 +43,7 @@ def registerPrinter():
         description: string; 
         hwid: string; 
         customname: string; 
+        filament?: string; 
     }
     """
     try: 
@@ -51,8 +53,10 @@ def registerPrinter():
         description = data['printer']['description']
         hwid = data['printer']['hwid']
         name = data['printer']['name']
+        filament = data['printer'].get('filament') # material loaded, optional
         
-        res = Printer.create_printer(device=device, description=description, hwid=hwid, name=name, status='ready')
+        res = Printer.create_printer(device=device, description=description, hwid=hwid, name=name, status='ready',
+                                     filament=filament)
         return res
     
     except Exception as e:
@@ -1,5 +1,6 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request, Response, stream_with_context
 from app import printer_status_service  # import the instance from app.py
+from services.statusStream import statusBroadcaster, eventStream
 
 status_bp = Blueprint("status", __name__)
 
@@ -15,5 +16,120 @@ def getOpenThreads():
 @status_bp.route('/getprinterinfo', methods=["GET"])
 def getPrinterInfo():
     printer_info = printer_status_service.retrieve_printer_info()  # call the method on the instance
-    print(printer_info)
-    return jsonify(printer_info)
\ No newline at end of file
+    return jsonify(printer_info)
+
+# Temperatures and position for a printer, downsampled. Query params: printerid, bucket (seconds per
+# rollup entry, default 60) and since (unix time).
+@status_bp.route('/printertelemetry', methods=["GET"])
+def getPrinterTelemetry():
+    try:
+        printerid = request.args.get("printerid", type=int)
+        bucket = request.args.get("bucket", 60, type=float)
+        since = request.args.get("since", type=float)
+        thread = printer_status_service.getPrinterThread(printerid)
+        if thread is None:
+            return jsonify({"error": "Printer not found"}), 404
+        if bucket <= 0:
+            return jsonify({"error": "bucket must be positive"}), 400
+        telemetry = thread.printer.getTelemetry()
+        return jsonify({"latest": telemetry.getLatest(), **telemetry.getRollup(bucket, since)}), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# Server-sent events instead of polling /getprinterinfo. The client gets a "snapshot" event with
+# every printer, then "update" events holding only the fields that changed, keyed by printer id.
+@status_bp.route('/printerstatus/stream', methods=["GET"])
+def streamPrinterStatus():
+    return Response(
+        stream_with_context(eventStream(statusBroadcaster)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, # don't let proxies buffer events
+    )
+
+# Resume the print a printer was running when it lost its connection or the server went down, from
+# the start of the layer it was on. {"printerid": id, "restart": true} prints the job from the
+# start instead.
+@status_bp.route('/resumeprint', methods=["POST"])
+def resumePrint():
+    try:
+        data = request.get_json()
+        printer = printer_status_service.resume_print(data["printerid"], data.get("restart", False))
+        if printer is None:
+            return jsonify({"error": "Printer not found"}), 404
+        return jsonify({"success": True, "message": "Print restarted." if data.get("restart") else "Print resuming."}), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# The last checkpoint of a printer's interrupted print, if it has one
+@status_bp.route('/printcheckpoint', methods=["GET"])
+def getPrintCheckpoint():
+    try:
+        printerid = request.args.get("printerid", type=int)
+        thread = printer_status_service.getPrinterThread(printerid)
+        if thread is None:
+            return jsonify({"error": "Printer not found"}), 404
+        job, checkpoint = thread.printer.getCheckpoint()
+        return jsonify({"checkpoint": checkpoint}), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# The last lines sent to and received from a printer, and the same from when its last print failed
+# (null if none has). Query params: printerid, limit (entries, default all that are kept).
+@status_bp.route('/printerexchanges', methods=["GET"])
+def getPrinterExchanges():
+    try:
+        printerid = request.args.get("printerid", type=int)
+        limit = request.args.get("limit", type=int)
+        thread = printer_status_service.getPrinterThread(printerid)
+        if thread is None:
+            return jsonify({"error": "Printer not found"}), 404
+        printer = thread.printer
+        return jsonify({"exchanges": printer.getExchanges().dump(limit), "last_failure": printer.getLastFailure()}), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# stop a printer's worker thread (cancels the current print)
+@status_bp.route('/stopprinter', methods=["POST"])
+def stopPrinter():
+    try:
+        printerid = request.get_json()["printerid"]
+        thread = printer_status_service.stop_printer_thread(printerid)
+        if thread is None:
+            return jsonify({"error": "Printer not found"}), 404
+        return jsonify({"success": True, "message": "Printer stopped."}), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# restart a printer's worker thread, re-initializing the printer
+@status_bp.route('/restartprinter', methods=["POST"])
+def restartPrinter():
+    try:
+        printerid = request.get_json()["printerid"]
+        thread = printer_status_service.restart_printer_thread(printerid)
+        if thread is None:
+            return jsonify({"error": "Printer not found"}), 404
+        return jsonify({"success": True, "message": "Printer restarted."}), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
+
+# {"printerid": id, "filament": "PLA"} after loading a spool. Auto-placed jobs that name a filament
+# only go to printers loaded with it; "filament": null takes any job.
+@status_bp.route('/setfilament', methods=["POST"])
+def setFilament():
+    try:
+        data = request.get_json()
+        thread = printer_status_service.set_filament(data["printerid"], data.get("filament") or None)
+        if thread is None:
+            return jsonify({"error": "Printer not found"}), 404
+        return jsonify({"success": True, "message": "Filament updated."}), 200
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return jsonify({"error": "Unexpected error occurred"}), 500
@@ -0,0 +1,58 @@
+"""move job G-code out of the job table into the blob store
+
+Revision ID: b5d20e8c41f7
+Revises: 7c1e9f3a2b64
+Create Date: 2026-10-18 10:03:48.551920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from Classes.BlobStore import blobStore
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d20e8c41f7'
+down_revision = '7c1e9f3a2b64'
+branch_labels = None
+depends_on = None
+
+job = sa.table('job',
+    sa.column('id', sa.Integer()),
+    sa.column('file', sa.LargeBinary()),
+    sa.column('file_hash', sa.String(length=64)),
+    sa.column('file_size', sa.Integer()),
+)
+
+
+def upgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('file_hash', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('file_size', sa.Integer(), nullable=True))
+
+    # copy every stored file into the blob store, one row at a time
+    connection = op.get_bind()
+    for row in connection.execute(sa.select(job.c.id)).fetchall():
+        data = connection.execute(sa.select(job.c.file).where(job.c.id == row.id)).scalar()
+        key, size = blobStore.put(data or b"")
+        connection.execute(job.update().where(job.c.id == row.id).values(file_hash=key, file_size=size))
+
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.alter_column('file_hash', existing_type=sa.String(length=64), nullable=False)
+        batch_op.alter_column('file_size', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_index(batch_op.f('ix_job_file_hash'), ['file_hash'], unique=False)
+        batch_op.drop_column('file')
+
+
+def downgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('file', sa.LargeBinary(), nullable=True))
+
+    connection = op.get_bind()
+    for row in connection.execute(sa.select(job.c.id, job.c.file_hash)).fetchall():
+        connection.execute(job.update().where(job.c.id == row.id).values(file=blobStore.read(row.file_hash)))
+
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.alter_column('file', existing_type=sa.LargeBinary(), nullable=False)
+        batch_op.drop_index(batch_op.f('ix_job_file_hash'))
+        batch_op.drop_column('file_size')
+        batch_op.drop_column('file_hash')
@@ -1,79 +1,533 @@
-from threading import Thread
+from threading import Thread, Condition, Event, current_thread
+from concurrent.futures import wait as wait_futures
+from contextlib import nullcontext
 from models.printers import Printer
+from models.jobs import Job
+from Classes.GcodeStreamer import StreamCancelled
+from Classes.AsyncTransport import EventLoopThread
+from Classes.PortRegistry import portRegistry
+from Classes.ConnectionPool import serialPool
+from Classes.Metrics import metrics, JOB_BUCKETS
+from services.schedulerService import FarmScheduler
+from services.statusStream import statusBroadcaster
+import asyncio
+import logging
 import serial
 import serial.tools.list_ports
 import time
+
+logger = logging.getLogger(__name__)
+
+# seconds between telemetry polls of idle printers
+PING_INTERVAL = 2
+# printers that are connected but not running a job
+IDLE_STATUSES = ("ready", "complete")
+
+QUEUE_WAIT = metrics.histogram("filamentforge_queue_wait_seconds", "Time from queueing a job to starting its print.",
+                               ("printer",), JOB_BUCKETS)
+JOB_DURATION = metrics.histogram("filamentforge_job_duration_seconds", "Time from starting a print to it ending.",
+                                 ("printer", "outcome"), JOB_BUCKETS)
+PRINTER_ERRORS = metrics.counter("filamentforge_printer_errors_total", "Printer workers stopped by an error.", ("printer",))
+
+
+# One worker per printer. The worker sleeps on a condition variable until the printer has something
+# to do, and is woken as soon as a job is queued or the printer's status changes.
 class PrinterThread(Thread):
     def __init__(self, printer, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.printer = printer
-        
+        self.condition = Condition()
+        self.stopped = False
+        self.daemon = True
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify()
+
+    # Asks the worker to exit. A print in progress is cancelled.
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.printer.cancelStream()
+
+    def isStopped(self):
+        return self.stopped
+
+
+# Worker for the asyncio backend. Same interface as PrinterThread, but the printer runs as a task
+# on the shared event loop instead of owning an OS thread.
+class AsyncPrinterWorker:
+    def __init__(self, printer, loop_thread):
+        self.printer = printer
+        self.loop_thread = loop_thread
+        self.event = None
+        self.stopped = False
+        self.future = None
+
+    def start(self, target):
+        async def run():
+            self.event = asyncio.Event()
+            await target(self)
+        self.future = self.loop_thread.submit(run())
+
+    def wake(self):
+        self.loop_thread.callSoon(self._set_event)
+
+    def _set_event(self):
+        if self.event is not None:
+            self.event.set()
+
+    def stop(self):
+        self.stopped = True
+        if self.future is not None:
+            self.future.cancel()
+
+    def isStopped(self):
+        return self.stopped
+
+    def join(self, timeout=None):
+        if self.future is not None:
+            wait_futures([self.future], timeout)
+
+    def is_alive(self):
+        return self.future is not None and not self.future.done()
+
+
 class PrinterStatusService:
-    def __init__(self):
+    # backend is "threaded" (one OS thread per printer, blocking pyserial) or "async" (every
+    # printer on one asyncio event loop)
+    def __init__(self, backend="threaded", journal=None):
         self.printer_threads = [] # array of printer threads
+        self.printer_index = {} # printer id: its thread, so lookups don't scan the array
+        self.journal = journal # QueueJournal that keeps printer queues across restarts
+        self.app = None # for database access from printer workers
+        self.backend = backend
+        self.scheduler = FarmScheduler() # places auto-queued jobs on the printer that will be free first
+        self.loop_thread = None
+        self.ping_stopped = Event()
+        portRegistry.addListener(self.remap_printer) # follow printers that come back on a different port
+        serialPool.resolver = portRegistry.findDevice
+        portRegistry.startMonitor()
+        self.ping_thread = None
+        self.register_metrics()
+        if backend == "async":
+            self.loop_thread = EventLoopThread()
+            self.loop_thread.start()
+
+    def init_app(self, app):
+        self.app = app
+
+    # Scrape-time metrics, read from the printers and their workers
+    def register_metrics(self):
+        def per_printer(value):
+            return lambda: {(thread.printer.getId(),): value(thread) for thread in list(self.printer_threads)}
+        metrics.callback("filamentforge_worker_up", "Whether the printer's worker is running.",
+                         per_printer(lambda thread: int(thread.is_alive())), labels=("printer",))
+        metrics.callback("filamentforge_ping_thread_up", "Whether the idle telemetry poller is running.",
+                         lambda: {(): int(self.ping_thread is not None and self.ping_thread.is_alive())})
+        metrics.callback("filamentforge_serial_connected", "Whether the printer's serial port is open.",
+                         per_printer(lambda thread: int(serialPool.isConnected(thread.printer.hwid))), labels=("printer",))
+        metrics.callback("filamentforge_serial_reconnects_total", "Times the printer's serial port was reopened.",
+                         per_printer(lambda thread: serialPool.getReconnects(thread.printer.hwid)),
+                         kind="counter", labels=("printer",))
+        metrics.callback("filamentforge_queue_length", "Jobs in the printer's queue.",
+                         per_printer(lambda thread: thread.printer.getQueue().getSize()), labels=("printer",))
+        metrics.callback("filamentforge_printer_status", "The printer's current status (1 for the status it's in).",
+                         lambda: {(thread.printer.getId(), thread.printer.getStatus()): 1 for thread in list(self.printer_threads)},
+                         labels=("printer", "status"))
+
+    # Called by a printer's worker as it starts printing `job`
+    def observe_print_start(self, printer, job):
+        queued_at = getattr(job, "queued_at", None) # unknown for jobs restored after a restart
+        if queued_at is not None:
+            job.queued_at = None # a resumed print doesn't count its wait again
+            QUEUE_WAIT.labels(printer.getId()).observe(max(0.0, time.time() - queued_at))
+        return time.monotonic()
+
+    def observe_print_end(self, printer, started, outcome):
+        if started is not None:
+            JOB_DURATION.labels(printer.getId(), outcome).observe(time.monotonic() - started)
 
     def start_printer_thread(self, printer):
-        thread = PrinterThread(printer, target=self.update_thread, args=(printer,)) 
-        thread.start()
+        thread = self.add_printer_worker(printer)
+        self.start_worker(thread)
         return thread
 
+    # Registers a worker for `printer` without starting it
+    def add_printer_worker(self, printer):
+        if self.journal is not None:
+            printer.getQueue().setJournal(self.journal, printer.getId())
+        self.scheduler.addPrinter(printer)
+        statusBroadcaster.publish(printer.getId(), **printer.getInfo())
+        for job in printer.getQueue().getQueue(): # jobs still queued from before a restart
+            self.scheduler.reserve(printer, job)
+        if self.backend == "async":
+            thread = AsyncPrinterWorker(printer, self.loop_thread)
+        else:
+            thread = PrinterThread(printer, target=self.update_thread, args=(printer,))
+        printer.setListener(thread.wake)
+        self.printer_index[printer.getId()] = thread
+        return thread
+
+    def start_worker(self, thread):
+        if self.backend == "async":
+            thread.start(self.update_async)
+        else:
+            thread.start()
+
     def create_printer_threads(self, printers_data):
         # all printer statuses intiialized to be 'online.' Instantly changes to 'ready' on initialization -- test with 'reset printer' command.
         for printer_info in printers_data:
+            port = portRegistry.findByHwid(printer_info["hwid"]) # device paths can change between runs
             printer = Printer(
                 id=printer_info["id"],
-                device=printer_info["device"],
+                device=port.device if port else printer_info["device"],
                 description=printer_info["description"],
                 hwid=printer_info["hwid"],
                 name=printer_info["name"],
+                filament=printer_info.get("filament"),
             )
-            print(printer.getId())
-            printer_thread = self.start_printer_thread(printer)  # creating a thread for each printer object
+            printer_thread = self.add_printer_worker(printer)  # creating a thread for each printer object
             self.printer_threads.append(printer_thread)
+        # the queues go back in before any worker runs: initializing a printer looks for an
+        # interrupted job in its queue to decide whether it's safe to home
+        try:
+            self.restore_queues()
+        except Exception as e:
+            logger.warning("Restoring queues failed", extra={"error": str(e)})
+        for printer_thread in self.printer_threads:
+            self.start_worker(printer_thread)
 
         # creating seperate thread to loop through all of the printer threads to ping them for print status
-        self.ping_thread = Thread(target=self.pingForStatus)
+        self.ping_thread = Thread(target=self.pingForStatus, daemon=True)
+        self.ping_thread.start()
+
+    # a printer has work when it needs initializing, has a print to resume, or is ready with jobs
+    # in its queue
+    def has_work(self, printer):
+        status = printer.getStatus()
+        if status in ("configuring", "resuming"):
+            return True
+        return status == "ready" and printer.getQueue().getSize() > 0
 
     def update_thread(self, printer):
+        thread = current_thread()
         while True:
-            time.sleep(2)
-            status = printer.getStatus()
-            # time sleep
-            if status == "configuring":
-                printer.initialize()  # code to change status from online -> ready on thread start
-            """
-            I guess we could only really get a status "error" when we ping it and it doesnt work. No reason to 
-            ping for error if its idle. 
-            """
-            queueSize = printer.getQueue().getSize()
-            if status == "ready" and queueSize > 0:
-                printer.printNextInQueue()
-        # this method will be called by the UI to get the printers that have a threads information
+            with thread.condition:
+                while not thread.isStopped() and not self.has_work(printer):
+                    thread.condition.wait()
+                if thread.isStopped():
+                    break
+            started = None
+            try:
+                status = printer.getStatus()
+                if status == "configuring":
+                    printer.initialize()  # code to change status from online -> ready on thread start
+                    if printer.hasCheckpoint(): # a print was cut short: wait to be told to resume it
+                        printer.setStatus("interrupted")
+                elif status in ("ready", "resuming") and printer.getQueue().getSize() > 0:
+                    started = self.observe_print_start(printer, printer.getQueue().getNext())
+                    job = printer.printNextInQueue(resume=status == "resuming")
+                    self.observe_print_end(printer, started, "complete")
+                    self.scheduler.release(printer, job)
+                    self.update_job_status(job, "complete")
+            except StreamCancelled:
+                self.observe_print_end(printer, started, "cancelled")
+                break
+            except Exception as e:
+                printer.recordFailure(e)
+                self.observe_print_end(printer, started, "error")
+                PRINTER_ERRORS.labels(printer.getId()).inc()
+                printer.disconnect()
+                printer.setStatus("error")
+        printer.closeConnection()
+
+    # asyncio version of update_thread, one task per printer on the shared event loop
+    async def update_async(self, worker):
+        printer = worker.printer
+        try:
+            while not worker.isStopped():
+                worker.event.clear()
+                if not self.has_work(printer):
+                    await worker.event.wait()
+                    continue
+                started = None
+                try:
+                    status = printer.getStatus()
+                    if status == "configuring":
+                        await printer.initializeAsync()
+                        # reads the checkpoint file, so it's kept off the event loop
+                        if await asyncio.get_running_loop().run_in_executor(None, printer.hasCheckpoint):
+                            printer.setStatus("interrupted")
+                    elif status in ("ready", "resuming") and printer.getQueue().getSize() > 0:
+                        started = self.observe_print_start(printer, printer.getQueue().getNext())
+                        job = await printer.printNextInQueueAsync(resume=status == "resuming")
+                        self.observe_print_end(printer, started, "complete")
+                        self.scheduler.release(printer, job)
+                        await asyncio.get_running_loop().run_in_executor(None, self.update_job_status, job, "complete")
+                except (asyncio.CancelledError, StreamCancelled):
+                    self.observe_print_end(printer, started, "cancelled")
+                    break
+                except Exception as e:
+                    printer.recordFailure(e)
+                    self.observe_print_end(printer, started, "error")
+                    PRINTER_ERRORS.labels(printer.getId()).inc()
+                    printer.disconnect()
+                    printer.setStatus("error")
+        finally:
+            printer.closeConnection()
+
+    # Stops the worker for a printer and waits for it to exit
+    def stop_printer_thread(self, printerid, timeout=5):
+        thread = self.getPrinterThread(printerid)
+        if thread is None:
+            return None
+        thread.stop()
+        thread.join(timeout)
+        thread.printer.setListener(None)
+        thread.printer.setStatus("offline")
+        self.scheduler.removePrinter(thread.printer)
+        self.printer_threads.remove(thread)
+        self.printer_index.pop(printerid, None)
+        return thread
+
+    # Restarts a printer's worker. The printer goes back through initialization.
+    def restart_printer_thread(self, printerid, timeout=5):
+        thread = self.stop_printer_thread(printerid, timeout)
+        if thread is None:
+            return None
+        printer = thread.printer
+        printer.setStatus("configuring")
+        new_thread = self.start_printer_thread(printer)
+        self.printer_threads.append(new_thread)
+        return new_thread
+
+    # Records the filament a printer has loaded. The scheduler only auto-places jobs that need a
+    # filament on printers loaded with it; None takes any job.
+    def set_filament(self, printerid, filament):
+        thread = self.getPrinterThread(printerid)
+        if thread is None:
+            return None
+        Printer.update_printer(printerid, filament=filament)
+        thread.printer.filament = filament
+        statusBroadcaster.publish(printerid, filament=filament)
+        return thread
+
+    def shutdown(self, timeout=5):
+        self.ping_stopped.set()
+        for thread in list(self.printer_threads):
+            thread.stop()
+        for thread in list(self.printer_threads):
+            thread.join(timeout)
+        self.printer_threads = []
+        self.printer_index = {}
+        if self.loop_thread is not None:
+            self.loop_thread.stop()
+        if self.journal is not None:
+            self.journal.close()
+
+    # Adds a job to a printer's queue. Without a printer id the scheduler picks the compatible
+    # printer expected to finish its current work first. Returns the printer, or None if no printer
+    # could take the job.
+    def queue_job(self, job, printerid=None):
+        return self.queue_jobs([job], printerid)[0]
+
+    # Queues many jobs with one database commit and one journal sync for the lot. Jobs placed by
+    # the scheduler are placed one after another, so copies of a part spread over whichever
+    # printers free up first. Returns the printer for each job, None where no printer could take it.
+    def queue_jobs(self, jobs, printerid=None):
+        placements = [self.place_job(job, printerid) for job in jobs]
+        queued = [(job, printer) for job, printer in zip(jobs, placements) if printer is not None]
+        # the rows are committed before the jobs are queued: the queue journal refers to them by id
+        for job, printer in queued:
+            job.printer_id = printer.getId()
+            job.status = "inqueue"
+            job.queued_at = time.time() # for the queue wait metric
+        Job.save_all([job for job, _ in queued])
+        with self.journaling():
+            for job, printer in queued:
+                printer.getQueue().addToBack(job)
+        for printer in {id(printer): printer for _, printer in queued}.values():
+            printer.notifyListener() # wakes the printer's worker
+        return placements
+
+    # Picks the printer for a job and reserves its time there
+    def place_job(self, job, printerid=None):
+        if printerid is None:
+            return self.scheduler.assign(job)
+        thread = self.getPrinterThread(printerid)
+        if thread is None:
+            return None
+        self.scheduler.reserve(thread.printer, job)
+        return thread.printer
+
+    # Queue changes made inside the block are synced to the journal once, at the end
+    def journaling(self):
+        return self.journal.deferred() if self.journal is not None else nullcontext()
+
+    # Applies a list of queue operations as one batch: every operation is checked before any is
+    # applied, the journal is synced once and the database is updated in one transaction.
+    # Each operation is a dict with "op" and "jobid":
+    #   cancel                          take the job out of its queue
+    #   move (printerid)                to the back of another printer's queue
+    #   front, back, up, down           reorder within its queue
+    #   priority (priority)             move to another priority level
+    # A job being printed can't be cancelled or moved. Raises ValueError for a bad batch.
+    def apply_queue_operations(self, operations):
+        located = {} # job id: (printer, job) for every queued job
+        for thread in self.printer_threads:
+            for job in thread.printer.getQueue().getQueue():
+                located[getattr(job, "id", None)] = (thread.printer, job)
+        plan = []
+        for number, operation in enumerate(operations, 1):
+            op, jobid = operation.get("op"), operation.get("jobid")
+            if jobid not in located:
+                raise ValueError(f"Operation {number}: job {jobid} is not queued.")
+            printer, job = located[jobid]
+            target = None
+            if op in ("cancel", "move") and self.is_printing(printer, job):
+                raise ValueError(f"Operation {number}: job {jobid} is printing.")
+            if op == "cancel":
+                del located[jobid]
+            elif op == "move":
+                thread = self.getPrinterThread(operation.get("printerid"))
+                if thread is None:
+                    raise ValueError(f"Operation {number}: printer {operation.get('printerid')} not found.")
+                target = thread.printer
+                located[jobid] = (target, job)
+            elif op == "priority":
+                if not isinstance(operation.get("priority"), int):
+                    raise ValueError(f"Operation {number}: priority must be an integer.")
+            elif op not in ("front", "back", "up", "down"):
+                raise ValueError(f"Operation {number}: unknown operation {op}.")
+            plan.append((op, printer, job, target, operation))
+
+        updates = {} # job id: database fields
+        touched = {}
+        with self.journaling():
+            for op, printer, job, target, operation in plan:
+                queue = printer.getQueue()
+                if op == "cancel":
+                    queue.deleteJob(job)
+                    self.scheduler.release(printer, job)
+                    updates.setdefault(job.id, {})["status"] = "cancelled"
+                elif op == "move":
+                    priority = queue.getPriority(job)
+                    queue.deleteJob(job)
+                    self.scheduler.release(printer, job)
+                    target.getQueue().addToBack(job, priority)
+                    self.scheduler.reserve(target, job)
+                    job.printer_id = target.getId()
+                    updates.setdefault(job.id, {})["printer_id"] = target.getId()
+                    touched[id(target)] = target
+                elif op in ("front", "back"):
+                    queue.bumpExtreme(op == "front", job)
+                elif op in ("up", "down"):
+                    queue.bump(op == "up", job)
+                elif op == "priority":
+                    queue.setPriority(job, operation["priority"])
+                touched[id(printer)] = printer
+        if updates:
+            Job.update_jobs(updates)
+        for printer in touched.values():
+            printer.notifyListener()
+        return len(plan)
+
+    # The job the printer's worker took to print. Other jobs can be reordered ahead of it, so it
+    # isn't necessarily at the front of the queue any more.
+    def is_printing(self, printer, job):
+        return printer.getPrintingJob() is job
+
+    # Refills printer queues from the journal after a restart, so queued work resumes without
+    # re-uploading. Jobs whose printer is gone are placed again by the scheduler.
+    def restore_queues(self):
+        if self.journal is None:
+            return
+        queues = self.journal.open()
+        jobs = {job.id: job for job in Job.load_jobs([jobid for entries in queues.values() for jobid, _ in entries])}
+        restored = 0
+        for printerid, entries in queues.items():
+            thread = self.getPrinterThread(printerid)
+            if thread is not None:
+                loaded = [(jobs[jobid], priority) for jobid, priority in entries if jobid in jobs]
+                thread.printer.getQueue().load(loaded)
+                for job, _ in loaded:
+                    self.scheduler.reserve(thread.printer, job)
+                thread.printer.notifyListener()
+                restored += len(loaded)
+                continue
+            for jobid, priority in entries:
+                job = jobs.get(jobid)
+                printer = self.scheduler.assign(job) if job is not None else None
+                if printer is None:
+                    continue # stays in the journal for next time
+                self.journal.append({"op": "delete", "printer": printerid, "job": jobid})
+                job.printer_id = printer.getId()
+                Job.update_job(jobid, printer_id=job.printer_id)
+                printer.getQueue().addToBack(job, priority)
+                printer.notifyListener()
+                restored += 1
+        logger.info("Restored queued jobs", extra={"jobs": restored, "journal": self.journal.path})
+
+    # Picks up a printer's interrupted print at the layer it was on. With restart=True the
+    # checkpoint is dropped and the job is printed again from the start instead.
+    def resume_print(self, printerid, restart=False):
+        thread = self.getPrinterThread(printerid)
+        if thread is None:
+            return None
+        printer = thread.printer
+        if printer.getStatus() == "printing":
+            raise ValueError("Printer is printing.")
+        if not printer.hasCheckpoint():
+            raise ValueError("Printer has no interrupted print.")
+        if restart:
+            printer.discardCheckpoint()
+            printer.setStatus("ready")
+        else:
+            printer.setStatus("resuming")
+        return printer
+
+    def update_job_status(self, job, status):
+        if self.app is None or getattr(job, "id", None) is None:
+            return
+        with self.app.app_context():
+            Job.update_job(job.id, status=status)
 
     # this method will be called by the UI to get the printers that have a threads information
     def retrieve_printer_info(self):
         printer_info_list = []
         for thread in self.printer_threads:
             printer = thread.printer  # get the printer object associated with the thread
-            printer_info = {
-                "device": printer.device,
-                "description": printer.description,
-                "hwid": printer.hwid,
-                "name": printer.name,
-                "status": printer.status,
-                "id": printer.id
-            }
-            printer_info_list.append(printer_info)
+            printer_info_list.append(printer.getInfo())
         return printer_info_list
 
+    # Telemetry for idle printers. Printing printers are sampled by their own stream, which
+    # interleaves the queries with the job.
     def pingForStatus(self):
-        """_summary_ psuedo code
-        for printer in threads:
-            status = printer.getStatus()
-            if status == printing:
-                GCODE for print status
-        """
-        pass
+        while not self.ping_stopped.wait(PING_INTERVAL):
+            portRegistry.refresh() # picks up printers that were replugged, if there's no hotplug monitor
+            for thread in list(self.printer_threads):
+                printer = thread.printer
+                if printer.getStatus() not in IDLE_STATUSES:
+                    continue
+                try:
+                    printer.pollTelemetry()
+                except Exception as e:
+                    logger.warning("Telemetry poll failed", extra={"printer": printer.getId(), "error": str(e)})
+
+    # A registered printer's hwid showed up on a different device. Its connection moves there the
+    # next time it's opened.
+    def remap_printer(self, hwid, device):
+        for thread in list(self.printer_threads):
+            printer = thread.printer
+            if printer.getHwid() == hwid and printer.getDevice() != device:
+                logger.info("Printer moved", extra={"printer": printer.getId(), "from": printer.getDevice(), "to": device})
+                printer.setDevice(device)
+                statusBroadcaster.publish(printer.getId(), **printer.getInfo())
 
     def getThreadArray(self):
         return self.printer_threads
+
+    def getPrinterThread(self, printerid):
+        return self.printer_index.get(printerid)
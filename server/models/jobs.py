@@ -1,47 +1,184 @@
 from models.db import db 
 from datetime import datetime
 from models.printers import Printer
-from sqlalchemy import Column, String, LargeBinary, DateTime, ForeignKey
+from sqlalchemy import Column, String, DateTime, ForeignKey, or_
 from sqlalchemy.orm import relationship
 from flask import jsonify 
 from sqlalchemy.exc import SQLAlchemyError
+from Classes.GcodeBuffer import GcodeBuffer
+from Classes.GcodeEstimator import estimateBuffer
+from Classes.GcodeOptimizer import optimizeBuffer
+from Classes.BlobStore import blobStore
+import json
+import base64
+
+# columns the job history API can return. id and date are always included (they form the cursor)
+HISTORY_FIELDS = ("id", "name", "status", "date", "printer_id", "printer_name", "file_hash", "file_size",
+                  "estimated_time", "filament_length", "optimize", "lines_removed", "filament")
+DEFAULT_HISTORY_FIELDS = ("id", "name", "status", "date", "printer_id", "printer_name")
+MAX_HISTORY_LIMIT = 500
+
+
+# Opaque keyset cursor: the (date, id) of the last row on the previous page
+def encodeCursor(date, id):
+    return base64.urlsafe_b64encode(f"{date.isoformat()},{id}".encode()).decode()
+
+
+def decodeCursor(cursor):
+    date, id = base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+    return datetime.fromisoformat(date), int(id)
 
 # model for job history table 
 class Job(db.Model):
+    __table_args__ = (
+        db.Index('ix_job_printer_id_date', 'printer_id', 'date'), # history for one printer, newest first
+        db.Index('ix_job_status', 'status'),
+        db.Index('ix_job_date_id', 'date', 'id'), # keyset pagination over the whole history
+    )
     id = db.Column(db.Integer, primary_key=True)
-    file = db.Column(db.LargeBinary, nullable=False)
+    # the G-code itself is kept in the content-addressed blob store, not in the row
+    file_hash = db.Column(db.String(64), nullable=False, index=True) # SHA-256 of the file
+    file_size = db.Column(db.Integer, nullable=False) # bytes
     name = db.Column(db.String(50), nullable = False)
     status = db.Column(db.String(50), nullable=False)
     date = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  
+    # computed once from the G-code at upload
+    estimated_time = db.Column(db.Float, nullable=True) # seconds
+    filament_length = db.Column(db.Float, nullable=True) # mm
+    layer_times = db.Column(db.Text, nullable=True) # JSON list of [z, seconds]
+    # print the file with short moves merged into arcs and longer lines (see GcodeOptimizer)
+    optimize = db.Column(db.Boolean, nullable=False, default=False)
+    lines_removed = db.Column(db.Integer, nullable=True) # by the optimizer
+    # material the job must be printed with, e.g. "PLA". None prints on any printer.
+    filament = db.Column(db.String(50), nullable=True)
+    # queue priority it was uploaded with (higher first), so an upload still being analyzed when
+    # the server restarts is queued at the same level. Once queued, the journal has the priority.
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     
-    # foregin key relationship to match jobs to the printer printed on 
-    printer_id = db.Column(db.Integer, db.ForeignKey('printer.id'), nullable = False)
+    # foregin key relationship to match jobs to the printer printed on. Empty until an
+    # auto-placed upload has been analyzed and given a printer.
+    printer_id = db.Column(db.Integer, db.ForeignKey('printer.id'), nullable = True)
     printer = db.relationship('Printer', backref='Job')
     
-    def __init__(self, file, name, printerid): 
-        self.file = file 
+    # file is the G-code contents (bytes or str) or a readable file, never a path. It is streamed
+    # into the blob store; uploading the same file again stores nothing new. For a file that is already in
+    # the blob store (a chunked upload), pass file=None and its file_hash and file_size instead.
+    def __init__(self, file, name, printerid, file_hash=None, file_size=None, optimize=False, filament=None, priority=0): 
+        if file is not None:
+            file_hash, file_size = blobStore.put(file)
+        self.file_hash, self.file_size = file_hash, file_size
         self.name = name 
         self.printer_id = printerid 
+        self.optimize = optimize
+        self.filament = filament
+        self.priority = priority
+        self.gcode = None
     
     def getPrinterId(self): 
         return self.printer_id
+
+    # Commits the row and detaches it, so printer workers can use it outside the request
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+        db.session.refresh(self)
+        db.session.expunge(self)
+        return self
+
+    # Size of a file other jobs were created from, or None if no job has used it
+    @classmethod
+    def get_file_size(cls, file_hash):
+        row = db.session.query(cls.file_size).filter_by(file_hash=file_hash).first()
+        return row.file_size if row is not None else None
+
+    # Inserts many jobs in one transaction. They're left detached like save() leaves them, with
+    # their ids set.
+    @classmethod
+    def save_all(cls, jobs):
+        db.session.add_all(jobs)
+        db.session.flush() # assigns the ids
+        for job in jobs:
+            db.session.expunge(job) # before the commit, which would expire them
+        db.session.commit()
+        return jobs
+
+    # Jobs by id, detached like save() leaves them
+    @classmethod
+    def load_jobs(cls, ids):
+        jobs = cls.query.filter(cls.id.in_(ids)).all() if ids else []
+        for job in jobs:
+            db.session.expunge(job)
+        return jobs
+
+    @classmethod
+    def load_jobs_with_status(cls, statuses):
+        jobs = cls.query.filter(cls.status.in_(statuses)).order_by(cls.id).all()
+        for job in jobs:
+            db.session.expunge(job)
+        return jobs
+
+    @classmethod
+    def update_job(cls, jobid, from_status=None, **fields): # jobid may be a list of ids
+        try:
+            query = cls.query.filter(cls.id.in_(jobid)) if isinstance(jobid, list) else cls.query.filter_by(id=jobid)
+            if from_status is not None: # only while the job is still in this state
+                query = query.filter_by(status=from_status)
+            query.update(fields)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            print(f"Database error: {e}")
+            db.session.rollback()
         
+    # {jobid: {column: value}} applied in one transaction
     @classmethod
-    def get_job_history(cls):
+    def update_jobs(cls, updates):
         try:
-            jobs = cls.query.all()
-            
-            jobs_data = [{
-                "file": jobs.file, 
-                "name": jobs.name, 
-                "status": jobs.status, 
-                "date": jobs.date, 
-                "printer": {
-                    "name": Printer.name
-                }
-            } for job in jobs]
-            
-            return jsonify({"jobs": jobs_data})
+            for jobid, fields in updates.items():
+                cls.query.filter_by(id=jobid).update(fields)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            print(f"Database error: {e}")
+            db.session.rollback()
+        
+    # Returns one page of job history, newest first. Pages are keyset-paginated on (date, id), so
+    # fetching any page costs the same no matter how deep into the history it is. Only the
+    # requested columns are selected.
+    @classmethod
+    def get_job_history(cls, limit=50, cursor=None, printer_id=None, status=None, since=None, until=None, fields=None):
+        try:
+            fields = [f for f in (fields or DEFAULT_HISTORY_FIELDS) if f in HISTORY_FIELDS]
+            columns = [cls.id, cls.date] + [
+                Printer.name.label("printer_name") if f == "printer_name" else getattr(cls, f)
+                for f in fields if f not in ("id", "date")
+            ]
+            query = db.session.query(*columns)
+            if "printer_name" in fields:
+                query = query.outerjoin(Printer, cls.printer_id == Printer.id)
+            if printer_id is not None:
+                query = query.filter(cls.printer_id == printer_id)
+            if status is not None:
+                query = query.filter(cls.status == status)
+            if since is not None:
+                query = query.filter(cls.date >= since)
+            if until is not None:
+                query = query.filter(cls.date < until)
+            if cursor is not None:
+                date, id = decodeCursor(cursor)
+                # the plain date bound lets the (date, id) index range-scan; the OR only breaks ties
+                query = query.filter(cls.date <= date, or_(cls.date < date, cls.id < id))
+
+            limit = max(1, min(limit, MAX_HISTORY_LIMIT))
+            rows = query.order_by(cls.date.desc(), cls.id.desc()).limit(limit + 1).all()
+            page = rows[:limit]
+
+            jobs_data = []
+            for row in page:
+                job = row._asdict()
+                if "printer_name" in job:
+                    job["printer"] = {"name": job.pop("printer_name")}
+                jobs_data.append(job)
+            next_cursor = encodeCursor(page[-1].date, page[-1].id) if len(rows) > limit else None
+            return jsonify({"jobs": jobs_data, "next_cursor": next_cursor})
         except SQLAlchemyError as e:
             print(f"Database error: {e}")
             return jsonify({"error": "Failed to retrieve jobs. Database error"}), 500
@@ -49,5 +186,56 @@ class Job(db.Model):
     def getName(self):
         return self.name
     
+    # reads the whole file into memory; printing streams it through getGcode() instead
     def getFile(self):
-        return self.file
\ No newline at end of file
+        return blobStore.read(self.file_hash)
+
+    def getFileHash(self):
+        return self.file_hash
+
+    def getOptimize(self):
+        return bool(self.optimize)
+
+    def getLinesRemoved(self):
+        return self.lines_removed
+
+    # Strips and indexes the G-code once (on upload). Every print of this job, and every other job
+    # with the same file, reuses the cached buffer instead of parsing the file again.
+    # Print time and filament use are estimated in the same step. With optimize on, the job prints
+    # (and is estimated from) the optimized buffer, which is cached the same way.
+    def preprocess(self):
+        self.gcode = GcodeBuffer.fromBlob(self.file_hash, blobStore)
+        if self.optimize:
+            source = self.gcode
+            self.gcode, report = optimizeBuffer(source)
+            if self.gcode is not source:
+                source.close()
+            self.lines_removed = report["lines_removed"]
+        self.setEstimate(estimateBuffer(self.gcode))
+        return self.gcode
+
+    def setEstimate(self, estimate):
+        self.estimated_time = estimate.total_time
+        self.filament_length = estimate.filament_length
+        self.layer_times = json.dumps(estimate.toDict()["layer_times"])
+        self.layer_index = estimate.layers # kept with the cached estimate, not in the database
+
+    def getEstimatedTime(self):
+        return self.estimated_time
+
+    def getFilamentLength(self):
+        return self.filament_length
+
+    def getLayerTimes(self):
+        return json.loads(self.layer_times) if self.layer_times else []
+
+    # where each layer starts in the G-code, for resuming an interrupted print
+    def getLayerIndex(self):
+        if getattr(self, "layer_index", None) is None:
+            self.preprocess()
+        return self.layer_index
+
+    def getGcode(self):
+        if getattr(self, "gcode", None) is None:
+            return self.preprocess()
+        return self.gcode
@@ -5,10 +5,28 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.exc import SQLAlchemyError
 from flask import jsonify
 from Classes.Queue import Queue
+from Classes.GcodeStreamer import GcodeStreamer, StreamMetrics, DEFAULT_MAX_COMMANDS
+from Classes.GcodeBuffer import GcodeBuffer, encodeNumbered
+from Classes.MeatPack import MEATPACK, PackedGcode, packNumbered
+from Classes.AsyncTransport import AsyncSerialConnection, AsyncGcodeStreamer
+from Classes.ConnectionPool import serialPool, ConnectionUnavailable
+from Classes.Telemetry import PrinterTelemetry, StreamedPosition, DEFAULT_INTERVAL
+from Classes.PrintCheckpoint import checkpointStore, Checkpointer, findLayer, resumePreamble
+from Classes.PrinterLog import CommandEcho, ExchangeRing
+from services.statusStream import statusBroadcaster
+from contextlib import contextmanager
+import asyncio
+import logging
+import pathlib
 import serial
 import serial.tools.list_ports
 import time
 
+logger = logging.getLogger(__name__)
+
+# how often print progress is pushed to status subscribers, in seconds
+PROGRESS_INTERVAL = 1.0
+
 
 # model for Printer table
 class Printer(db.Model):
@@ -19,15 +37,30 @@ class Printer(db.Model):
     name = db.Column(db.String(50), nullable=False)
     status = None  # default setting on printer start. Runs initialization and status switches to "ready" automatically.
     date = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    queue = Queue()
+    # material loaded, e.g. "PLA". Auto-placed jobs that need a different one go elsewhere.
+    filament = db.Column(db.String(50), nullable=True)
+    queue = None
     ser = None
+    streamer = None
+    conn = None  # AsyncSerialConnection when the printer runs on the asyncio backend
+    asyncStreamer = None
+    listener = None  # called whenever the status or queue changes, so the printer's worker wakes up
+    telemetry = None
+    streamMetrics = None
+    exchanges = None  # ExchangeRing of the last lines sent and received
+    commandEcho = None
+    lastFailure = None  # what the printer was doing when its last print failed
+    meatpack = False  # the firmware answered the MeatPack query, so jobs are streamed packed
+    printingJob = None  # the job being printed. It stays queued until it's done, not necessarily at the front.
 
-    def __init__(self, device, description, hwid, name, status='configuring', id=None):
+    def __init__(self, device, description, hwid, name, status='configuring', id=None, filament=None):
         self.device = device
         self.description = description
         self.hwid = hwid
         self.name = name
         self.status = status
+        self.filament = filament
+        self.queue = Queue() # each printer needs its own queue, not one shared by the class
         if id is not None:
             self.id = id
 
@@ -44,7 +77,7 @@ class Printer(db.Model):
             return None
 
     @classmethod
-    def create_printer(cls, device, description, hwid, name, status):
+    def create_printer(cls, device, description, hwid, name, status, filament=None):
         printerExists = cls.searchByDevice(hwid)
         if printerExists:
             return {"success": False, "message": "Printer already registered."}
@@ -56,6 +89,7 @@ class Printer(db.Model):
                     hwid=hwid,
                     name=name,
                     status=status,
+                    filament=filament,
                 )
                 db.session.add(printer)
                 db.session.commit()
@@ -67,6 +101,15 @@ class Printer(db.Model):
                     500,
                 )
 
+    @classmethod
+    def update_printer(cls, printerid, **fields):
+        try:
+            cls.query.filter_by(id=printerid).update(fields)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            print(f"Database error: {e}")
+            db.session.rollback()
+
     @classmethod
     def get_registered_printers(cls):
         try:
@@ -83,6 +126,7 @@ class Printer(db.Model):
                     "name": printer.name,
                     "status": printer.status,
                     "date": printer.date,
+                    "filament": printer.filament,
                 }
                 for printer in printers
             ]
@@ -100,7 +144,15 @@ class Printer(db.Model):
     def getDevice(self):
         return self.device
 
+    def setDevice(self, device):
+        self.device = device
+
+    def getHwid(self):
+        return self.hwid
+
     def getQueue(self):
+        if self.queue is None: # printers loaded from the database don't go through __init__
+            self.queue = Queue()
         return self.queue
 
     def getStatus(self):
@@ -109,89 +161,373 @@ class Printer(db.Model):
     def getName(self):
         return self.name
 
+    def getFilament(self):
+        return self.filament
+
+    def getPrintingJob(self):
+        return self.printingJob
+
     def getSer(self):
         return self.ser
     
     def getId(self):
         return self.id
 
+    def getStreamer(self):
+        # the streamer is bound to the current serial handle
+        if self.streamer is None or self.streamer.ser is not self.ser:
+            self.streamer = GcodeStreamer(self.ser, telemetry=self.getTelemetry(), metrics=self.getStreamMetrics(),
+                                          exchanges=self.getExchanges(), printer=self.id)
+        return self.streamer
+
+    def getStreamMetrics(self):
+        if self.streamMetrics is None:
+            self.streamMetrics = StreamMetrics(self.id)
+        return self.streamMetrics
+
+    def getExchanges(self):
+        if self.exchanges is None:
+            self.exchanges = ExchangeRing()
+        return self.exchanges
+
+    def getCommandEcho(self):
+        if self.commandEcho is None:
+            self.commandEcho = CommandEcho(logger)
+        return self.commandEcho
+
+    # Keeps the last exchanges with the printer from when a print failed, for the API to show
+    def recordFailure(self, error):
+        exchanges = self.getExchanges().dump()
+        self.lastFailure = {"time": time.time(), "error": str(error), "status": self.status, "exchanges": exchanges}
+        logger.error("Printer failed", extra={"printer": self.id, "error": str(error), "last_exchanges": exchanges[-10:]})
+
+    def getLastFailure(self):
+        return self.lastFailure
+
+    # created on first use: printers loaded from the database don't go through __init__
+    def getTelemetry(self):
+        if self.telemetry is None:
+            self.telemetry = PrinterTelemetry(listener=self.publishTelemetry)
+        return self.telemetry
+
+    def publishTelemetry(self, fields):
+        statusBroadcaster.publish(self.id, **fields)
+
+    # Reads temperatures and position while the printer is idle. Only uses a connection that is
+    # already open and not leased, so it never resets a board or gets in the way of a job.
+    def pollTelemetry(self):
+        if not serialPool.isConnected(self.hwid):
+            return
+        try:
+            with serialPool.lease(self.hwid, self.device, timeout=0) as ser:
+                streamer = GcodeStreamer(ser, telemetry=self.getTelemetry(), metrics=self.getStreamMetrics(),
+                                         exchanges=self.getExchanges(), printer=self.id)
+                while ser.in_waiting: # auto-reports that arrived since the last poll
+                    streamer.readResponse()
+                for query in self.getTelemetry().getQueries():
+                    streamer.send(query)
+        except ConnectionUnavailable:
+            pass
+
     def setSer(self, port):
         self.ser = port
 
     def setStatus(self, newStatus):
         self.status = newStatus
+        statusBroadcaster.publish(self.id, status=newStatus)
+        self.notifyListener()
+
+    # fields shown on the dashboard, sent in full to new status subscribers
+    def getInfo(self):
+        return {
+            "device": self.device,
+            "description": self.description,
+            "hwid": self.hwid,
+            "name": self.name,
+            "status": self.status,
+            "id": self.id,
+            "filament": self.filament,
+        }
+
+    # Numbered, checksummed G-code lines from line `start`, publishing the fraction sent at most every
+    # PROGRESS_INTERVAL and handing each line number to the checkpointer, if there is one. Unless
+    # the firmware is polled with M114 mid-print, positions are worked out from the lines sent,
+    # a planner buffer behind the last one.
+    def trackProgress(self, gcode, start=0, checkpointer=None, packed=None):
+        total = len(gcode)
+        nextUpdate = 0.0
+        telemetry = self.getTelemetry()
+        position = None
+        if not telemetry.positionWhilePrinting:
+            # a resumed print starts at a layer, with the state the checkpointer's layer index saved
+            layer = findLayer(checkpointer.layers, start) if checkpointer is not None and start else None
+            position = StreamedPosition(gcode, start, layer)
+        nextPosition = 0.0
+        statusBroadcaster.publish(self.id, progress=round(start / total, 4) if total else 0.0)
+        # lines are numbered as in the file, from here
+        if packed is not None:
+            yield start, packNumbered(start, b"M110"), b"M110\n"
+        else:
+            yield start, encodeNumbered(start, b"M110")
+        lines = packed.iterNumbered(start) if packed is not None else gcode.iterNumbered(start)
+        for sent, line in enumerate(lines, start):
+            now = time.monotonic()
+            if now >= nextUpdate:
+                statusBroadcaster.publish(self.id, progress=round(sent / total, 4))
+                nextUpdate = now + PROGRESS_INTERVAL
+            if checkpointer is not None:
+                checkpointer.update(sent)
+            if position is not None and now >= nextPosition:
+                telemetry.recordStreamedPosition(position.advance(max(start, sent - DEFAULT_MAX_COMMANDS)))
+                nextPosition = now + telemetry.positionInterval
+            yield line
+        statusBroadcaster.publish(self.id, progress=1.0)
+
+    # The job whose print was cut short and its last checkpoint, if that job is still queued here.
+    # (None, None) otherwise.
+    def getCheckpoint(self):
+        checkpoint = checkpointStore.load(self.id)
+        if checkpoint is None or checkpoint["job"] is None:
+            return None, None
+        for job in self.getQueue().getQueue():
+            if getattr(job, "id", None) == checkpoint["job"]:
+                return job, checkpoint
+        return None, None
+
+    def hasCheckpoint(self):
+        return self.getCheckpoint()[0] is not None
+
+    def discardCheckpoint(self):
+        checkpointStore.clear(self.id)
+
+    # `loop` writes the checkpoints on that event loop's executor (see Checkpointer)
+    def createCheckpointer(self, job, gcode, loop=None):
+        # lines still in the firmware's buffers when a checkpoint is written may never have run
+        return Checkpointer(checkpointStore, self.id, job, gcode, job.getLayerIndex(),
+                            telemetry=self.getTelemetry(), inFlight=DEFAULT_MAX_COMMANDS, loop=loop)
+
+    # Where to pick `job` up again: the first line of the layer the checkpoint is on, and the
+    # G-code that restores the printer's state there. Before the first layer it starts over.
+    def getResumePoint(self, job, checkpoint):
+        if checkpoint["file_hash"] != job.getGcode().getKey(): # optimized jobs print their own buffer, with its own key
+            raise Exception("Checkpoint is for a different file.")
+        layer = findLayer(job.getLayerIndex(), checkpoint["line"])
+        if layer is None:
+            return 0, None
+        return layer["line"], resumePreamble(layer, checkpoint)
+
+    # The job to print next, its G-code and where to start: (job, gcode, first line, resume
+    # preamble or None). With resume=True an interrupted job comes first. Preprocessing the job
+    # can take a while, so the asyncio backend runs this on an executor.
+    def preparePrint(self, resume=False):
+        job, checkpoint = self.getCheckpoint() if resume else (None, None)
+        if job is None:
+            job = self.getQueue().getNext()
+        self.printingJob = job  # from here on it can't be cancelled or moved
+        gcode = job.getGcode()
+        start, preamble = self.getResumePoint(job, checkpoint) if checkpoint else (0, None)
+        return job, gcode, start, preamble
+
+    def setListener(self, listener):
+        self.listener = listener
 
+    def notifyListener(self):
+        if self.listener:
+            self.listener()
+
+    def addToQueue(self, job):
+        self.getQueue().addToBack(job)
+        self.notifyListener()
+
+    # Stops whatever is currently streaming to the printer
+    def cancelStream(self):
+        for streamer in (self.streamer, self.asyncStreamer):
+            if streamer:
+                streamer.cancel()
+
+    # Borrows the printer's long-lived serial handle from the connection pool. The port is only
+    # opened (and the board reset) the first time, or after the connection has been lost.
     def connect(self):
-        self.ser = serial.Serial(self.device, 115200, timeout=1)
+        if self.ser is None:
+            self.setSer(serialPool.acquire(self.hwid, self.device))
+            self.streamer = None
 
+    # Hands the serial handle back to the pool. The port itself stays open.
     def disconnect(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+            self.asyncStreamer = None
         if self.ser:
-            self.ser.close()
             self.setSer(None)
+            self.streamer = None
+            serialPool.release(self.hwid)
+
+    # Disconnects and closes the port for good (printer stopped or removed)
+    def closeConnection(self):
+        self.disconnect()
+        serialPool.close(self.hwid)
 
-    def reset(self, initializeStatus):
-        self.sendGcode("G28")
+    @contextmanager
+    def leaseSerial(self):
+        self.connect()
+        try:
+            yield self.ser
+        except (OSError, serial.SerialException):
+            serialPool.invalidate(self.hwid) # reconnect on the next lease
+            raise
+        finally:
+            self.disconnect()
+
+    # home=False leaves the axes alone, for a printer with an interrupted print on its bed
+    def reset(self, initializeStatus, home=True):
+        if home:
+            self.sendGcode("G28")
         self.sendGcode("G92 E0", initializeStatus)
 
     def parseGcode(self, path):
-        with open(path, "r") as g:
-            # Replace file with the path to the file. "r" means read mode.
-            for line in g:
-                # remove whitespace
-                line = line.strip()
-                # Don't send empty lines and comments. ";" is a comment in gcode.
-                if len(line) == 0 or line.startswith(";"):
-                    continue
-                # Send the line to the printer.
-                self.sendGcode(line, self.ser)
-
-    # Function to send gcode commands
+        # Blank lines and comments are stripped once and cached, so printing the same file again
+        # skips parsing.
+        return self.streamGcode(GcodeBuffer.fromSource(pathlib.Path(path)))
+
+    # Streams preprocessed G-code lines (a GcodeBuffer) to the printer, from line `start`. Printers
+    # that speak MeatPack get the packed lines made when the job was preprocessed.
+    def streamGcode(self, gcode, start=0, checkpointer=None):
+        packed = PackedGcode.fromBuffer(gcode) if self.meatpack else None
+        try:
+            stats = self.getStreamer().stream(self.trackProgress(gcode, start, checkpointer, packed), packed=packed is not None)
+        finally:
+            if packed is not None:
+                packed.close()
+        logger.info("Stream finished", extra={"printer": self.id, "packed": packed is not None, **stats.toDict()})
+        return stats
+
+    # Asks the firmware whether it speaks MeatPack, unless MEATPACK=0. Called on every initialize,
+    # since the board behind the port may have been swapped or reflashed.
+    def negotiatePacking(self):
+        self.meatpack = MEATPACK and self.getStreamer().queryPacking() is not None
+        if self.meatpack:
+            logger.info("Printer supports MeatPack, jobs will be sent packed", extra={"printer": self.id})
+
+    # Function to send a single gcode command and wait for the printer to acknowledge it
     def sendGcode(self, message, initializeStatus=False):
-        # Encode and send the message to the printer.
-        self.ser.write(f"{message}\n".encode("utf-8"))
-        # Sleep the printer to give it enough time to get the instuction.
-        time.sleep(0.1)
-        # Save and print out the response from the printer. We can use this for error handling and status updates.
-        while True:
-            response = self.ser.readline().decode("utf-8").strip()
-            if "ok" in response:
-                if initializeStatus == True:
-                    self.setStatus("ready")
-                break
-        print(f"Command: {message}, Recieved: {response}")
+        response = self.getStreamer().send(message)
+        if initializeStatus == True:
+            self.setStatus("ready")
+        self.getCommandEcho().log(self.id, message, response)
 
     def print_job(self, job):
         for line in job.gcode_lines:
             self.send_gcode(line)
 
-    def printNextInQueue(self):
-        job = self.getQueue().getNext()
-        file = job.getFile()
-        port = serial.Serial(
-            self.getDevice(), 115200, timeout=1
-        )  # set up serial communication
-        self.setSer(port)
-        if self.getSer():
-            self.setStatus("printing")
-            self.reset(initializeStatus=False)
-            self.parseGcode(file)
-            self.reset(initializeStatus=False)
-            self.disconnect()
-            self.setStatus("complete")
-            # WHEN THE USER CLEARS THE JOB, THEN we can remove the job from printer queue,
-            # add it to job history collection, and update the printer status in-memory
-        else:
-            raise Exception(
-                "Failed to establish serial connection for printer: ", self.name
-            )
+    # Prints the next job. With resume=True an interrupted job is picked up at its last checkpoint
+    # instead: the printer seeks straight to the layer it was on rather than starting over.
+    def printNextInQueue(self, resume=False):
+        try:
+            job, gcode, start, preamble = self.preparePrint(resume)
+            # borrow the already open connection instead of opening (and resetting) the port per job
+            with self.leaseSerial():
+                self.setStatus("printing")
+                if preamble:
+                    logger.info("Resuming job", extra={"printer": self.id, "job": job.id, "line": start})
+                    for command in preamble:
+                        self.sendGcode(command)
+                else:
+                    self.reset(initializeStatus=False)
+                self.streamGcode(gcode, start, self.createCheckpointer(job, gcode))
+                self.reset(initializeStatus=False)
+                # the job leaves the (journaled) queue so it isn't printed again after a restart. The
+                # printer waits in "complete" until the user clears the plate and sets it back to ready.
+                self.getQueue().discard(job)
+                self.discardCheckpoint()
+                self.setStatus("complete")
+        finally:
+            self.printingJob = None
+        return job
 
+    # A print cut short left its part on the bed, where homing Z would drive the nozzle into it. The
+    # printer isn't homed then: resuming homes X and Y above the part, restarting homes after.
     def initialize(self):
-        self.ser = serial.Serial(
-            self.getDevice(), 115200, timeout=1
-        )  # set up serial communication
-        if self.getSer():
-            self.reset(initializeStatus=True)
-        else:
-            raise Exception(
-                "Failed to establish serial connection for printer: ", self.name
-            )
+        with self.leaseSerial():  # set up serial communication
+            self.reset(initializeStatus=False, home=not self.hasCheckpoint())
+            self.negotiatePacking()
+            # ask for temperature auto-reports. Firmware without M155 just ignores it and gets polled.
+            self.sendGcode(f"M155 S{DEFAULT_INTERVAL}", initializeStatus=True)
+
+    # asyncio backend. Same steps as the threaded methods above, but run as tasks on the shared
+    # printer event loop. The connection stays open between jobs.
+    async def connectAsync(self):
+        # acquiring may have to reconnect with backoff, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        self.setSer(await loop.run_in_executor(None, serialPool.acquire, self.hwid, self.device))
+        try:
+            self.conn = await AsyncSerialConnection.open(self.ser.port, self.ser.baudrate, configure=False)
+        except Exception:
+            self.disconnect()
+            raise
+        self.asyncStreamer = AsyncGcodeStreamer(self.conn, telemetry=self.getTelemetry(), metrics=self.getStreamMetrics(),
+                                                exchanges=self.getExchanges(), printer=self.id)
+
+    async def sendGcodeAsync(self, message, initializeStatus=False):
+        response = await self.asyncStreamer.send(message)
+        if initializeStatus == True:
+            self.setStatus("ready")
+        self.getCommandEcho().log(self.id, message, response)
+
+    async def resetAsync(self, initializeStatus, home=True):
+        if home:
+            await self.sendGcodeAsync("G28")
+        await self.sendGcodeAsync("G92 E0", initializeStatus)
+
+    async def streamGcodeAsync(self, gcode, start=0, checkpointer=None):
+        # packing a job that wasn't packed at upload reads and writes the whole file
+        packed = await asyncio.get_running_loop().run_in_executor(None, PackedGcode.fromBuffer, gcode) \
+            if self.meatpack else None
+        try:
+            stats = await self.asyncStreamer.stream(self.trackProgress(gcode, start, checkpointer, packed),
+                                                    packed=packed is not None)
+        finally:
+            if packed is not None:
+                packed.close()
+        logger.info("Stream finished", extra={"printer": self.id, "packed": packed is not None, **stats.toDict()})
+        return stats
+
+    async def negotiatePackingAsync(self):
+        self.meatpack = MEATPACK and await self.asyncStreamer.queryPacking() is not None
+        if self.meatpack:
+            logger.info("Printer supports MeatPack, jobs will be sent packed", extra={"printer": self.id})
+
+    async def initializeAsync(self):
+        if self.conn is None:
+            await self.connectAsync()
+        interrupted = await asyncio.get_running_loop().run_in_executor(None, self.hasCheckpoint)
+        await self.resetAsync(initializeStatus=False, home=not interrupted)
+        await self.negotiatePackingAsync()
+        await self.sendGcodeAsync(f"M155 S{DEFAULT_INTERVAL}", initializeStatus=True)
+
+    async def printNextInQueueAsync(self, resume=False):
+        # reading, preprocessing and checkpoint I/O would stall every printer on the loop, so it all
+        # runs on the executor
+        loop = asyncio.get_running_loop()
+        try:
+            job, gcode, start, preamble = await loop.run_in_executor(None, self.preparePrint, resume)
+            if self.conn is None:
+                await self.connectAsync()
+            self.setStatus("printing")
+            if preamble:
+                logger.info("Resuming job", extra={"printer": self.id, "job": job.id, "line": start})
+                for command in preamble:
+                    await self.sendGcodeAsync(command)
+            else:
+                await self.resetAsync(initializeStatus=False)
+            checkpointer = self.createCheckpointer(job, gcode, loop)
+            await self.streamGcodeAsync(gcode, start, checkpointer)
+            await self.resetAsync(initializeStatus=False)
+            await checkpointer.wait()
+            # journaling waits for an fsync, so keep it off the event loop
+            await loop.run_in_executor(None, self.getQueue().discard, job)
+            await loop.run_in_executor(None, self.discardCheckpoint)
+            self.setStatus("complete")
+        finally:
+            self.printingJob = None
+        return job
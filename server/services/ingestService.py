@@ -0,0 +1,194 @@
+import os
+import time
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread, Lock
+from Classes.BlobStore import blobStore
+from Classes.GcodeBuffer import GcodeBuffer
+from Classes.GcodeEstimator import PrintEstimate, estimateBuffer
+from Classes.GcodeOptimizer import optimizeBuffer
+from Classes.MeatPack import MEATPACK, PackedGcode
+from models.jobs import Job
+
+# processes analyzing uploads. Parsing and estimating are pure Python, so threads would all wait
+# on the GIL (and hold up the API and printer threads while they're at it).
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", min(4, os.cpu_count() or 1)))
+# how many finished uploads are remembered for /ingeststatus. Older ones are looked up in the database.
+STATE_HISTORY = 1000
+# seconds between a worker's checks that the server is still running
+PARENT_CHECK_INTERVAL = 1.0
+
+# set in each worker process: where progress reports go
+progressQueue = None
+
+logger = logging.getLogger(__name__)
+
+
+def initWorker(queue):
+    global progressQueue
+    progressQueue = queue
+    Thread(target=exitWithParent, args=(os.getppid(),), daemon=True).start()
+
+
+# Forked workers hold their own end of the task pipe, so they never see it close if the server is
+# killed. They watch for the server going away instead.
+def exitWithParent(parent):
+    while os.getppid() == parent:
+        time.sleep(PARENT_CHECK_INTERVAL)
+    os._exit(0)
+
+
+def reportProgress(jobids, stage, fraction):
+    if progressQueue is not None:
+        progressQueue.put((jobids, stage, round(fraction, 3)))
+
+
+# Runs in a worker process. Strips and indexes the uploaded file, checks it looks like G-code and
+# estimates it. With `optimize`, the file is also run through the G-code optimizer and the
+# optimized version is what gets estimated. The lines are also MeatPack encoded for printers that
+# support it (unless MEATPACK=0). The buffers and estimate are cached on disk, where
+# the server picks them up when the job prints. `jobids` are the jobs printing this file.
+# Returns the estimate as a dict and the optimizer's report (None without `optimize`).
+def analyzeUpload(jobids, fileHash, optimize=False):
+    reportProgress(jobids, "preprocessing", 0.0)
+    gcode = GcodeBuffer.fromBlob(fileHash, blobStore)
+    report = None
+    try:
+        reportProgress(jobids, "validating", 0.0)
+        if len(gcode) == 0:
+            raise ValueError("File has no G-code commands.")
+        for number, line in enumerate(gcode, 1):
+            if not line[:1].isalpha():
+                raise ValueError(f"Line {number} is not a G-code command.")
+        if optimize:
+            source = gcode
+            gcode, report = optimizeBuffer(source, progress=lambda fraction: reportProgress(jobids, "optimizing", fraction))
+            if gcode is not source:
+                source.close()
+        if MEATPACK:
+            PackedGcode.fromBuffer(gcode, lambda fraction: reportProgress(jobids, "packing", fraction)).close()
+        estimate = estimateBuffer(gcode, lambda fraction: reportProgress(jobids, "estimating", fraction))
+        return estimate.toDict(), report
+    finally:
+        gcode.close()
+
+
+# Takes uploaded jobs off the request thread: each one is analyzed in a process pool and queued
+# when it's done. A job goes uploaded -> analyzing -> inqueue, or failed if the file is rejected
+# or no printer can take it.
+class IngestService:
+    def __init__(self, max_workers=INGEST_WORKERS):
+        self.printer_status_service = None
+        self.max_workers = max_workers
+        self.app = None
+        self.executor = None
+        self.progress = None
+        self.states = OrderedDict() # jobid: {"status", "stage", "progress", "error", "lines_removed"}, recent uploads only
+        self.lock = Lock()
+
+    def init_app(self, app, printer_status_service):
+        self.app = app
+        self.printer_status_service = printer_status_service
+
+    # Starts the worker processes. Called before any other thread is started, so the workers are
+    # forked from a single-threaded process.
+    def start(self):
+        self.progress = multiprocessing.SimpleQueue()
+        self.executor = ProcessPoolExecutor(self.max_workers, initializer=initWorker, initargs=(self.progress,))
+        self.executor.submit(int).result() # launches the workers now instead of on the first upload
+        Thread(target=self.read_progress, daemon=True).start()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.progress.put(None)
+            self.executor = None
+
+    # Analyzes a saved job in the background and queues it on `printerid` (or wherever the
+    # scheduler places it) when done. Returns right away.
+    def submit(self, job, printerid=None):
+        self.submit_group([job], printerid)
+
+    # Saved jobs for the same file (copies of a part, all optimized or not): the file is analyzed
+    # once and the jobs are queued together, spread over the farm if there's no printer id.
+    def submit_group(self, jobs, printerid=None):
+        jobids = tuple(job.id for job in jobs)
+        for jobid in jobids:
+            self.set_state(jobid, status="uploaded", stage=None, progress=0.0, error=None)
+        future = self.executor.submit(analyzeUpload, jobids, jobs[0].getFileHash(), jobs[0].getOptimize())
+        future.add_done_callback(lambda future: self.finish(jobs, printerid, future))
+
+    # Uploads that hadn't been analyzed yet when the server went down are analyzed again
+    def resume_pending(self):
+        with self.app.app_context():
+            jobs = Job.load_jobs_with_status(("uploaded", "analyzing"))
+        groups = {}
+        for job in jobs:
+            groups.setdefault((job.getFileHash(), job.getOptimize(), job.printer_id), []).append(job)
+        for (_, _, printerid), group in groups.items():
+            self.submit_group(group, printerid)
+        return len(jobs)
+
+    def read_progress(self):
+        while True:
+            message = self.progress.get()
+            if message is None:
+                break
+            jobids, stage, fraction = message
+            started = []
+            with self.lock:
+                for jobid in jobids:
+                    state = self.states.get(jobid)
+                    if state is None or state["status"] not in ("uploaded", "analyzing"):
+                        continue # finished before its progress was read
+                    if state["status"] == "uploaded":
+                        started.append(jobid)
+                    state.update(status="analyzing", stage=stage, progress=fraction)
+            if started:
+                self.update_job(started, from_status="uploaded", status="analyzing")
+
+    # Runs in the executor's result thread once a worker is done with the jobs
+    def finish(self, jobs, printerid, future):
+        try:
+            result, report = future.result()
+            estimate = PrintEstimate.fromDict(result)
+            for job in jobs:
+                job.setEstimate(estimate)
+                if report is not None:
+                    job.lines_removed = report["lines_removed"]
+            with self.app.app_context():
+                placements = self.printer_status_service.queue_jobs(jobs, printerid)
+            unplaced = [job.id for job, printer in zip(jobs, placements) if printer is None]
+            for job, printer in zip(jobs, placements):
+                if printer is not None:
+                    self.set_state(job.id, status="inqueue", stage=None, progress=1.0, printerid=printer.getId(),
+                                   lines_removed=job.lines_removed)
+            if unplaced:
+                self.fail(unplaced, "No printer available for this job.")
+        except Exception as e:
+            logger.warning("Jobs rejected", extra={"jobs": [job.id for job in jobs], "error": str(e)})
+            self.fail([job.id for job in jobs], str(e))
+
+    def fail(self, jobids, error):
+        for jobid in jobids:
+            self.set_state(jobid, status="failed", stage=None, error=error)
+        self.update_job(jobids, status="failed")
+
+    def update_job(self, jobid, **fields):
+        with self.app.app_context():
+            Job.update_job(jobid, **fields)
+
+    def set_state(self, jobid, **fields):
+        with self.lock:
+            self.states.setdefault(jobid, {}).update(fields)
+            self.states.move_to_end(jobid)
+            while len(self.states) > STATE_HISTORY:
+                self.states.popitem(last=False)
+
+    # Where an upload is in the pipeline, or None if it isn't a recent upload
+    def get_state(self, jobid):
+        with self.lock:
+            state = self.states.get(jobid)
+            return dict(state, id=jobid) if state is not None else None
@@ -0,0 +1,128 @@
+# assigns jobs to printers by estimated completion time
+import heapq
+import threading
+import time
+
+# rough print time per G-code line, used until a job has a real estimate
+SECONDS_PER_LINE = 0.05
+# printers in these states can't take new work
+UNAVAILABLE_STATUSES = ("error", "offline")
+
+
+def estimateJobTime(job):
+    if hasattr(job, "getEstimatedTime"):
+        estimate = job.getEstimatedTime()
+        if estimate is not None:
+            return estimate
+    if hasattr(job, "getGcode"):
+        lines = job.getGcode()
+    else:
+        lines = getattr(job, "gcode_lines", None) or ()
+    return len(lines) * SECONDS_PER_LINE
+
+
+def printerId(printer):
+    return printer.getId()
+
+
+# A printer and the work already assigned to it
+class PrinterSlot:
+    def __init__(self, printer):
+        self.printer = printer
+        self.finishTime = time.time()  # when the printer is expected to run out of work
+        self.jobs = {}  # job: estimated seconds, for jobs assigned but not finished
+        self.version = 0  # bumped on every change; older heap entries are stale
+
+
+# Keeps every printer in a min-heap keyed by the time it is expected to finish its queued work, so
+# auto-placement picks the printer that will be free first rather than the one with the shortest
+# queue (one 30 hour print is not the same as one 10 minute print). Updates push a new heap entry
+# and leave the old one to be discarded lazily, so assignment is O(log P).
+class FarmScheduler:
+    def __init__(self):
+        self.__heap = []  # (finishTime, version, printerId)
+        self.__slots = {}  # printerId: PrinterSlot
+        self.__lock = threading.Lock()
+
+    def __push(self, slot):
+        slot.version += 1
+        heapq.heappush(self.__heap, (slot.finishTime, slot.version, printerId(slot.printer)))
+        # drop stale entries once they make up most of the heap
+        if len(self.__heap) > 2 * len(self.__slots) + 16:
+            self.__heap = [(slot.finishTime, slot.version, pid) for pid, slot in self.__slots.items()]
+            heapq.heapify(self.__heap)
+
+    def addPrinter(self, printer):
+        with self.__lock:
+            slot = PrinterSlot(printer)
+            self.__slots[printerId(printer)] = slot
+            self.__push(slot)
+
+    def removePrinter(self, printer):
+        with self.__lock:
+            self.__slots.pop(printerId(printer), None)  # its heap entries go stale
+
+    # a printer can take a job if it's usable and loaded with the filament the job needs (the
+    # `filament` columns of Job and Printer; either left empty matches anything)
+    def isCompatible(self, printer, job):
+        if getattr(printer, "status", None) in UNAVAILABLE_STATUSES:
+            return False
+        needed = getattr(job, "filament", None)
+        loaded = getattr(printer, "filament", None)
+        return not needed or not loaded or needed.strip().lower() == loaded.strip().lower()
+
+    # Picks the compatible printer expected to finish first, reserves the job on it and returns it.
+    # Returns None if no printer can take the job.
+    def assign(self, job):
+        estimate = estimateJobTime(job)
+        with self.__lock:
+            skipped = []
+            chosen = None
+            while self.__heap:
+                finishTime, version, pid = heapq.heappop(self.__heap)
+                slot = self.__slots.get(pid)
+                if slot is None or slot.version != version:
+                    continue  # stale entry
+                if self.isCompatible(slot.printer, job):
+                    chosen = slot
+                    break
+                skipped.append((finishTime, version, pid))
+            for entry in skipped:
+                heapq.heappush(self.__heap, entry)
+            if chosen is None:
+                return None
+            self.__reserve(chosen, job, estimate)
+            return chosen.printer
+
+    # Records a job placed on a specific printer (not through assign)
+    def reserve(self, printer, job):
+        estimate = estimateJobTime(job)
+        with self.__lock:
+            slot = self.__slots.get(printerId(printer))
+            if slot is not None:
+                self.__reserve(slot, job, estimate)
+
+    def __reserve(self, slot, job, estimate):
+        slot.jobs[job] = estimate
+        slot.finishTime = max(time.time(), slot.finishTime) + estimate
+        self.__push(slot)
+
+    # Called when a job finishes or is removed from a printer's queue. The printer's finish time
+    # is recomputed from the jobs it still has.
+    def release(self, printer, job):
+        with self.__lock:
+            slot = self.__slots.get(printerId(printer))
+            if slot is None or slot.jobs.pop(job, None) is None:
+                return
+            slot.finishTime = time.time() + sum(slot.jobs.values())
+            self.__push(slot)
+
+    def getFinishTime(self, printer):
+        slot = self.__slots.get(printerId(printer))
+        return slot.finishTime if slot is not None else None
+
+    # printers ordered by expected finish time, soonest first
+    def getPrinters(self):
+        with self.__lock:
+            slots = sorted(self.__slots.values(), key=lambda slot: slot.finishTime)
+        return [slot.printer for slot in slots]
@@ -0,0 +1,105 @@
+# pushes printer status changes to connected dashboards
+import json
+import threading
+import time
+
+# updates arriving within this window are sent to a subscriber as one message
+COALESCE_INTERVAL = 0.25
+# a comment line is sent this often so proxies don't close idle streams
+HEARTBEAT_INTERVAL = 15.0
+
+_MISSING = object()
+
+
+# One connected client. Holds the changes it hasn't been sent yet, merged per printer, so a burst of
+# updates to the same field only ever costs one value on the wire.
+class StatusSubscriber:
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.pending = {}  # printerid: {field: value}
+        self.closed = False
+
+    # Blocks until there are changes (or `timeout` passes) and returns them, clearing the pending set.
+    # Returns an empty dict on timeout.
+    def wait(self, timeout=HEARTBEAT_INTERVAL):
+        return self.broadcaster.waitFor(self, timeout)
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+
+# Keeps the last known state of every printer and fans changes out to subscribers. Publishers only
+# pay for a dict merge per subscriber; nothing is serialized until a subscriber's stream sends it.
+class StatusBroadcaster:
+    def __init__(self, coalesceInterval=COALESCE_INTERVAL):
+        self.coalesceInterval = coalesceInterval
+        self.__state = {}  # printerid: {field: value}
+        self.__subscribers = set()
+        self.__condition = threading.Condition()
+
+    # Records new values for a printer's fields and queues whichever of them actually changed
+    def publish(self, printerid, **fields):
+        with self.__condition:
+            state = self.__state.setdefault(printerid, {"id": printerid})
+            changed = {field: value for field, value in fields.items() if state.get(field, _MISSING) != value}
+            if not changed:
+                return
+            state.update(changed)
+            for subscriber in self.__subscribers:
+                subscriber.pending.setdefault(printerid, {}).update(changed)
+            self.__condition.notify_all()
+
+    # Registers a new subscriber. Returns (subscriber, snapshot) taken atomically, so no change is
+    # missed or sent twice between the snapshot and the first delta.
+    def subscribe(self):
+        with self.__condition:
+            subscriber = StatusSubscriber(self)
+            self.__subscribers.add(subscriber)
+            return subscriber, [dict(state) for state in self.__state.values()]
+
+    def unsubscribe(self, subscriber):
+        with self.__condition:
+            subscriber.closed = True
+            self.__subscribers.discard(subscriber)
+            self.__condition.notify_all()
+
+    def waitFor(self, subscriber, timeout):
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while not subscriber.pending and not subscriber.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return {}
+                self.__condition.wait(remaining)
+        # give the rest of a burst a moment to land so it goes out as one message
+        time.sleep(self.coalesceInterval)
+        with self.__condition:
+            pending = subscriber.pending
+            subscriber.pending = {}
+        return pending
+
+    def getSubscriberCount(self):
+        return len(self.__subscribers)
+
+
+# Server-sent events for one subscriber: a snapshot, then one "update" per coalesced batch of
+# changes, with heartbeat comments in between.
+def eventStream(broadcaster, heartbeat=HEARTBEAT_INTERVAL):
+    subscriber, snapshot = broadcaster.subscribe()
+    try:
+        yield formatEvent("snapshot", snapshot)
+        while not subscriber.closed:
+            changes = subscriber.wait(heartbeat)
+            if changes:
+                yield formatEvent("update", {str(printerid): fields for printerid, fields in changes.items()})
+            else:
+                yield ": keepalive\n\n"
+    finally:
+        subscriber.close()
+
+
+def formatEvent(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+statusBroadcaster = StatusBroadcaster()
@@ -15,9 +15,8 @@ def create_job(file, name, quantity, priority, port, status):
     test_job = Job(file, name, quantity, priority, status)
     
     if(port == "None"): # OPTION FOR IF YOU WANT TO PRINT TO PRINTER W/ SMALLEST QUEUE: 
-        # select printer with smallest queue. Add to queue of specific printer and also database 
-        sortedPrinterList = printerObjects.autoQueue() # returns a dict sorted by which printer has smallest queue
-        nextPrinter = sortedPrinterList[0][1] # gets printer object. tuple is in form (mongoId: PrinterObject)
+        # select printer that will finish its queued work first. Add to queue of specific printer and also database 
+        nextPrinter = printerObjects.autoQueue(test_job) # gets printer object
         handleQueue(nextPrinter, test_job)
         printer_util(nextPrinter, test_job)
     else: 
@@ -0,0 +1,136 @@
+import time
+import pytest
+from Classes.GcodeBuffer import GcodeBuffer
+from Classes.GcodeEstimator import estimateBuffer
+from Classes.PrintCheckpoint import CheckpointStore, Checkpointer, findLayer, resumePreamble
+from Classes.QueueJournal import QueueJournal
+from Classes.VirtualPrinter import VirtualPrinterFarm
+from models import printers as printersModule
+from models.jobs import Job
+from models.printers import Printer
+from models.PrinterStatusService import PrinterStatusService
+
+LAYERS = 5
+
+
+def sampleGcode():
+    lines = ["G28", "M140 S60", "M104 S210", "M190 S60", "M109 S210", "G90", "M82", "G92 E0"]
+    e = 0.0
+    for layer in range(1, LAYERS + 1):
+        lines.append(f"G1 Z{layer * 0.2:.1f} F600 ; layer {layer}")
+        for x in (10, 20, 30, 20):
+            e += 0.5
+            lines.append(f"G1 X{x} Y{layer * 2} E{e:.3f} F1500")
+    return "\n".join(lines).encode()
+
+
+class FakeJob:
+    id = 42
+
+    def __init__(self, gcode, layers):
+        self.gcode = gcode
+        self.layers = layers
+
+    def getGcode(self):
+        return self.gcode
+
+    def getLayerIndex(self):
+        return self.layers
+
+
+@pytest.fixture
+def job(tmp_path):
+    gcode = GcodeBuffer.build(sampleGcode(), str(tmp_path / "cache"))
+    return FakeJob(gcode, estimateBuffer(gcode).layers)
+
+
+def test_checkpoint_points_at_the_layer_it_was_on(tmp_path, job):
+    store = CheckpointStore(str(tmp_path))
+    layers = job.getLayerIndex()
+    assert [layer["z"] for layer in layers] == [round(0.2 * n, 3) for n in range(1, LAYERS + 1)]
+    checkpointer = Checkpointer(store, 1, job, job.gcode, layers, inFlight=4)
+    checkpointer.update(layers[3]["line"] + 6)
+    checkpoint = store.load(1)
+    assert checkpoint["job"] == 42 and checkpoint["line"] == layers[3]["line"] + 2
+    assert findLayer(layers, checkpoint["line"]) is layers[3]
+    assert findLayer(layers, 0) is None
+
+
+def test_preamble_restores_the_layer_without_homing_z(job):
+    layer = job.getLayerIndex()[2]
+    preamble = resumePreamble(layer, {"temperatures": None})
+    assert "G28" not in preamble and "G28 X Y" in preamble
+    assert preamble.index(f"G92 Z{layer['z']:g}") < preamble.index("G28 X Y")
+    assert preamble[-1] == "G90"
+
+
+def test_restart_then_resume_never_homes_z(tmp_path, job, monkeypatch):
+    monkeypatch.setattr(printersModule.checkpointStore, "root", str(tmp_path / "checkpoints"))
+    farm = VirtualPrinterFarm()
+    farm.start()
+    port = farm.spawn()
+    printer = Printer(device=port.device, description="test", hwid=port.hwid, name="test", id=900)
+    sent = []
+    sendGcode = printer.sendGcode
+
+    def recordingSendGcode(message, initializeStatus=False):
+        sent.append(message)
+        sendGcode(message, initializeStatus)
+    printer.sendGcode = recordingSendGcode
+    try:
+        printer.getQueue().addToBack(job)
+        layer = job.getLayerIndex()[3]
+        printersModule.checkpointStore.save(printer.getId(), {
+            "job": job.id, "file_hash": job.gcode.getKey(), "line": layer["line"] + 3,
+            "offset": 0, "z": layer["z"], "temperatures": None, "time": time.time(),
+        })
+        # the server comes back up: the printer is initialized, then told to resume
+        printer.initialize()
+        assert printer.hasCheckpoint()
+        printer.printNextInQueue(resume=True)
+        first = sent.index("M140 S60")  # the preamble starts by heating the bed
+        assert "G28" not in sent[:first]
+        assert sent[first:first + 16] == resumePreamble(layer, {"temperatures": None})
+        assert not printer.hasCheckpoint() and printer.getStatus() == "complete"
+    finally:
+        printer.closeConnection()
+        farm.stop()
+
+
+@pytest.mark.parametrize("backend", ["threaded", "async"])
+def test_queues_are_restored_before_workers_start(tmp_path, job, monkeypatch, backend):
+    monkeypatch.setattr(printersModule.checkpointStore, "root", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(Job, "load_jobs", classmethod(lambda cls, ids: [job] if job.id in ids else []))
+    sent = []
+    sendGcode = Printer.sendGcode
+
+    def recordingSendGcode(self, message, initializeStatus=False):
+        sent.append(message)
+        sendGcode(self, message, initializeStatus)
+    monkeypatch.setattr(Printer, "sendGcode", recordingSendGcode)
+    # the journal and checkpoint a print that was cut off leaves behind
+    journal = QueueJournal(str(tmp_path / "queue.journal"))
+    journal.open()
+    journal.append({"op": "add", "printer": 900, "job": job.id, "priority": 0})
+    journal.close()
+    layer = job.getLayerIndex()[2]
+    printersModule.checkpointStore.save(900, {
+        "job": job.id, "file_hash": job.gcode.getKey(), "line": layer["line"], "offset": 0, "z": layer["z"],
+        "temperatures": None, "time": time.time(),
+    })
+    farm = VirtualPrinterFarm()
+    farm.start()
+    port = farm.spawn()
+    service = PrinterStatusService(backend=backend, journal=QueueJournal(journal.path))
+    try:
+        service.create_printer_threads([{"id": 900, "device": port.device, "description": "test",
+                                         "hwid": port.hwid, "name": "test"}])
+        printer = service.getPrinterThread(900).printer
+        deadline = time.monotonic() + 10
+        while printer.getStatus() != "interrupted" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert printer.getStatus() == "interrupted"
+        assert "G28" not in sent
+    finally:
+        service.shutdown()
+        farm.stop()
@@ -0,0 +1,26 @@
+import math
+from Classes.GcodeEstimator import GcodeEstimator, MIN_LAYER_HEIGHT
+
+
+def test_each_z_step_starts_a_layer():
+    lines = ["G90", "M82", "G92 E0"]
+    for layer in range(1, 6):
+        lines += [f"G1 Z{layer * 0.2:.1f} F600", f"G1 X10 Y{layer} E{layer:.1f} F1500"]
+    estimate = GcodeEstimator().estimateLines(lines)
+    assert [layer["z"] for layer in estimate.layers] == [0.2, 0.4, 0.6, 0.8, 1.0]
+    assert len(estimate.layer_times) == 5
+
+
+def test_spiral_vase_layers_stay_bounded():
+    # 0.2mm per turn of 100 moves: Z goes up on every line
+    lines, e = ["G90", "M82", "G92 E0", "G1 Z0.2 F600"], 0.0
+    for i in range(10_000):
+        angle = 2 * math.pi * i / 100
+        e += 0.02
+        lines.append(f"G1 X{50 + 20 * math.cos(angle):.3f} Y{50 + 20 * math.sin(angle):.3f} Z{0.2 + 0.002 * i:.4f} E{e:.4f}")
+    estimate = GcodeEstimator().estimateLines(lines)
+    height = 0.002 * 10_000
+    assert len(estimate.layers) <= height / MIN_LAYER_HEIGHT + 1
+    assert len(estimate.layer_times) == len(estimate.layers)
+    zs = [layer["z"] for layer in estimate.layers]
+    assert zs == sorted(zs) and zs[-1] >= 20.0
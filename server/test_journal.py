@@ -0,0 +1,131 @@
+import os
+import json
+import threading
+import pytest
+from Classes.Queue import Queue
+from Classes.QueueJournal import QueueJournal, JournalError
+
+
+def openJournal(tmp_path, **options):
+    journal = QueueJournal(str(tmp_path / "queue.journal"), **options)
+    return journal, journal.open()
+
+
+def test_queues_survive_a_restart(tmp_path):
+    journal, _ = openJournal(tmp_path)
+    queue = Queue()
+    queue.setJournal(journal, 1)
+    for job in (10, 11, 12):
+        queue.addToBack(job)
+    queue.addToBack(13, priority=2)
+    queue.bump(False, 10)
+    queue.deleteJob(12)
+    journal.close()
+
+    journal, queues = openJournal(tmp_path)
+    assert queues == {1: [(13, 2), (11, 0), (10, 0)]}
+    journal.close()
+
+
+def test_torn_last_record_is_ignored(tmp_path):
+    journal, _ = openJournal(tmp_path)
+    journal.append({"op": "add", "printer": 1, "job": 5, "priority": 0})
+    journal.close()
+    with open(journal.path, "ab") as f:
+        f.write(b'{"op":"add","printer":1,"jo')
+    journal, queues = openJournal(tmp_path)
+    assert queues == {1: [(5, 0)]}
+    journal.close()
+
+
+def test_compaction_keeps_only_live_jobs(tmp_path):
+    journal, _ = openJournal(tmp_path, compactAfter=20)
+    queue = Queue()
+    queue.setJournal(journal, 1)
+    for job in range(50):
+        queue.addToBack(job)
+        if job % 2:
+            queue.deleteJob(job)
+    journal.sync()
+    with open(journal.path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) < 75  # 50 adds and 25 deletes were appended
+    journal.close()
+    journal, queues = openJournal(tmp_path)
+    assert queues == {1: [(job, 0) for job in range(0, 50, 2)]}
+    journal.close()
+
+
+def test_deferred_appends_share_commits(tmp_path):
+    journal, _ = openJournal(tmp_path)
+    queue = Queue()
+    queue.setJournal(journal, 1)
+    commits = journal.commits
+    with journal.deferred():
+        for job in range(100):
+            queue.addToBack(job)
+    assert journal.commits - commits <= 2
+    journal.close()
+
+
+def test_failed_write_is_raised_and_rewritten(tmp_path, monkeypatch):
+    journal, _ = openJournal(tmp_path)
+    journal.append({"op": "add", "printer": 1, "job": 1, "priority": 0})
+    realFsync = os.fsync
+
+    def failingFsync(fd):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(os, "fsync", failingFsync)
+    with pytest.raises(JournalError):
+        journal.append({"op": "add", "printer": 1, "job": 2, "priority": 0})
+    monkeypatch.setattr(os, "fsync", realFsync)
+    # the next commit rewrites the file, including the record that failed
+    journal.append({"op": "add", "printer": 1, "job": 3, "priority": 0})
+    journal.close()
+    journal, queues = openJournal(tmp_path)
+    assert queues == {1: [(1, 0), (2, 0), (3, 0)]}
+    journal.close()
+
+
+def test_readers_dont_wait_for_the_disk(tmp_path, monkeypatch):
+    journal, _ = openJournal(tmp_path)
+    queue = Queue()
+    queue.setJournal(journal, 1)
+    syncing, release = threading.Event(), threading.Event()
+    realFsync = os.fsync
+
+    def slowFsync(fd):
+        syncing.set()
+        release.wait(5)
+        realFsync(fd)
+    monkeypatch.setattr(os, "fsync", slowFsync)
+    writer = threading.Thread(target=queue.addToBack, args=(7,))
+    writer.start()
+    assert syncing.wait(5)
+    seen = []
+    reader = threading.Thread(target=lambda: seen.append(queue.getNext()))
+    reader.start()
+    reader.join(2)
+    release.set()
+    writer.join(5)
+    assert seen == [7]
+    journal.close()
+
+
+def test_refused_change_leaves_the_queue_alone(tmp_path):
+    journal, _ = openJournal(tmp_path)
+    queue = Queue()
+    queue.setJournal(journal, 1)
+    queue.addToBack(1)
+    journal.close()
+    for change in (lambda: queue.addToBack(2), lambda: queue.addToFront(2), lambda: queue.deleteJob(1),
+                   lambda: queue.setPriority(1, 3), lambda: queue.removeJob()):
+        with pytest.raises(Exception, match="not open"):
+            change()
+    assert queue.getQueue() == [1] and queue.getPriority(1) == 0
+    # once the journal is back, retrying works
+    journal, _ = openJournal(tmp_path)
+    queue.setJournal(journal, 1)
+    queue.addToBack(2)
+    assert queue.getQueue() == [1, 2]
+    journal.close()
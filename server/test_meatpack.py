@@ -0,0 +1,65 @@
+import serial
+from Classes.GcodeBuffer import GcodeBuffer, numberedChecksum
+from Classes.GcodeStreamer import GcodeStreamer
+from Classes.MeatPack import ENABLE, PackedGcode, MeatPackDecoder, packLine, packNumbered
+from Classes.VirtualPrinter import VirtualPrinterFarm, lineChecksum
+
+LINES = [b"G28", b"M104 S210", b"G1 Z0.2 F600", b"G1 X10.5 Y20.25 E0.12345 F1800", b"G0 X0 Y0",
+         b"M117 Printing...", b"G92 E0", b"G1 X-5.5 Y100 E1.5"]
+
+
+def unpack(*packed):
+    decoder = MeatPackDecoder()
+    decoder.feed(ENABLE)
+    out, _ = decoder.feed(b"".join(packed))
+    return out
+
+
+def test_round_trip():
+    for line in LINES:
+        assert unpack(packLine(line)) == line + b"\n"
+    assert unpack(*(packLine(line) for line in LINES)) == b"".join(line + b"\n" for line in LINES)
+
+
+def test_numbered_lines_check_out_once_unpacked():
+    for number, line in enumerate(LINES, 1):
+        body, _, checksum = unpack(packNumbered(number, line)).rstrip(b"\n").rpartition(b"*")
+        assert lineChecksum(body.decode()) == int(checksum)
+        if line.startswith((b"G0 ", b"G1 ")):
+            assert body == b"N%d%s" % (number, line.replace(b" ", b""))  # moves are sent without spaces
+        else:
+            assert body == b"N%d %s" % (number, line)
+        # the checksum stored with the buffer gives the same wire bytes
+        assert packNumbered(number, line, numberedChecksum(number - 1, line)) == packNumbered(number, line)
+
+
+def test_packed_buffer_is_smaller_and_cached(tmp_path):
+    gcode = GcodeBuffer.build(b"\n".join(LINES * 50), str(tmp_path))
+    packed = PackedGcode.fromBuffer(gcode)
+    assert PackedGcode.exists(gcode)
+    lines = list(packed.iterNumbered(0))
+    assert [number for number, _, _ in lines] == list(range(1, len(gcode) + 1))
+    assert [plain for _, _, plain in lines] == list(gcode)
+    plain = sum(len(wire) for _, wire in gcode.iterNumbered(0))
+    assert packed.getSize() == sum(len(wire) for _, wire, _ in lines) < plain * 0.75
+    packed.close()
+
+
+def test_packed_stream_reaches_the_printer(tmp_path):
+    gcode = GcodeBuffer.build(b"\n".join(LINES * 20), str(tmp_path))
+    packed = PackedGcode.fromBuffer(gcode)
+    farm = VirtualPrinterFarm()
+    farm.start()
+    try:
+        printer = farm.spawn(meatpack=True)
+        ser = serial.Serial(printer.device, 115200, timeout=0.1)
+        assert ser.readline() == b"start\n"
+        streamer = GcodeStreamer(ser)
+        assert streamer.queryPacking().startswith("[MP]")
+        stats = streamer.stream(packed.iterNumbered(0), packed=True)
+        assert stats.resends == 0 and stats.errors == 0
+        assert printer.lineNumber == len(gcode)
+        ser.close()
+    finally:
+        packed.close()
+        farm.stop()
@@ -0,0 +1,27 @@
+import math
+import pytest
+from Classes.GcodeBuffer import GcodeBuffer
+from Classes.GcodeOptimizer import optimizeBuffer
+
+pytest.importorskip("numpy")
+
+
+# A half circle of short moves, each point 0.01mm off the circle either way
+def wobblyArc():
+    lines, e = ["G90", "M82", "G92 E0"], 0.0
+    for i in range(1, 60):
+        angle = i * math.pi / 60
+        e += 0.05
+        lines.append(f"G1 X{50 + 20 * math.cos(angle):.3f} Y{50 + 20 * math.sin(angle) + 0.01 * (i % 2):.3f} E{e:.5f}")
+    return "\n".join(lines).encode()
+
+
+def test_each_tolerance_is_cached_separately(tmp_path):
+    gcode = GcodeBuffer.build(wobblyArc(), str(tmp_path))
+    strict, strictReport = optimizeBuffer(gcode, tolerance=0.001)
+    loose, looseReport = optimizeBuffer(gcode, tolerance=0.05)
+    assert strictReport["arcs"] == 0 and looseReport["arcs"] == 1
+    assert len(strict) == len(gcode) and len(loose) < len(gcode)
+    # cached: asking again gets the same buffer back, not the other tolerance's
+    again, report = optimizeBuffer(gcode, tolerance=0.001)
+    assert again.basePath == strict.basePath and report == strictReport
@@ -0,0 +1,81 @@
+import pytest
+from Classes.Queue import Queue
+
+
+def makeQueue(*jobs):
+    queue = Queue()
+    for job in jobs:
+        queue.addToBack(job)
+    return queue
+
+
+def test_fifo_within_a_priority():
+    queue = makeQueue(1, 2, 3)
+    assert queue.getQueue() == [1, 2, 3]
+    assert queue.getNext() == 1
+    assert queue.removeJob() == 1
+    assert queue.getQueue() == [2, 3]
+
+
+def test_higher_priority_first():
+    queue = makeQueue(1, 2)
+    queue.addToBack(3, priority=5)
+    queue.addToFront(4)
+    assert queue.getQueue() == [3, 4, 1, 2]
+    assert queue.getPriority(3) == 5
+
+
+def test_membership_and_duplicates():
+    queue = makeQueue(1)
+    assert 1 in queue and 2 not in queue
+    with pytest.raises(Exception):
+        queue.addToBack(1)
+
+
+def test_bump_stays_within_its_level():
+    queue = makeQueue(1, 2)
+    queue.addToBack(3, priority=1)
+    queue.bump(True, 2)
+    assert queue.getQueue() == [3, 2, 1]
+    queue.bump(True, 2)  # at the front of level 0: nothing happens
+    assert queue.getQueue() == [3, 2, 1]
+    assert queue.getPriority(2) == 0 and queue.getPriority(3) == 1
+    queue.bump(False, 2)
+    assert queue.getQueue() == [3, 1, 2]
+
+
+def test_extremes_and_set_priority():
+    queue = makeQueue(1, 2, 3)
+    queue.bumpExtreme(True, 3)
+    assert queue.getQueue() == [3, 1, 2]
+    queue.bumpExtreme(False, 3)
+    assert queue.getQueue() == [1, 2, 3]
+    queue.setPriority(2, 2)
+    assert queue.getQueue() == [2, 1, 3]
+    queue.setPriority(2, 0)  # keeps its place among the jobs already in level 0
+    assert queue.getQueue() == [1, 2, 3]
+
+
+def test_delete_and_compaction():
+    queue = makeQueue(*range(100))
+    for job in range(0, 100, 2):
+        queue.deleteJob(job)
+    for job in range(1, 60, 2):
+        queue.deleteJob(job)
+    assert queue.getQueue() == list(range(61, 100, 2))
+    assert queue.getSize() == len(queue) == 20
+    with pytest.raises(Exception):
+        queue.deleteJob(0)
+
+
+def test_empty_queue():
+    queue = Queue()
+    with pytest.raises(IndexError):
+        queue.getNext()
+
+
+def test_discard_tolerates_a_job_already_gone():
+    queue = makeQueue(1, 2)
+    assert queue.discard(1)
+    assert not queue.discard(1)
+    assert queue.getQueue() == [2]
@@ -0,0 +1,154 @@
+import time
+from collections import deque
+import serial
+from Classes import GcodeStreamer as streamerModule
+from Classes.GcodeBuffer import encodeNumbered
+from Classes.GcodeStreamer import GcodeStreamer, SendWindow
+from Classes.VirtualPrinter import VirtualPrinterFarm
+
+
+# Answers every line written with an ok, read back in order. Keeps track of how many lines the
+# "firmware" had been sent and not yet acknowledged.
+class FakeSerial:
+    def __init__(self, reply=b"ok\n"):
+        self.reply = reply
+        self.written = []
+        self.responses = deque()
+        self.unacknowledged = 0
+        self.mostUnacknowledged = 0
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        if self.reply is not None:
+            self.responses.append(self.reply)
+        self.unacknowledged += 1
+        self.mostUnacknowledged = max(self.mostUnacknowledged, self.unacknowledged)
+
+    def readline(self):
+        if not self.responses:
+            return b""
+        response = self.responses.popleft()
+        if response.startswith(b"ok"):
+            self.unacknowledged -= 1
+        return response
+
+
+def test_window_limits_commands_and_bytes():
+    window = SendWindow(maxCommands=2, maxBytes=10)
+    assert window.canSend(50)  # one command always fits
+    window.sent(4, 0.0)
+    assert window.canSend(6)
+    assert not window.canSend(7)
+    window.sent(4, 1.0)
+    assert not window.canSend(1)
+    assert window.acknowledge() == 0.0
+    assert window.getSize() == 1 and window.bytesInFlight == 4
+    window.clear()
+    assert window.isEmpty() and window.acknowledge() is None
+
+
+def test_stream_keeps_the_window_full():
+    ser = FakeSerial()
+    lines = [f"G1 X{i}" for i in range(100)]
+    stats = GcodeStreamer(ser, maxCommands=4).stream(lines)
+    assert ser.written == [line.encode() + b"\n" for line in lines]
+    assert ser.mostUnacknowledged == 4
+    assert ser.unacknowledged == 0
+    assert stats.lines == 100 and stats.bytes == sum(len(line) + 1 for line in lines)
+
+
+def test_stream_respects_the_rx_buffer():
+    ser = FakeSerial()
+    streamer = GcodeStreamer(ser, maxCommands=8, maxBytes=30)
+    sizes = []
+    original = streamer.recordSent
+
+    def recordSent(data, number=None, text=None):
+        original(data, number, text)
+        sizes.append(streamer.window.bytesInFlight)
+    streamer.recordSent = recordSent
+    streamer.stream([b"G1 X100.000 Y100.000\n"] * 20)
+    assert max(sizes) <= 30
+
+
+def test_send_waits_for_its_ok():
+    ser = FakeSerial(reply=None)
+    ser.responses.extend([b"echo:busy: processing\n", b"ok T:20.0 /0.0\n"])
+    streamer = GcodeStreamer(ser)
+    assert streamer.send("G28") == "ok T:20.0 /0.0"
+    assert streamer.window.isEmpty()
+
+
+def test_wait_frees_slots_whose_oks_were_lost():
+    ser = FakeSerial(reply=None)
+    streamer = GcodeStreamer(ser, maxCommands=2)
+    ser.responses.extend([b"wait\n", b"ok\n"])
+    streamer.stream(["G1 X1", "G1 X2", "G1 X3"])
+    assert len(ser.written) == 3
+    assert streamer.window.isEmpty()
+
+
+def test_lost_ok_times_out(monkeypatch):
+    monkeypatch.setattr(streamerModule, "ACK_TIMEOUT", 0.0)
+    ser = FakeSerial(reply=None)
+    stats = GcodeStreamer(ser).stream(["G1 X1"])
+    assert stats.lostAcks == 1
+
+
+# Corrupts the checksum of the first copy of line `badLine` on its way to the printer, and holds it
+# back to arrive with the next line, which the firmware then throws away unanswered
+class NoisySerial(serial.Serial):
+    def __init__(self, device, badLine):
+        super().__init__(device, 115200, timeout=0.1)
+        self.badLine = b"N%d " % badLine
+        self.held = None
+
+    def write(self, data):
+        if self.badLine is not None and data.startswith(self.badLine):
+            self.badLine = None
+            self.held = data.rsplit(b"*", 1)[0] + b"*999\n"
+            return len(data)
+        if self.held is not None:
+            data, self.held = self.held + data, None
+        return super().write(data)
+
+
+def test_resend_after_a_corrupted_line_doesnt_stall(monkeypatch):
+    # the resent line can be thrown away by a later rejection, which is retried after RESEND_TIMEOUT
+    monkeypatch.setattr(streamerModule, "RESEND_TIMEOUT", 0.3)
+    farm = VirtualPrinterFarm()
+    farm.start()
+    try:
+        printer = farm.spawn()
+        ser = NoisySerial(printer.device, badLine=50)
+        assert ser.readline() == b"start\n"
+        streamer = GcodeStreamer(ser)
+        lines = [(n, encodeNumbered(n, b"G1 X%d" % n)) for n in range(1, 201)]
+        started = time.monotonic()
+        stats = streamer.stream(lines)
+        # the lines flushed with the bad one never get an ok; waiting them out would take ACK_TIMEOUT each
+        assert time.monotonic() - started < streamerModule.ACK_TIMEOUT / 2
+        assert stats.lostAcks == 0 and stats.resends > 0
+        assert printer.getStats()["flushed"] > 0
+        assert printer.lineNumber == 200
+        assert streamer.window.isEmpty()
+        ser.close()
+    finally:
+        farm.stop()
+
+
+def test_resends_survive_line_noise(monkeypatch):
+    monkeypatch.setattr(streamerModule, "RESEND_TIMEOUT", 0.3)
+    farm = VirtualPrinterFarm()
+    farm.start()
+    try:
+        printer = farm.spawn(resendRate=0.05, seed=3)
+        ser = serial.Serial(printer.device, 115200, timeout=0.1)
+        assert ser.readline() == b"start\n"
+        lines = [(n, encodeNumbered(n, b"G1 X%d" % n)) for n in range(1, 501)]
+        stats = GcodeStreamer(ser).stream(lines)
+        assert stats.lostAcks == 0 and stats.resends > 0
+        assert printer.lineNumber == 500
+        ser.close()
+    finally:
+        farm.stop()
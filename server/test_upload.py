@@ -0,0 +1,63 @@
+import io
+import hashlib
+import pytest
+from Classes.BlobStore import blobStore
+from Classes.ChunkedUpload import UploadStore, UploadOffsetMismatch
+from Classes.GcodeBuffer import GcodeBuffer
+
+GCODE = b"".join(b"G1 X%d Y%d E%d ; move %d\n" % (i, i, i, i) for i in range(2000)) + b"M84"
+
+
+def sendChunks(upload, data, size):
+    for offset in range(0, len(data), size):
+        assert upload.append(offset, io.BytesIO(data[offset:offset + size])) == min(offset + size, len(data))
+
+
+def test_chunks_are_hashed_and_stripped_as_they_arrive(tmp_path):
+    upload = UploadStore(str(tmp_path)).create(name="part.gcode", size=len(GCODE))
+    sendChunks(upload, GCODE, 1000)  # chunk edges fall in the middle of lines
+    assert upload.isComplete()
+    key, size = upload.finish()
+    assert key == hashlib.sha256(GCODE).hexdigest() and size == len(GCODE)
+    gcode = GcodeBuffer.load(key)
+    assert len(gcode) == 2001
+    assert gcode[0] == b"G1 X0 Y0 E0\n" and gcode[-1] == b"M84\n"
+    with blobStore.open(key) as blob:
+        assert blob.read() == GCODE
+    assert not (tmp_path / (upload.id + ".part")).exists()
+
+
+def test_chunk_at_the_wrong_offset_is_refused(tmp_path):
+    upload = UploadStore(str(tmp_path)).create(name="part.gcode", size=len(GCODE))
+    upload.append(0, io.BytesIO(GCODE[:100]))
+    with pytest.raises(UploadOffsetMismatch) as error:
+        upload.append(50, io.BytesIO(GCODE[50:150]))
+    assert error.value.expected == 100
+
+
+def test_broken_off_chunk_is_resumed(tmp_path):
+    upload = UploadStore(str(tmp_path)).create(name="part.gcode", size=len(GCODE))
+    assert upload.append(0, io.BytesIO(GCODE[:777])) == 777  # the client lost its connection here
+    assert upload.append(777, io.BytesIO(GCODE[777:])) == len(GCODE)
+    assert upload.finish()[0] == hashlib.sha256(GCODE).hexdigest()
+
+
+def test_upload_survives_a_restart(tmp_path):
+    upload = UploadStore(str(tmp_path)).create(name="part.gcode", size=len(GCODE))
+    upload.append(0, io.BytesIO(GCODE[:5000]))
+    restored = UploadStore(str(tmp_path)).get(upload.id)
+    assert restored.getStatus() == {"uploadid": upload.id, "offset": 5000, "size": len(GCODE)}
+    restored.append(5000, io.BytesIO(GCODE[5000:]))
+    assert restored.finish()[0] == hashlib.sha256(GCODE).hexdigest()
+
+
+def test_data_past_the_declared_size_is_an_error(tmp_path):
+    upload = UploadStore(str(tmp_path)).create(name="part.gcode", size=10)
+    with pytest.raises(ValueError):
+        upload.append(0, io.BytesIO(GCODE[:20]))
+
+
+def test_unknown_upload_ids(tmp_path):
+    store = UploadStore(str(tmp_path))
+    assert store.get("0123abcd") is None
+    assert store.get("../etc") is None
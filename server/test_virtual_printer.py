@@ -0,0 +1,57 @@
+import time
+import pytest
+import serial
+from Classes.VirtualPrinter import VirtualPrinterFarm, lineChecksum
+
+
+@pytest.fixture(scope="module")
+def farm():
+    farm = VirtualPrinterFarm()
+    farm.start()
+    yield farm
+    farm.stop()
+
+
+def openPort(printer):
+    ser = serial.Serial(printer.device, 115200, timeout=0.3)
+    assert ser.readline() == b"start\n"
+    return ser
+
+
+def numbered(number, command, checksum=None):
+    body = f"N{number} {command}"
+    return f"{body}*{lineChecksum(body) if checksum is None else checksum}\n".encode()
+
+
+def readAll(ser):
+    lines = []
+    while True:
+        line = ser.readline()
+        if not line:
+            return lines
+        lines.append(line.decode().strip())
+
+
+def test_bad_line_flushes_the_rx_buffer(farm):
+    printer = farm.spawn()
+    ser = openPort(printer)
+    ser.write(numbered(1, "G1 X1", checksum=0) + numbered(2, "G1 X2") + numbered(3, "G1 X3"))
+    # lines 2 and 3 were already buffered, so they're thrown away without a reply
+    assert readAll(ser) == ["Error:checksum mismatch, Last Line: 0", "Resend: 1", "ok"]
+    assert printer.getStats()["flushed"] == 2
+    # a line that arrives after the flush is rejected on its own
+    ser.write(numbered(2, "G1 X2"))
+    assert readAll(ser) == ["Error:Line Number is not Last Line Number+1, Last Line: 0", "Resend: 1", "ok"]
+    ser.write(numbered(1, "G1 X1") + numbered(2, "G1 X2"))
+    assert readAll(ser) == ["ok", "ok"]
+    ser.close()
+
+
+def test_idle_printer_sends_wait(farm):
+    printer = farm.spawn(waitInterval=0.1)
+    ser = openPort(printer)
+    started = time.monotonic()
+    assert ser.readline() == b"wait\n"
+    assert ser.readline() == b"wait\n"  # and again while it stays idle
+    assert time.monotonic() - started >= 0.1
+    ser.close()